@@ -10,7 +10,7 @@ def create_app():
     app = Flask(__name__, instance_relative_config=True)
     
     # Configure CORS
-    CORS(app, supports_credentials=True)
+    CORS(app, supports_credentials=True, expose_headers=['ETag', 'Link', 'X-Next-Cursor'])
     
     # Use the secret key from the environment variable
     app.secret_key = os.getenv('FLASK_SECRET_KEY')
@@ -30,8 +30,15 @@ def create_app():
     # Create the database tables
     with app.app_context():
         try:
-            from .models import Company  # Import the model here
+            from .models import Company, add_missing_columns, add_missing_indexes  # Import the model here
             db.create_all()
+            add_missing_columns()
+            # Interrupted jobs are failed first, so no mailbox has two active jobs when its unique index is added
+            from .jobs import recover_interrupted_jobs
+            recover_interrupted_jobs()
+            add_missing_indexes()
+            from .search import create_search_index
+            create_search_index()
             app.logger.info("Database tables created successfully")
 
             # Verify if the table was created
@@ -0,0 +1,102 @@
+import re
+
+# "---------- Forwarded message ---------" or "Begin forwarded message:" and the header lines after it
+FORWARD_HEADER = re.compile(
+    r'^[ \t]*(?:-{3,}[ \t]*Forwarded message[ \t]*-{3,}|Begin forwarded message:)[ \t]*\n'
+    r'(?:[ \t]*(?:From|Date|Sent|Subject|To|Cc|Reply-To):[^\n]*\n|[ \t]*\n)*',
+    re.I | re.M
+)
+# Where quoted history starts: "On <date>, <name> wrote:" (possibly wrapped onto a second line),
+# Outlook's "-----Original Message-----", its "From: ... Sent: ..." block or its underscore rule
+REPLY_HEADER = re.compile(
+    r'^[ \t]*(?:On\b[^\n]{0,200}(?:\n[^\n]{0,200})?\bwrote:[ \t]*$'
+    r'|-{3,}[ \t]*Original Message[ \t]*-{3,}'
+    r'|_{10,}[ \t]*$'
+    r'|From:[^\n]*\n[ \t]*(?:Sent|Date):)',
+    re.I | re.M
+)
+QUOTED_LINE = re.compile(r'^[ \t]*>[^\n]*(?:\n|\Z)', re.M)
+# Where a signature, mobile footer or legal disclaimer starts
+SIGNATURE = re.compile(
+    r'^(?:--[ \t]*$'
+    r'|Sent from my \w+'
+    r'|Get Outlook for \w+'
+    r'|(?:CONFIDENTIALITY NOTICE|DISCLAIMER)\b'
+    r'|This (?:e-?mail|message)(?: and any attachments)? (?:is|are|may be|contains?) (?:confidential|privileged|intended))',
+    re.I | re.M
+)
+# A sign-off line; it and the few short lines after it (name, title, phone) are the signature
+SIGN_OFF = re.compile(
+    r'^[ \t]*(?:best|thanks|thank you|many thanks|regards|best regards|kind regards|warm regards|cheers|'
+    r'sincerely|warmly|all the best|talk soon)[ \t]*[,.!]?[ \t]*$',
+    re.I | re.M
+)
+SIGN_OFF_MAX_LINES = 6
+BLANK_LINES = re.compile(r'\n[ \t]*\n(?:[ \t]*\n)+')
+
+# Lines shorter than this ("Thanks!", "Sounds good") are never treated as repeated text
+MIN_DEDUPE_LINE_CHARS = 20
+
+# Cuts text at the first match of pattern when something is left before it, returning (kept, removed)
+def cut_at(pattern, text):
+    match = pattern.search(text)
+    if match is None or not text[:match.start()].strip():
+        return text, ''
+    return text[:match.start()], text[match.start():]
+
+# Cuts a sign-off and the short lines after it when they end the message
+def cut_sign_off(text):
+    for match in SIGN_OFF.finditer(text):
+        tail = text[match.start():]
+        lines = [line for line in tail.splitlines()[1:] if line.strip()]
+        if len(lines) <= SIGN_OFF_MAX_LINES and all(len(line) < 80 for line in lines) and text[:match.start()].strip():
+            return text[:match.start()], tail
+    return text, ''
+
+# Strips what repeats or carries no information from an email body: forwarded-message headers,
+# quoted replies and signatures. Returns (clean text, {reason: removed text}) with reasons
+# 'forward_header', 'quoted' and 'signature'.
+def clean_body(text):
+    removed = {}
+    forward_headers = FORWARD_HEADER.findall(text)
+    if forward_headers:
+        text = FORWARD_HEADER.sub('', text)
+        removed['forward_header'] = ''.join(forward_headers)
+
+    text, quoted = cut_at(REPLY_HEADER, text)
+    quoted_lines = QUOTED_LINE.findall(text)
+    if quoted_lines:
+        text = QUOTED_LINE.sub('', text)
+    quoted = ''.join(quoted_lines) + quoted
+    if quoted:
+        removed['quoted'] = quoted
+
+    text, signature = cut_at(SIGNATURE, text)
+    text, sign_off = cut_sign_off(text)
+    if signature or sign_off:
+        removed['signature'] = sign_off + signature
+
+    return BLANK_LINES.sub('\n\n', text).strip(), removed
+
+def normalize_line(line):
+    return ' '.join(line.lower().split())
+
+# Drops lines of each body that already appeared earlier in the same thread, e.g. a pitch pasted
+# into every follow-up. Returns (bodies, removed text).
+def dedupe_thread_bodies(bodies):
+    seen = set()
+    deduped, removed = [], []
+    for body in bodies:
+        if not body:
+            deduped.append(body)
+            continue
+        kept = []
+        for line in body.splitlines():
+            key = normalize_line(line)
+            if len(key) >= MIN_DEDUPE_LINE_CHARS and key in seen:
+                removed.append(line)
+                continue
+            seen.add(key)
+            kept.append(line)
+        deduped.append('\n'.join(kept))
+    return deduped, '\n'.join(removed)
@@ -0,0 +1,362 @@
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import re
+import openai
+from openai import AsyncOpenAI
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from flask import current_app
+from config import settings
+from .models import ClassificationVerdict
+from .extensions import db
+from . import metrics
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+OPENAI_MODEL = getattr(settings, 'OPENAI_MODEL', 'gpt-3.5-turbo')
+# Prompt tokens of company summaries sent in one request
+CLASSIFIER_CHUNK_TOKENS = getattr(settings, 'CLASSIFIER_CHUNK_TOKENS', 6000)
+# Keeps each answer well inside max_tokens
+CLASSIFIER_MAX_COMPANIES_PER_CHUNK = getattr(settings, 'CLASSIFIER_MAX_COMPANIES_PER_CHUNK', 15)
+CLASSIFIER_CONCURRENCY = getattr(settings, 'CLASSIFIER_CONCURRENCY', 4)
+CLASSIFIER_MAX_ATTEMPTS = getattr(settings, 'CLASSIFIER_MAX_ATTEMPTS', 4)
+# Times a chunk is re-sent when its answer isn't valid JSON
+CLASSIFIER_PARSE_ATTEMPTS = getattr(settings, 'CLASSIFIER_PARSE_ATTEMPTS', 3)
+CLASSIFIER_MAX_TOKENS = 2000
+# Answer tokens expected per company, used to estimate a request's cost before it is sent
+COMPLETION_TOKENS_PER_COMPANY = 60
+
+# USD per million prompt and completion tokens
+OPENAI_PRICES = {
+    'gpt-3.5-turbo': (0.50, 1.50),
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4-turbo': (10.00, 30.00),
+    'gpt-4': (30.00, 60.00),
+}
+OPENAI_PRICE = getattr(settings, 'OPENAI_PRICE', OPENAI_PRICES.get(OPENAI_MODEL, OPENAI_PRICES['gpt-3.5-turbo']))
+# Most a run may spend on OpenAI in USD; None for no limit
+CLASSIFIER_MAX_COST = getattr(settings, 'CLASSIFIER_MAX_COST', None)
+
+# Words and punctuation, for counting tokens when tiktoken isn't available
+TOKEN_PIECES = re.compile(r'\w+|[^\w\s]')
+
+# Errors worth retrying; anything else fails the chunk immediately
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+
+SYSTEM_PROMPT = "You are an AI assistant analyzing potential startup investments for a venture capital firm. Your task is to identify startups from email communications, focusing primarily on the content of the email body."
+
+INSTRUCTIONS = """
+    Analyze the following email content for each company and determine if they are startups that our venture capital firm might be considering for investment. Focus primarily on the email body content, not just the subject lines.
+    If it is a service we're evaluating as a tool that would be used by the firm, it's not a startup. Otherwise, consider the following as potential indicators of a startup:
+
+    1. Discussions about funding rounds, investments, or pitching to investors
+    2. If a company is sending over a deck and/or financials, it's likely a startup, but understand context to make sure it's not just a service we're considering paying for.
+    3. Requests for meetings, demos, or further discussions with investors. However, if the email thread is only 1 email and it's a calendar invite, it's not a startup.
+    4. Mentions of product launches, growth metrics, or market opportunities
+    5. Any indication of early-stage or innovative technology
+
+    For each company, provide a concise analysis:
+    Clearly state if this is likely a startup (yes/no)
+    Briefly explain your reasoning (1 sentence)
+    If it's a startup, summarize what stage they seem to be at and what they're looking for
+
+    If there's insufficient information, err on the side of No.
+    Be thorough in your analysis.
+
+    Each company below starts with an ID line. Respond with a JSON object of this form, with one entry per company ID:
+    {"companies": [{"id": "<company ID>", "is_startup": true or false, "reasoning": "<1 sentence>", "stage": "<stage and what they're looking for, or empty>"}]}
+"""
+
+# Raised when a summary line keeps its wording but changes meaning. 2: Interactions counts the
+# company's emails read, not only those shown.
+SUMMARY_FORMAT = 2
+# Changes whenever the prompt text or the summary format does, so verdicts cached under an older
+# prompt are not reused
+PROMPT_VERSION = hashlib.sha256(f"{SUMMARY_FORMAT}\0{SYSTEM_PROMPT}{INSTRUCTIONS}".encode('utf-8')).hexdigest()[:12]
+
+# The model's tokenizer, or None when tiktoken is not installed or its encoding can't be loaded
+@functools.lru_cache(maxsize=None)
+def tokenizer():
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(OPENAI_MODEL)
+        except KeyError:
+            return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        current_app.logger.warning(f"Counting tokens approximately, tiktoken is unavailable: {str(e)}")
+        return None
+
+# Approximate tokens of a word or symbol: one, plus one per further 6 characters
+def piece_tokens(piece):
+    return 1 + (len(piece) - 1) // 6
+
+# Counts the tokens text takes in the model's prompt
+def count_tokens(text):
+    if not text:
+        return 0
+    encoding = tokenizer()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return sum(piece_tokens(piece) for piece in TOKEN_PIECES.findall(text))
+
+# Cuts text to at most max_tokens tokens
+def truncate_to_tokens(text, max_tokens):
+    if max_tokens <= 0:
+        return ''
+    encoding = tokenizer()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    used = 0
+    for match in TOKEN_PIECES.finditer(text):
+        used += piece_tokens(match.group())
+        if used > max_tokens:
+            return text[:match.start()].rstrip()
+    return text
+
+# Counts the tokens of a chat request, including the few each message adds
+def count_message_tokens(messages):
+    return sum(count_tokens(message['content']) + 4 for message in messages) + 3
+
+# USD cost of a request with the given token counts
+def request_cost(prompt_tokens, completion_tokens):
+    return (prompt_tokens * OPENAI_PRICE[0] + completion_tokens * OPENAI_PRICE[1]) / 1000000
+
+# OpenAI spend of one analysis run. Each request's cost is estimated from its prompt before it is
+# sent, and the request is refused if it would take the run past limit. The actual usage replaces
+# the estimate once the answer arrives. on_change(budget) is called after every change.
+class SpendBudget:
+    def __init__(self, limit=CLASSIFIER_MAX_COST, on_change=None):
+        self.limit = limit
+        self.on_change = on_change
+        self.estimated = 0.0
+        self.skipped_companies = 0
+
+    # Reserves the estimated cost of a request and returns it, or returns None if it doesn't fit
+    def reserve(self, prompt_tokens, companies):
+        cost = request_cost(prompt_tokens, companies * COMPLETION_TOKENS_PER_COMPANY)
+        if self.limit is not None and self.estimated + cost > self.limit:
+            self.skipped_companies += companies
+            self.changed()
+            return None
+        self.estimated += cost
+        self.changed()
+        return cost
+
+    # Replaces a reserved estimate with what the request actually used (nothing if it failed)
+    def settle(self, reserved, usage=None):
+        actual = request_cost(usage.prompt_tokens or 0, usage.completion_tokens or 0) if usage is not None else 0.0
+        self.estimated += actual - reserved
+        self.changed()
+
+    def changed(self):
+        if self.on_change:
+            self.on_change(self)
+
+# Splits (company_id, company_name, summary) entries into chunks that fit the per-request token budget
+def chunk_summaries(entries, max_tokens=CLASSIFIER_CHUNK_TOKENS, max_companies=CLASSIFIER_MAX_COMPANIES_PER_CHUNK):
+    chunks = []
+    chunk, chunk_tokens = [], 0
+    for entry in entries:
+        tokens = count_tokens(entry[2])
+        if chunk and (chunk_tokens + tokens > max_tokens or len(chunk) >= max_companies):
+            chunks.append(chunk)
+            chunk, chunk_tokens = [], 0
+        chunk.append(entry)
+        chunk_tokens += tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+# Builds the chat messages that ask for one chunk of company summaries to be classified
+def classification_messages(chunk):
+    company_blocks = [f"ID: {company_id}\n{summary}" for company_id, _, summary in chunk]
+    prompt = f"""{INSTRUCTIONS}
+    {' '.join(company_blocks)}
+    """
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+# Sends one chunk's messages to OpenAI, retrying rate limits and transient errors
+async def request_classification(messages):
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(CLASSIFIER_MAX_ATTEMPTS),
+        wait=wait_random_exponential(multiplier=1, max=30),
+        retry=retry_if_exception_type(RETRYABLE_ERRORS),
+        reraise=True
+    ):
+        with attempt, metrics.timer(metrics.LLM_REQUEST_SECONDS):
+            response = await send_request(messages)
+    record_usage(response)
+    return response
+
+# Sends one chat completion request, counting it by outcome
+async def send_request(messages):
+    outcome = 'error'
+    try:
+        response = await client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            max_tokens=CLASSIFIER_MAX_TOKENS,
+            n=1,
+            temperature=0.2,
+            response_format={"type": "json_object"}
+        )
+        outcome = 'ok'
+        return response
+    finally:
+        metrics.inc(metrics.LLM_REQUESTS, outcome)
+
+# Adds the tokens a response was billed for to the LLM token counters
+def record_usage(response):
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        metrics.inc(metrics.LLM_TOKENS, 'prompt', amount=usage.prompt_tokens or 0)
+        metrics.inc(metrics.LLM_TOKENS, 'completion', amount=usage.completion_tokens or 0)
+
+# Parses a JSON answer into {company_name: explanation}, where the explanation is None for
+# companies judged not to be startups. Raises ValueError if the answer isn't the expected JSON.
+def parse_verdicts(ai_response, company_names_by_id):
+    try:
+        verdicts = json.loads(ai_response)['companies']
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"Unparseable classifier response: {str(e)}")
+    if not isinstance(verdicts, list):
+        raise ValueError("Unparseable classifier response: 'companies' is not a list")
+
+    results = {}
+    for verdict in verdicts:
+        if not isinstance(verdict, dict):
+            continue
+        company_name = company_names_by_id.get(str(verdict.get('id')))
+        if company_name is None:
+            current_app.logger.warning(f"Classifier returned unknown company ID {verdict.get('id')}")
+            continue
+        is_startup = verdict.get('is_startup') is True
+        current_app.logger.info(f"AI analysis for {company_name}: {'Startup' if is_startup else 'Not a startup'}")
+        explanation = None
+        if is_startup:
+            explanation = f"Yes. {verdict.get('reasoning') or ''}".strip()
+            if verdict.get('stage'):
+                explanation += f"\n{verdict['stage']}"
+        results[company_name] = explanation
+    return results
+
+# Hashes exactly what decides a verdict: the model, the prompt version and the company summary
+def summary_fingerprint(summary):
+    return hashlib.sha256(f"{OPENAI_MODEL}\0{PROMPT_VERSION}\0{summary}".encode('utf-8')).hexdigest()
+
+# Splits (company_name, summary) pairs into verdicts already cached in the database,
+# as {company_name: explanation or None}, and the pairs that still need classifying
+def lookup_cached_verdicts(summaries):
+    fingerprints = [summary_fingerprint(summary) for _, summary in summaries]
+    cached = {}
+    for i in range(0, len(fingerprints), 500):
+        for verdict in ClassificationVerdict.query.filter(ClassificationVerdict.fingerprint.in_(fingerprints[i:i + 500])):
+            cached[verdict.fingerprint] = verdict
+
+    hits, misses = {}, []
+    for (company_name, summary), fingerprint in zip(summaries, fingerprints):
+        verdict = cached.get(fingerprint)
+        if verdict is None:
+            misses.append((company_name, summary))
+        else:
+            hits[company_name] = verdict.explanation if verdict.is_startup else None
+    metrics.inc(metrics.CACHE_LOOKUPS, 'classification', 'hit', amount=len(hits))
+    metrics.inc(metrics.CACHE_LOOKUPS, 'classification', 'miss', amount=len(misses))
+    return hits, misses
+
+# Stores fresh verdicts so unchanged companies skip OpenAI on later runs
+def store_verdicts(summaries, verdicts):
+    stored = 0
+    with metrics.timer(metrics.DB_WRITE_SECONDS, 'classification_verdict'):
+        for company_name, summary in summaries:
+            if company_name in verdicts:
+                explanation = verdicts[company_name]
+                db.session.merge(ClassificationVerdict(
+                    fingerprint=summary_fingerprint(summary),
+                    is_startup=explanation is not None,
+                    explanation=explanation,
+                    model=OPENAI_MODEL
+                ))
+                stored += 1
+        db.session.commit()
+    metrics.inc(metrics.DB_WRITES, 'classification_verdict', amount=stored)
+
+# Classifies (company_name, summary) pairs in token-budgeted chunks sent concurrently, then merges
+# the answers into {company_name: explanation}, with None for companies that are not startups,
+# and caches every verdict. Companies whose chunk failed or was skipped are left out.
+# on_chunk_done(count) is called as each chunk finishes. A chunk whose answer can't be parsed is
+# re-sent on its own, companies its answer leaves out are re-sent as a chunk of their own, and a
+# chunk that still fails only drops its own companies. Every request is
+# charged to spend first; chunks that would exceed its limit are not sent. requests limits the
+# requests in flight; calls running at once share one so that together they stay within
+# CLASSIFIER_CONCURRENCY.
+async def classify_companies(summaries, on_chunk_done=None, spend=None, requests=None):
+    spend = spend or SpendBudget()
+    entries = [(f"c{i}", company_name, summary) for i, (company_name, summary) in enumerate(summaries)]
+    chunks = [(chunk, classification_messages(chunk)) for chunk in chunk_summaries(entries)]
+    prompt_tokens = [count_message_tokens(messages) for _, messages in chunks]
+    estimate = sum(request_cost(tokens, len(chunk) * COMPLETION_TOKENS_PER_COMPANY) for (chunk, _), tokens in zip(chunks, prompt_tokens))
+    semaphore = requests or asyncio.Semaphore(CLASSIFIER_CONCURRENCY)
+    current_app.logger.info(
+        f"Classifying {len(summaries)} companies in {len(chunks)} chunks, {sum(prompt_tokens)} prompt tokens, estimated ${estimate:.4f}"
+    )
+
+    async def classify_chunk(chunk, messages, tokens):
+        verdicts = {}
+        pending = chunk
+        async with semaphore:
+            for attempt in range(1, CLASSIFIER_PARSE_ATTEMPTS + 1):
+                reserved = spend.reserve(tokens, len(pending))
+                if reserved is None:
+                    current_app.logger.warning(f"Skipping {len(pending)} companies: the run would exceed its ${spend.limit} OpenAI budget")
+                    break
+                response = None
+                try:
+                    response = await request_classification(messages)
+                    company_names_by_id = {company_id: company_name for company_id, company_name, _ in pending}
+                    verdicts.update(parse_verdicts(response.choices[0].message.content.strip(), company_names_by_id))
+                except ValueError as e:
+                    current_app.logger.warning(f"{str(e)} (attempt {attempt}/{CLASSIFIER_PARSE_ATTEMPTS})")
+                    continue
+                except Exception as e:
+                    current_app.logger.error(f"Error in GPT analysis: {str(e)}")
+                    break
+                finally:
+                    spend.settle(reserved, getattr(response, 'usage', None))
+                pending = [entry for entry in pending if entry[1] not in verdicts]
+                if not pending:
+                    break
+                current_app.logger.warning(
+                    f"Classifier answer left out {len(pending)} companies (attempt {attempt}/{CLASSIFIER_PARSE_ATTEMPTS})"
+                )
+                messages = classification_messages(pending)
+                tokens = count_message_tokens(messages)
+            else:
+                current_app.logger.warning(
+                    f"No verdict after {CLASSIFIER_PARSE_ATTEMPTS} attempts for {', '.join(name for _, name, _ in pending)}"
+                )
+        if on_chunk_done:
+            on_chunk_done(len(chunk))
+        return verdicts
+
+    verdicts = {}
+    for chunk_verdicts in await asyncio.gather(*[
+        classify_chunk(chunk, messages, tokens) for (chunk, messages), tokens in zip(chunks, prompt_tokens)
+    ]):
+        verdicts.update(chunk_verdicts)
+    store_verdicts(summaries, verdicts)
+    return verdicts
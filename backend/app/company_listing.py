@@ -0,0 +1,106 @@
+import base64
+import hashlib
+import json
+from datetime import datetime
+from sqlalchemy import func, tuple_
+from config import settings
+from .models import Company
+from .extensions import db
+
+# Companies returned per page by /companies and /startups unless limit asks for fewer or more
+COMPANY_PAGE_SIZE = getattr(settings, 'COMPANY_PAGE_SIZE', 100)
+COMPANY_MAX_PAGE_SIZE = 1000
+
+# Columns a listing can be sorted by. Each has an index ending in id, which breaks ties, so
+# every page is a range scan of that index from the cursor.
+SORT_COLUMNS = {
+    'name': Company.name,
+    'last_interaction_date': Company.last_interaction_date,
+    'total_interactions': Company.total_interactions,
+}
+
+# Parses a date argument given as YYYY-MM-DD
+def parse_day(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+# Applies the filters shared by the listings and the export. start_date and end_date
+# (YYYY-MM-DD) keep companies with interactions inside the range, min_interactions and
+# max_interactions bound total_interactions, and contact keeps one contact's companies.
+# Raises ValueError for malformed values.
+def filter_companies(query, args):
+    if args.get('start_date'):
+        query = query.filter(Company.last_interaction_date >= parse_day(args['start_date']))
+    if args.get('end_date'):
+        query = query.filter(Company.first_interaction_date <= parse_day(args['end_date']))
+    if args.get('min_interactions'):
+        query = query.filter(Company.total_interactions >= int(args['min_interactions']))
+    if args.get('max_interactions'):
+        query = query.filter(Company.total_interactions <= int(args['max_interactions']))
+    if args.get('contact'):
+        query = query.filter(Company.company_contact == args['contact'])
+    return query
+
+# Cursors are opaque to clients: the sort they were issued for and the last row's sort key
+def encode_cursor(sort, order, value, company_id):
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    data = json.dumps([sort, order, value, company_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+# Returns the (value, id) a cursor points after. Raises ValueError if it is malformed or was
+# issued for another sort.
+def decode_cursor(cursor, sort, order):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        cursor_sort, cursor_order, value, company_id = data
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if (cursor_sort, cursor_order) != (sort, order):
+        raise ValueError("The cursor belongs to a different sort order")
+    if sort == 'last_interaction_date':
+        value = parse_day(value)
+    return value, int(company_id)
+
+# Reads the sort, order and limit arguments of a listing. Raises ValueError for unknown values.
+def listing_options(args):
+    sort = args.get('sort', 'name')
+    order = args.get('order', 'asc')
+    if sort not in SORT_COLUMNS:
+        raise ValueError(f"sort must be one of {', '.join(SORT_COLUMNS)}")
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be asc or desc")
+    limit = int(args.get('limit', COMPANY_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    return sort, order, min(limit, COMPANY_MAX_PAGE_SIZE)
+
+# Returns one page of companies matching the request arguments and the cursor of the next page,
+# or None on the last page. Pages are found by keyset pagination: each one starts right after the
+# previous page's last (sort value, id), so its cost doesn't grow with how deep it is.
+def list_companies(args):
+    sort, order, limit = listing_options(args)
+    column = SORT_COLUMNS[sort]
+    query = filter_companies(Company.query, args)
+    if args.get('cursor'):
+        key = tuple_(column, Company.id)
+        after = tuple_(*decode_cursor(args['cursor'], sort, order))
+        query = query.filter(key > after if order == 'asc' else key < after)
+    if order == 'asc':
+        query = query.order_by(column.asc(), Company.id.asc())
+    else:
+        query = query.order_by(column.desc(), Company.id.desc())
+
+    companies = query.limit(limit + 1).all()
+    if len(companies) <= limit:
+        return companies, None
+    companies = companies[:limit]
+    last = companies[-1]
+    return companies, encode_cursor(sort, order, getattr(last, sort), last.id)
+
+# Weak ETag of a listing: every analysis stamps the companies it saves with analysis_date, and
+# deletions change the count, so the pair only moves when the table does. The request's
+# arguments are part of it since each page and filter is its own representation.
+def companies_etag(endpoint, args):
+    latest, count = db.session.query(func.max(Company.analysis_date), func.count(Company.id)).one()
+    key = json.dumps([endpoint, latest.isoformat() if latest else None, count, sorted(args.items(multi=True))])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
@@ -0,0 +1,71 @@
+import sys
+from config.settings import INTERNAL_DOMAINS, BLACKLISTED_DOMAINS
+
+# Public suffixes with more than one label, so 'acme.co.uk' is kept whole rather than cut to 'co.uk'
+MULTI_LABEL_SUFFIXES = frozenset({
+    'co.uk', 'org.uk', 'ac.uk', 'gov.uk', 'me.uk', 'ltd.uk', 'plc.uk',
+    'com.au', 'net.au', 'org.au', 'edu.au', 'co.nz', 'org.nz',
+    'co.jp', 'ne.jp', 'or.jp', 'co.kr', 'or.kr', 'co.in', 'net.in', 'org.in',
+    'com.br', 'com.mx', 'com.ar', 'com.cn', 'com.hk', 'com.sg', 'com.tw', 'com.tr',
+    'co.za', 'co.il', 'com.my', 'com.ph', 'com.ng', 'com.pk', 'com.co', 'com.es',
+})
+
+# Domains ending in these never name a company (other investors)
+EXCLUDED_SUFFIXES = ('.vc',)
+
+# Returns the registrable part of a domain, so 'mail.acme.io' and 'acme.io' both give 'acme.io'
+def registrable_domain(domain):
+    labels = domain.strip('.').lower().split('.')
+    if len(labels) > 2 and '.'.join(labels[-2:]) in MULTI_LABEL_SUFFIXES:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+# Returns True if domain is one of entries or a subdomain of one, so 'mail.acme.io' matches
+# 'acme.io' but 'acme.io' doesn't match 'mail.acme.io'
+def matches_domain(domain, entries):
+    labels = domain.strip('.').lower().split('.')
+    return any('.'.join(labels[i:]) in entries for i in range(len(labels)))
+
+# Resolves columns of sender and recipient domains to company keys. Each distinct domain is
+# normalized and checked against the internal, blacklisted and excluded sets once, then reused
+# for every later message from it. Configured domains are matched as written: only the domains
+# of messages are reduced to their registrable part, to key companies.
+class DomainResolver:
+    def __init__(self, internal_domains=INTERNAL_DOMAINS, blacklisted_domains=BLACKLISTED_DOMAINS, excluded_suffixes=EXCLUDED_SUFFIXES):
+        self.internal = frozenset(domain.strip('.').lower() for domain in internal_domains)
+        self.blacklisted = frozenset(domain.strip('.').lower() for domain in blacklisted_domains)
+        self.excluded_suffixes = tuple(excluded_suffixes)
+        self.resolved = {}
+
+    # Returns (registrable domain, is_internal, is_blacklisted, is_excluded) for one domain
+    def resolve(self, domain):
+        info = self.resolved.get(domain)
+        if info is None:
+            key = sys.intern(registrable_domain(domain)) if domain else ''
+            info = self.resolved[domain] = (
+                key, matches_domain(domain, self.internal), matches_domain(domain, self.blacklisted),
+                domain.lower().endswith(self.excluded_suffixes)
+            )
+        return info
+
+    # Returns (keys, skipped) for whole columns of sender and recipient domains. skipped[i] is True
+    # for internal-only and blacklisted conversations; otherwise keys[i] is the company's
+    # registrable domain, or None when the conversation doesn't name a company.
+    def company_keys(self, sender_domains, recipient_domains):
+        resolve = self.resolve
+        keys, skipped = [], []
+        for sender_domain, recipient_domain in zip(sender_domains, recipient_domains):
+            sender, sender_internal, sender_blacklisted, sender_excluded = resolve(sender_domain)
+            recipient, recipient_internal, recipient_blacklisted, recipient_excluded = resolve(recipient_domain)
+            if (sender_internal and recipient_internal) or sender_blacklisted or recipient_blacklisted:
+                keys.append(None)
+                skipped.append(True)
+                continue
+            skipped.append(False)
+            if sender_excluded or recipient_excluded:
+                keys.append(None)
+            elif sender_internal:
+                keys.append(recipient or None)
+            else:
+                keys.append(sender or None)
+        return keys, skipped
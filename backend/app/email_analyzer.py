@@ -1,32 +1,62 @@
 import asyncio
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
 import csv
 from datetime import datetime
 import dateutil.parser
-import base64
+import functools
+import html
 import re
 import logging
-from openai import AsyncOpenAI
-import os
 from collections import defaultdict
 import threading
+import time
 from flask import current_app
-import aiohttp
-import cachetools
-from config.settings import MAX_EMAILS, INTERNAL_DOMAINS, BLACKLISTED_DOMAINS
+from config import settings
+from config.settings import MAX_EMAILS
+from sqlalchemy import case, func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from .models import Company, User
 from .extensions import db
+from . import metrics
+from .message_cache import create_message_cache
+from .email_record import EmailRecord, BODY_CHARS
+from .mime import extract_text, has_attachment
+from .body_cleaner import clean_body
+from .prompt_builder import plan_summary, build_company_summary, PROMPT_CANDIDATE_THREADS
+from .thread_store import ThreadStore, company_aggregates
+from .preclassifier import screen_company, local_model, save_model, CallSavings, PRECLASSIFIER_ENABLED
+from .domains import DomainResolver
+from .classifier import (classify_companies, lookup_cached_verdicts, count_tokens, SpendBudget, CLASSIFIER_CONCURRENCY,
+                         CLASSIFIER_MAX_COMPANIES_PER_CHUNK)
+from .gmail_client import (gmail_service, stream_threads, fetch_messages, run_blocking, new_worker_http, get_history_id, list_changed_thread_ids,
+                           is_history_expired, GMAIL_FETCH_MODE, GMAIL_METADATA_FIRST)
 
-client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Cache for storing processed email data
-email_cache = cachetools.TTLCache(maxsize=1000, ttl=3600)
+# Cache for storing processed email data, in memory or on disk depending on MESSAGE_CACHE_BACKEND
+email_cache = create_message_cache()
 
+# Also write each report to email_data.csv in the working directory
+WRITE_CSV_FILE = getattr(settings, 'WRITE_CSV_FILE', True)
+
+# Threads are parsed and grouped in batches of this many emails
+EMAIL_BATCH_SIZE = 5
+# Items each pipeline stage may run ahead of the next one
+PIPELINE_BUFFER_SIZE = getattr(settings, 'PIPELINE_BUFFER_SIZE', 50)
+# Characters of each body decoded before cleaning, so the text left once quoted history,
+# headers and signatures are cut can still fill BODY_CHARS
+BODY_WINDOW_CHARS = BODY_CHARS * 4
+
+# Raised inside a run when its job has been cancelled
+class AnalysisCancelled(Exception):
+    pass
+
+# Progress of one analysis run. on_update(state) is called after every change, and
+# cancel() asks the run to stop at its next checkpoint. Every change bumps version, so
+# watchers can block in wait_for_update() instead of polling.
 class ProgressTracker:
-    def __init__(self):
+    def __init__(self, on_update=None):
         self.total_emails = 0
         self.processed_emails = 0
         self.total_threads = 0
@@ -36,13 +66,56 @@ class ProgressTracker:
         self.status = "Not started"
         self.num_startups = 0
         self.current_step = "Initializing"
-        self.lock = threading.Lock()
+        self.classification_cache_hits = 0
+        self.classification_cache_misses = 0
+        self.estimated_cost = 0.0
+        self.budget_skipped_companies = 0
+        self.prefiltered_companies = 0
+        self.llm_calls_saved = 0
+        self.version = 0
+        self.closed = False
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.on_update = on_update
+        self.cancelled = threading.Event()
 
     def update(self, **kwargs):
         with self.lock:
-            for key, value in kwargs.items():
+            changes = {key: value for key, value in kwargs.items() if getattr(self, key, None) != value}
+            if not changes:
+                return
+            for key, value in changes.items():
                 setattr(self, key, value)
-            current_app.logger.info(f"Progress update: {self.__dict__}")
+            self.version += 1
+            self.changed.notify_all()
+        current_app.logger.debug(f"Progress update: {changes}")
+        if self.on_update:
+            self.on_update(self.get_state())
+
+    # Blocks until the state moves past version, the run is closed or timeout seconds pass.
+    # Returns the current (version, state).
+    def wait_for_update(self, version, timeout=None):
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version or self.closed, timeout)
+            return self.version, self.get_state()
+
+    # Blocks until the run is closed or timeout seconds pass. Returns True if it is closed.
+    def wait_closed(self, timeout=None):
+        with self.changed:
+            return self.changed.wait_for(lambda: self.closed, timeout)
+
+    # Marks the run as over and wakes every watcher
+    def close(self):
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise AnalysisCancelled()
 
     def get_state(self):
         with self.lock:
@@ -53,176 +126,447 @@ class ProgressTracker:
                 'total_companies': self.total_companies,
                 'analyzed_companies': self.analyzed_companies,
                 'num_startups': self.num_startups,
-                'current_step': self.current_step
+                'current_step': self.current_step,
+                'classification_cache_hits': self.classification_cache_hits,
+                'classification_cache_misses': self.classification_cache_misses,
+                'estimated_cost': self.estimated_cost,
+                'budget_skipped_companies': self.budget_skipped_companies,
+                'prefiltered_companies': self.prefiltered_companies,
+                'llm_calls_saved': self.llm_calls_saved
             }
 
-progress_tracker = ProgressTracker()
-
-# Analyzes email threads to identify potential startup companies
-async def analyze_emails(credentials, user_email, full_reanalysis=False):
-    global progress_tracker
+# Running counts shared by the pipeline stages for progress reporting
+class PipelineStats:
+    def __init__(self):
+        self.processed_threads = 0
+        self.skipped_threads = 0
+        self.processed_emails = 0
+        self.companies = 0
+        self.analyzed_companies = 0
+        self.prefiltered_companies = 0
+        self.calls_saved = CallSavings()
+
+# What the run keeps about one company. Its first PROMPT_CANDIDATE_THREADS threads, which its
+# summary is planned from, the summary and the pre-classifier's features are held only until the
+# company has been classified; afterwards just its last email and verdict remain. Dates and
+# interaction counts for the report come from the stored messages.
+class CompanyGroup:
+    def __init__(self, name):
+        self.name = name
+        self.prompt_threads = []
+        self.summary = None
+        self.features = None
+        self.last_email = None
+        self.queued = False
+        self.explanation = None
+
+    def add_thread(self, thread_emails):
+        if not self.queued:
+            self.prompt_threads.append(thread_emails)
+        self.last_email = thread_emails[-1]
+
+    # The company's emails read until it was sent on to classification, all of them in its
+    # summary's threads. Emails read later aren't counted, or the summary, and so its cached
+    # verdict, would depend on how far the pipeline had run ahead.
+    def interactions(self):
+        return sum(len(thread) for thread in self.prompt_threads)
+
+    # The company is classified once it has a full set of candidate threads
+    def ready(self):
+        return len(self.prompt_threads) >= PROMPT_CANDIDATE_THREADS
+
+pipeline_done = object()
+
+# Runs an async iterator in a task of its own, at most size items ahead of the consumer, so
+# neighbouring pipeline stages overlap. Closing the consumer stops the producer. With pages=True
+# it yields lists of every item waiting in the buffer, for stages that work on a page at a time.
+async def buffered(items, size=PIPELINE_BUFFER_SIZE, pages=False):
+    queue = asyncio.Queue(maxsize=size)
+
+    async def produce():
+        try:
+            async for item in items:
+                await queue.put(item)
+        except Exception as e:
+            await queue.put(e)
+            return
+        await queue.put(pipeline_done)
+
+    task = asyncio.ensure_future(produce())
+    try:
+        finished = False
+        while not finished:
+            page = [await queue.get()]
+            while pages and not queue.empty():
+                page.append(queue.get_nowait())
+            for item in page:
+                if isinstance(item, Exception):
+                    raise item
+            if page[-1] is pipeline_done:
+                page.pop()
+                finished = True
+            if page:
+                yield page if pages else page[0]
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await items.aclose()
+
+# Parse stage: turns fetched threads of user_email's mailbox into batches of parsed emails, (thread_id, emails)
+async def parse_threads(threads, stats, user_email):
+    async for thread_id, thread_data, fetch_error in threads:
+        try:
+            if fetch_error:
+                raise fetch_error
+            thread_messages = thread_data.get('messages', [])
+            for i in range(0, len(thread_messages), EMAIL_BATCH_SIZE):
+                email_batch = thread_messages[i:i + EMAIL_BATCH_SIZE]
+                thread_emails = await asyncio.gather(*[extract_email_data(msg, user_email, include_body=not GMAIL_METADATA_FIRST) for msg in email_batch])
+                current_app.logger.debug(f"Processing batch of {len(thread_emails)} emails from thread {thread_id}")
+                if thread_emails:
+                    yield thread_id, thread_emails
+            stats.processed_threads += 1
+            if thread_data.get('historyId'):
+                email_cache.set_thread(user_email, thread_id, thread_data['historyId'], [msg['id'] for msg in thread_messages])
+        except Exception as e:
+            current_app.logger.error(f"Error processing thread {thread_id}: {str(e)}")
+            stats.skipped_threads += 1
+
+# Filter stage: resolves a page of batches to company keys at once, drops internal and
+# blacklisted conversations and yields (thread_id, company_name, emails). company_name is the registrable
+# domain, or None for conversations that count towards MAX_EMAILS without naming a company.
+async def filter_batches(pages, stats, resolver):
+    async for page in pages:
+        keys, skipped = resolver.company_keys(
+            [thread_emails[0].sender_domain for _, thread_emails in page],
+            [thread_emails[0].recipient_domain for _, thread_emails in page]
+        )
+        for (thread_id, thread_emails), company_name, skip in zip(page, keys, skipped):
+            if skip:
+                current_app.logger.debug(f"Skipped email: {thread_emails[0].sender_email} to {thread_emails[0].recipient_email}")
+                stats.skipped_threads += 1
+                continue
+            yield thread_id, company_name, thread_emails
+
+# Group stage: folds batches into companies, saving each to the store, and yields each company as
+# soon as its prompt threads are complete, then every remaining company once the mailbox or
+# MAX_EMAILS runs out
+async def group_companies(matches, companies, stats, progress_tracker, store):
+    async for thread_id, company_name, thread_emails in matches:
+        progress_tracker.check_cancelled()
+        if company_name:
+            store.add(thread_id, company_name, thread_emails)
+            group = companies.get(company_name)
+            if group is None:
+                current_app.logger.debug(f"Adding new company: {company_name}")
+                group = companies[company_name] = CompanyGroup(company_name)
+                stats.companies += 1
+            group.add_thread(thread_emails)
+            if group.ready() and not group.queued:
+                group.queued = True
+                yield group
+
+        stats.processed_emails += len(thread_emails)
+        processed_emails = min(stats.processed_emails, MAX_EMAILS)
+        progress_tracker.update(
+            total_emails=MAX_EMAILS,
+            processed_emails=processed_emails,
+            total_threads=stats.processed_threads + stats.skipped_threads,
+            total_companies=stats.companies,
+            status=f"Processed {stats.processed_threads} threads, skipped {stats.skipped_threads}, {processed_emails}/{MAX_EMAILS} emails"
+        )
+        if stats.processed_emails >= MAX_EMAILS:
+            break
+
+    for group in companies.values():
+        if not group.queued:
+            group.queued = True
+            yield group
+
+# Screen stage: downloads the bodies a page of companies' summaries need, queues them for the
+# search index, builds the summaries and drops the companies the local pre-classifier is confident
+# are not startups, so only the uncertain ones go on to the LLM. Bodies are downloaded on the
+# stage's own connection, since the fetch stage is still using the service's in another thread.
+async def screen_groups(pages, service, stats, progress_tracker, store, model=None):
+    http = new_worker_http(service)
+    async for page in pages:
+        progress_tracker.check_cancelled()
+        plans = {group.name: plan_summary(group.prompt_threads) for group in page}
+        if GMAIL_METADATA_FIRST:
+            await load_email_bodies(service, store.user_email, [email for plan in plans.values() for thread in plan for email in thread], http)
+            for group in page:
+                store.index(group.name, [email for thread in plans[group.name] for email in thread])
+        dropped = 0
+        for group in page:
+            group.summary = build_company_summary(group.name, plans[group.name], group.interactions())
+            if not PRECLASSIFIER_ENABLED:
+                yield group
+                continue
+            screening = screen_company(group.name, group.prompt_threads, plans[group.name], group.summary, model)
+            if not screening.drop:
+                metrics.inc(metrics.PRECLASSIFIER_DECISIONS, 'sent', screening.reason)
+                group.features = screening.features
+                yield group
+                continue
+            metrics.inc(metrics.PRECLASSIFIER_DECISIONS, 'dropped', screening.reason)
+            current_app.logger.debug(f"Pre-classifier dropped {group.name}: {screening.reason}")
+            calls = stats.calls_saved.calls
+            stats.calls_saved.add(count_tokens(group.summary))
+            metrics.inc(metrics.LLM_CALLS_SAVED, amount=stats.calls_saved.calls - calls)
+            group.prompt_threads, group.summary = [], None
+            dropped += 1
+        if dropped:
+            stats.prefiltered_companies += dropped
+            stats.analyzed_companies += dropped
+            progress_tracker.update(
+                prefiltered_companies=stats.prefiltered_companies,
+                llm_calls_saved=stats.calls_saved.calls,
+                analyzed_companies=stats.analyzed_companies
+            )
+
+# Classify stage: classifies companies in batches as they arrive, with up to
+# CLASSIFIER_CONCURRENCY batches in flight. Waiting for a free slot holds back the stages upstream.
+# A batch may be split into several requests, so the batches share one limit on the requests in
+# flight, which keeps the run at CLASSIFIER_CONCURRENCY of them.
+async def classify_groups(groups, service, stats, progress_tracker, classify=classify_companies, spend=None, model=None):
+    slots = asyncio.Semaphore(CLASSIFIER_CONCURRENCY)
+    requests = asyncio.Semaphore(CLASSIFIER_CONCURRENCY)
+    tasks = []
+
+    async def classify_batch(batch):
+        try:
+            with metrics.timer(metrics.STAGE_SECONDS, 'classify'):
+                await classify_group_batch(batch, service, stats, progress_tracker, classify, spend, model, requests)
+        finally:
+            slots.release()
+
+    async def launch(batch):
+        await slots.acquire()
+        tasks.append(asyncio.ensure_future(classify_batch(batch)))
+
+    batch = []
+    try:
+        async for group in groups:
+            batch.append(group)
+            if len(batch) >= CLASSIFIER_MAX_COMPANIES_PER_CHUNK:
+                await launch(batch)
+                batch = []
+        if batch:
+            await launch(batch)
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+# Classifies one batch of summarized companies, reusing cached verdicts, teaches the local model
+# the fresh ones and releases the companies' prompt threads
+async def classify_group_batch(batch, service, stats, progress_tracker, classify=classify_companies, spend=None, model=None,
+                               requests=None):
+    progress_tracker.check_cancelled()
+    groups = {group.name: group for group in batch}
+    summaries = [(group.name, group.summary) for group in batch]
+
+    # Companies whose summary hasn't changed since a previous run reuse the cached verdict
+    verdicts, summaries = lookup_cached_verdicts(summaries)
+    stats.analyzed_companies += len(verdicts)
+    progress_tracker.update(
+        classification_cache_hits=progress_tracker.classification_cache_hits + len(verdicts),
+        classification_cache_misses=progress_tracker.classification_cache_misses + len(summaries),
+        analyzed_companies=stats.analyzed_companies
+    )
+
+    def on_chunk_done(count):
+        stats.analyzed_companies += count
+        progress_tracker.update(analyzed_companies=stats.analyzed_companies, status=f"Analyzing company {stats.analyzed_companies}/{stats.companies}")
+
+    fresh = await classify(summaries, on_chunk_done, spend, requests) if summaries else {}
+    # Only verdicts OpenAI has just given, negatives included, teach the model: cached ones were
+    # learned when they were fresh
+    if model is not None:
+        for company_name, explanation in fresh.items():
+            if groups[company_name].features is not None:
+                model.learn(groups[company_name].features, explanation is not None)
+    verdicts.update(fresh)
+    for company_name, explanation in verdicts.items():
+        if explanation is not None:
+            groups[company_name].explanation = explanation
+            current_app.logger.info(f"Identified startup: {company_name}")
+    for group in batch:
+        group.prompt_threads, group.summary, group.features = [], None, None
+
+# Analyzes email threads to identify potential startup companies. The run is a pipeline of
+# stages joined by bounded buffers: fetch -> parse -> filter -> group -> screen -> classify -> persist.
+# Classification of early companies overlaps with fetching later threads, and only the prompt
+# threads of companies waiting to be classified are held in memory. fetch_threads and classify
+# can be swapped for alternate implementations with the same signatures.
+async def analyze_emails(credentials, user_email, full_reanalysis, progress_tracker, fetch_threads=stream_threads, classify=classify_companies):
     current_app.logger.info("Starting email analysis")
     progress_tracker.update(status="Fetching emails")
     
-    service = build('gmail', 'v1', credentials=credentials)
+    service = gmail_service(credentials, user_email)
     
     user = User.query.filter_by(email=user_email).first()
-    last_analyzed_email_id = None if full_reanalysis else (user.last_analyzed_email_id if user else None)
+    start_history_id = None if full_reanalysis else (user.last_history_id if user else None)
     
-    companies = defaultdict(lambda: {"threads": [], "interactions": 0})
-    page_token = None
-    processed_emails = 0
-    processed_threads = 0
-    skipped_threads = 0
-    batch_size = 10  # Temporary for testing
-    email_batch_size = 5  # Temporary for testing
+    companies = {}
+    stats = PipelineStats()
+    store = ThreadStore(user_email)
+    model = local_model() if PRECLASSIFIER_ENABLED else None
+    spend = SpendBudget(on_change=lambda budget: progress_tracker.update(
+        estimated_cost=round(budget.estimated, 4), budget_skipped_companies=budget.skipped_companies
+    ))
 
     current_app.logger.info(f"Fetching a maximum of {MAX_EMAILS} emails")
 
+    # In metadata-first mode only headers are fetched here; bodies are downloaded later
+    # for the few emails that survive the domain filter and make it into the prompt
+    thread_format = 'metadata' if GMAIL_METADATA_FIRST else 'full'
     try:
-        while processed_emails < MAX_EMAILS:
-            results = service.users().threads().list(userId='me', maxResults=batch_size, pageToken=page_token).execute()
-            threads = results.get('threads', [])
-            
-            if not threads:
-                current_app.logger.info("No more threads to process")
-                break
-
-            current_app.logger.info(f"Fetched {len(threads)} threads")
-            
-            for thread in threads:
-                if processed_emails >= MAX_EMAILS:
-                    break
-
-                try:
-                    thread_data = service.users().threads().get(userId='me', id=thread['id']).execute()
-                    thread_messages = thread_data.get('messages', [])
-                    
-                    # Check if we've reached the last analyzed email
-                    if last_analyzed_email_id and thread_messages[0]['id'] == last_analyzed_email_id:
-                        current_app.logger.info("Reached last analyzed email, stopping analysis")
-                        break
-                    
-                    # Process emails in smaller batches
-                    for i in range(0, len(thread_messages), email_batch_size):
-                        email_batch = thread_messages[i:i+email_batch_size]
-                        thread_emails = await asyncio.gather(*[extract_email_data(msg) for msg in email_batch])
-                        
-                        current_app.logger.info(f"Processing batch of {len(thread_emails)} emails from thread {thread['id']}")
-                        
-                        if not thread_emails:
-                            current_app.logger.warning(f"Skipping empty batch in thread: {thread['id']}")
-                            continue
-                        
-                        # Check if the email is between two internal addresses or from a blacklisted domain
-                        sender_domain = thread_emails[0]['sender_email'].split('@')[1]
-                        recipient_domain = thread_emails[0]['recipient_email'].split('@')[1]
-                        if (sender_domain in INTERNAL_DOMAINS and recipient_domain in INTERNAL_DOMAINS) or \
-                        (sender_domain in BLACKLISTED_DOMAINS or recipient_domain in BLACKLISTED_DOMAINS):
-                            current_app.logger.info(f"Skipped email: {thread_emails[0]['sender_email']} to {thread_emails[0]['recipient_email']}")
-                            skipped_threads += 1
-                            continue
-                        
-                        company_name = extract_company_name(thread_emails[0])
-                        if company_name:
-                            if company_name in companies:
-                                current_app.logger.info(f"Adding new emails to existing company: {company_name}")
-                                companies[company_name]["threads"].append(thread_emails)
-                                companies[company_name]["interactions"] += len(thread_emails)
-                            else:
-                                current_app.logger.info(f"Adding new company: {company_name}")
-                                companies[company_name] = {
-                                    "threads": [thread_emails],
-                                    "interactions": len(thread_emails),
-                                }
-                            
-                            current_app.logger.info(f"Added {len(thread_emails)} emails to company: {company_name}")
-                        
-                        processed_emails += len(thread_emails)
-                        progress_tracker.update(
-                            total_emails=MAX_EMAILS,
-                            processed_emails=min(processed_emails, MAX_EMAILS),
-                            total_threads=processed_threads + skipped_threads,
-                            status=f"Processed {processed_threads} threads, skipped {skipped_threads}, {min(processed_emails, MAX_EMAILS)}/{MAX_EMAILS} emails"
-                        )
-
-                        if processed_emails >= MAX_EMAILS:
-                            break
-
-                    processed_threads += 1
-
-                except Exception as e:
-                    current_app.logger.error(f"Error processing thread {thread['id']}: {str(e)}")
-                    skipped_threads += 1
-
-                    # If we encounter an error with the last analyzed email, reset and continue
-                    if last_analyzed_email_id and thread['id'] == last_analyzed_email_id:
-                        current_app.logger.warning("Last analyzed email not accessible, continuing with full analysis")
-                        last_analyzed_email_id = None
-
-            if 'nextPageToken' not in results:
-                current_app.logger.info("No more pages to fetch")
-                break
-            page_token = results['nextPageToken']
-
-        # Update the user's last analyzed email ID and analysis date
-        if processed_emails > 0:
-            last_email_id = thread_messages[0]['id']
-            if user:
-                user.last_analyzed_email_id = last_email_id
-                user.last_analysis_date = datetime.utcnow()
-            else:
-                user = User(email=user_email, last_analyzed_email_id=last_email_id, last_analysis_date=datetime.utcnow())
-                db.session.add(user)
-            db.session.commit()
-
-        current_app.logger.info(f"Processed {processed_threads} threads, skipped {skipped_threads}, {processed_emails} emails. Found {len(companies)} companies")
-        progress_tracker.update(total_companies=len(companies), status="Analyzing companies", analyzed_companies=0)
-        startup_companies = await analyze_companies(companies)
+        # Incremental runs only fetch threads that received messages since the last run
+        changed_thread_ids = None
+        if start_history_id:
+            try:
+                changed_thread_ids, history_id = await run_blocking(list_changed_thread_ids, service, start_history_id)
+                current_app.logger.info(f"Found {len(changed_thread_ids)} changed threads since history ID {start_history_id}")
+            except Exception as e:
+                if not is_history_expired(e):
+                    raise
+                current_app.logger.warning("History ID expired, falling back to a full scan")
+        if changed_thread_ids is None:
+            history_id = await run_blocking(get_history_id, service)
+
+        threads = fetch_threads(service, format=thread_format, thread_ids=changed_thread_ids, cached_thread=functools.partial(cached_thread, user_email))
+        batches = buffered(parse_threads(threads, stats, user_email), pages=True)
+        matches = buffered(filter_batches(batches, stats, DomainResolver()))
+        groups = buffered(group_companies(matches, companies, stats, progress_tracker, store), pages=True)
+        screened = buffered(screen_groups(groups, service, stats, progress_tracker, store, model))
+        try:
+            await classify_groups(screened, service, stats, progress_tracker, classify, spend, model)
+        finally:
+            # Stop every stage, including fetch workers still running after MAX_EMAILS was reached
+            for stage in (screened, groups, matches, batches, threads):
+                await stage.aclose()
+
+        store.flush()
+        current_app.logger.info(f"Processed {stats.processed_threads} threads, skipped {stats.skipped_threads}, {stats.processed_emails} emails. Found {len(companies)} companies")
+        current_app.logger.info(f"Stored {store.inserted_messages} new messages")
+        current_app.logger.info(f"Message cache: {email_cache.stats()}")
+        current_app.logger.info(f"Estimated OpenAI cost: ${spend.estimated:.4f}")
+        if spend.skipped_companies:
+            current_app.logger.warning(f"{spend.skipped_companies} companies were not classified: the ${spend.limit} OpenAI budget ran out")
+        if stats.prefiltered_companies:
+            current_app.logger.info(
+                f"Pre-classifier dropped {stats.prefiltered_companies} companies, saving about {stats.calls_saved.calls} OpenAI requests"
+            )
+        save_model(model)
+        progress_tracker.check_cancelled()
+
+        startup_companies = [group for group in companies.values() if group.explanation is not None]
+        current_app.logger.info(f"Identified {len(startup_companies)} potential startups")
         progress_tracker.update(status="Generating CSV", num_startups=len(startup_companies))
-        csv_path = generate_csv(startup_companies, user_email)
+        if GMAIL_METADATA_FIRST:
+            await load_email_bodies(service, user_email, [group.last_email for group in startup_companies])
+            for group in startup_companies:
+                store.index(group.name, [group.last_email])
+        store.flush()
+        with metrics.timer(metrics.STAGE_SECONDS, 'report'):
+            csv_path = generate_csv(startup_companies, user_email)
+
+        # Update the user's history ID and analysis date so the next run starts from here
+        if user:
+            user.last_history_id = history_id
+            user.last_analysis_date = datetime.utcnow()
+        else:
+            user = User(email=user_email, last_history_id=history_id, last_analysis_date=datetime.utcnow())
+            db.session.add(user)
+        db.session.commit()
+
         progress_tracker.update(status="Completed")
         return len(startup_companies), csv_path
+    except AnalysisCancelled:
+        raise
     except Exception as e:
         current_app.logger.error(f"Error in analyze_emails: {str(e)}")
         progress_tracker.update(status="Error", current_step=str(e))
         return None, None
 
-# Extracts relevant data from an email message
-async def extract_email_data(msg):
+# Rebuilds a listed thread of user_email's mailbox from the message cache when it hasn't changed
+# since it was parsed, so the thread and its messages are not fetched from Gmail again. The
+# cached emails are read here and carried in the thread, so one evicted in the meantime can't
+# leave the parse stage without it; if any is missing, or has no body when full messages are
+# fetched, the thread is fetched from Gmail instead.
+def cached_thread(user_email, thread):
+    history_id = thread.get('historyId')
+    message_ids = email_cache.get_thread(user_email, thread['id'], history_id) if history_id else None
+    if not message_ids:
+        return None
+    emails = email_cache.get_many(user_email, message_ids)
+    if len(emails) < len(set(message_ids)):
+        return None
+    if not GMAIL_METADATA_FIRST and any(email.body is None for email in emails.values()):
+        return None
+    return {'id': thread['id'], 'historyId': history_id, 'messages': [{'id': msg_id, 'cached': emails[msg_id]} for msg_id in message_ids]}
+
+# Extracts relevant data from an email message of user_email's mailbox. With include_body=False
+# the body is left as None so it can be downloaded later by load_email_bodies. Messages of a
+# thread rebuilt by cached_thread carry their cached email.
+async def extract_email_data(msg, user_email, include_body=True):
     msg_id = msg.get('id', 'Unknown')
-    if msg_id in email_cache:
-        current_app.logger.info(f"Retrieved email {msg_id} from cache")
-        return email_cache[msg_id]
+    cached = msg.get('cached') or email_cache.get(user_email, msg_id)
+    if cached is not None and (cached.body is not None or not include_body):
+        current_app.logger.debug(f"Retrieved email {msg_id} from cache")
+        return cached
 
-    current_app.logger.info(f"Extracting data for email {msg_id}")
+    current_app.logger.debug(f"Extracting data for email {msg_id}")
 
     headers = msg['payload']['headers']
     subject = next((header['value'] for header in headers if header['name'].lower() == 'subject'), '')
     date = next((header['value'] for header in headers if header['name'].lower() == 'date'), '')
     sender = next((header['value'] for header in headers if header['name'].lower() == 'from'), '')
 
-    body = await get_email_body(msg)
-    body = body[:5000]  # Limit to first 5000 characters
+    body = None
+    if include_body:
+        body = await get_email_body(msg)
 
     parsed_date = parse_date(date)
 
     recipient = next((header['value'] for header in headers if header['name'].lower() == 'to'), '')
     recipient_email = extract_email_address(recipient)
 
-    email_data = {
-        'date': parsed_date,
-        'subject': subject,
-        'sender': sender,
-        'sender_email': extract_email_address(sender),
-        'recipient_email': recipient_email,
-        'body': body
-    }
-
-    email_cache[msg_id] = email_data
-    current_app.logger.info(f"Extracted and cached data for email {msg_id}")
+    # Only the fields later stages read are kept, with the body cut to what they show
+    email_data = EmailRecord(
+        msg_id, parsed_date, subject, extract_email_address(sender), recipient_email, body, has_attachment(msg['payload'])
+    )
+
+    email_cache.set(user_email, msg_id, email_data)
+    current_app.logger.debug(f"Extracted and cached data for email {msg_id}")
     return email_data
 
+# Downloads bodies for emails of user_email's mailbox parsed in metadata-first mode, leaving
+# every other body undownloaded. http is the connection to use when the service's own may be busy in another thread.
+async def load_email_bodies(service, user_email, emails, http=None):
+    pending = defaultdict(list)
+    for email in emails:
+        if email.body is None:
+            pending[email.id].append(email)
+    if not pending:
+        return
+
+    current_app.logger.info(f"Downloading bodies for {len(pending)} emails")
+    with metrics.timer(metrics.STAGE_SECONDS, 'load_bodies'):
+        messages, errors = await run_blocking(fetch_messages, service, list(pending), GMAIL_FETCH_MODE, http)
+        for msg_id, emails in pending.items():
+            if msg_id in errors:
+                current_app.logger.error(f"Error downloading email {msg_id}: {str(errors[msg_id])}")
+                for email in emails:
+                    email.set_body('')
+                continue
+            body = await get_email_body(messages[msg_id])
+            for email in emails:
+                email.set_body(body)
+                email_cache.set(user_email, msg_id, email)
+
 # Parses a date string into a standard format
 def parse_date(date_string):
     try:
@@ -231,141 +575,32 @@ def parse_date(date_string):
     except:
         return date_string  # Return original string if parsing fails
 
-# Extracts the company name from an email address
-def extract_company_name(email_data):
-    try:
-        sender_domain = email_data['sender_email'].split('@')[1]
-        recipient_domain = email_data['recipient_email'].split('@')[1]
-        
-        if sender_domain.endswith('.vc') or recipient_domain.endswith('.vc'):
-            return None
-        
-        if sender_domain in INTERNAL_DOMAINS:
-            return recipient_domain if recipient_domain not in INTERNAL_DOMAINS else None
-        elif recipient_domain in INTERNAL_DOMAINS:
-            return sender_domain
-        else:
-            return sender_domain if sender_domain not in BLACKLISTED_DOMAINS else None
-    except Exception as e:
-        current_app.logger.error(f"Error extracting company name: {str(e)}")
-        return None
-    
-# Analyzes companies to determine if they are startups
-async def analyze_companies(companies):
-    global progress_tracker
-    company_summaries = []
-    startup_companies = {}
-    startup_count = 0
-    for i, (company_name, data) in enumerate(companies.items(), 1):
-        current_app.logger.info(f"Analyzing company: {company_name}")
-        summary = f"Company: {company_name}\n"
-        summary += f"Interactions: {data['interactions']}\n"
-        summary += "Email Threads:\n"
-        for thread in data['threads'][:3]:  # Limit to 3 threads per company
-            summary += "Thread:\n"
-            for email in thread[:3]:  # Limit to 3 emails per thread
-                summary += f"Subject: {email.get('subject', 'No subject')}\n"
-                body = email.get('body', '')
-                if body:
-                    summary += f"Body: {body[:300]}...\n"
-                else:
-                    summary += "Body: No body content\n"
-                summary += "\n"
-        company_summaries.append(summary)
-        progress_tracker.update(analyzed_companies=i, status=f"Analyzing company {i}/{len(companies)}")
-
-    prompt = f"""
-    Analyze the following email content for each company and determine if they are startups that our venture capital firm might be considering for investment. Focus primarily on the email body content, not just the subject lines.
-    If it is a service we're evaluating as a tool that would be used by the firm, it's not a startup. Otherwise, consider the following as potential indicators of a startup:
-
-    1. Discussions about funding rounds, investments, or pitching to investors
-    2. If a company is sending over a deck and/or financials, it's likely a startup, but understand context to make sure it's not just a service we're considering paying for.
-    3. Requests for meetings, demos, or further discussions with investors. However, if the email thread is only 1 email and it's a calendar invite, it's not a startup.
-    4. Mentions of product launches, growth metrics, or market opportunities
-    5. Any indication of early-stage or innovative technology
-
-    For each company, provide a concise analysis:
-    Clearly state if this is likely a startup (yes/no)
-    Briefly explain your reasoning (1 sentence)
-    If it's a startup, summarize what stage they seem to be at and what they're looking for
-
-    If there's insufficient information, err on the side of No.
-    Be thorough in your analysis.
-
-    {' '.join(company_summaries)}
-    """
-
-    current_app.logger.info("Sending request to OpenAI for company analysis")
-    try:
-        response = await client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are an AI assistant analyzing potential startup investments for a venture capital firm. Your task is to identify startups from email communications, focusing primarily on the content of the email body."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=2000,
-            n=1,
-            temperature=0.2
-        )
-        ai_response = response.choices[0].message.content.strip()
-        current_app.logger.info("Received response from OpenAI")
-        
-        for company_analysis in ai_response.split('\n\n'):
-            lines = company_analysis.split('\n')
-            if len(lines) >= 2:
-                ai_company_name = ' '.join(lines[0].replace('Company:', '').strip().strip('*').split()).lower()
-                ai_company_name = re.sub(r'^\d+\.\s*', '', ai_company_name)
-                ai_company_name = ai_company_name.strip('*').strip(':')  # Remove colon as well
-                is_startup = 'yes' in lines[1].strip().lower()
-                current_app.logger.info(f"AI analysis for {ai_company_name}: {'Startup' if is_startup else 'Not a startup'}")
-                if is_startup:
-                    matching_company = next((name for name in companies.keys() if ai_company_name in name.lower()), None)
-                    if matching_company:
-                        startup_companies[matching_company] = companies[matching_company].copy()
-                        startup_companies[matching_company]['ai_explanation'] = '\n'.join(lines[1:])
-                        startup_companies[matching_company]['last_emails'] = [
-                            thread[-1] for thread in startup_companies[matching_company]['threads']
-                        ]
-                        current_app.logger.info(f"Identified startup: {matching_company}")
-                        startup_count += 1
-                    else:
-                        current_app.logger.warning(f"Identified startup {ai_company_name} not found in original companies list")
-
-        current_app.logger.info(f"Identified {startup_count} potential startups")
-        progress_tracker.update(num_startups=startup_count)
-        return startup_companies
-    except Exception as e:
-        current_app.logger.error(f"Error in GPT analysis: {str(e)}")
-        return {}
-    
-# Extracts the body content from an email message
-async def get_email_body(msg):
+# Extracts the body content from an email message, decoding only the first max_chars characters
+# of text, and strips quoted replies, forwarded headers and signatures from it. Falls back to
+# the snippet when the message has no text or HTML part.
+async def get_email_body(msg, max_chars=BODY_WINDOW_CHARS):
     if 'payload' not in msg:
         return msg.get('snippet', '')
-
-    async def decode_body(body):
-        if 'data' in body:
-            return base64.urlsafe_b64decode(body['data']).decode('utf-8', errors='ignore')
-        return ''
-
-    payload = msg['payload']
-
-    if 'body' in payload and payload['body'].get('data'):
-        return await decode_body(payload['body'])
-
-    if 'parts' in payload:
-        text_content = ''
-        for part in payload['parts']:
-            if part['mimeType'] == 'text/plain':
-                text_content += await decode_body(part['body'])
-            elif part['mimeType'] == 'multipart/alternative':
-                for subpart in part['parts']:
-                    if subpart['mimeType'] == 'text/plain':
-                        text_content += await decode_body(subpart['body'])
-        if text_content:
-            return text_content
-
-    return msg.get('snippet', '')
+    text = extract_text(msg['payload'], max_chars)
+    if not text:
+        return html.unescape(msg.get('snippet', ''))
+    return clean_email_body(text)
+
+# Cleans a decoded body. A body that is nothing but quotes and signature is kept as it was.
+def clean_email_body(text):
+    cleaned, _ = clean_body(text)
+    if not cleaned:
+        return text
+    if metrics.METRICS_ENABLED:
+        count_tokens_saved(text[:BODY_CHARS])
+    return cleaned
+
+# Counts the prompt tokens cleaning saves. Without it the prompt would have shown the first
+# BODY_CHARS characters of the body as they were, so only what is cut from those counts.
+def count_tokens_saved(window):
+    _, removed = clean_body(window)
+    for reason, removed_text in removed.items():
+        metrics.inc(metrics.PROMPT_TOKENS_SAVED, reason, amount=count_tokens(removed_text))
 
 # Extracts an email address from a sender string
 def extract_email_address(sender):
@@ -376,96 +611,139 @@ def extract_email_address(sender):
 def generate_csv(startup_companies, user_email):
     filename = 'email_data.csv'
     current_app.logger.info(f"Generating CSV for {len(startup_companies)} startups")
-    
-    def generate_rows():
-        yield ['First Interaction Date', 'Last Interaction Date', 'Company', 'Interactions', 'Last Interaction', 'AI Explanation']
-        for company, data in startup_companies.items():
-            try:
-                current_app.logger.info(f"Processing data for {company}")
-                current_app.logger.debug(f"Data structure: {data}")  # Log the entire data structure
-
-                all_dates = [email['date'] for thread in data['threads'] for email in thread]
-                first_date = min(all_dates)
-                last_date = max(all_dates)
-                
-                first_date_formatted = datetime.strptime(first_date, "%Y-%m-%d").strftime("%m-%d-%Y")
-                last_date_formatted = datetime.strptime(last_date, "%Y-%m-%d").strftime("%m-%d-%Y")
-                
-                total_interactions = sum(len(thread) for thread in data['threads'])
-                
-                # Get the last email from the most recent thread
-                last_email = data['last_emails'][-1] if data['last_emails'] else None
-                if last_email:
-                    last_interaction = f"{last_email.get('sender_email', 'Unknown')} last sent: {last_email['body'][:100]}..."
-                else:
-                    last_interaction = "No interaction data available"
-                
-                company_contact = user_email
-                
-                db_company = Company.query.filter_by(name=company).first()
-                if db_company:
-                    db_company.last_interaction_date = datetime.strptime(last_date, "%Y-%m-%d").date()
-                    db_company.total_interactions = total_interactions
-                    db_company.company_contact = company_contact
-                    current_app.logger.info(f"Updated company in database: {company}")
-                else:
-                    db_company = Company(
-                        name=company,
-                        first_interaction_date=datetime.strptime(first_date, "%Y-%m-%d").date(),
-                        last_interaction_date=datetime.strptime(last_date, "%Y-%m-%d").date(),
-                        total_interactions=total_interactions,
-                        company_contact=company_contact
-                    )
-                    db.session.add(db_company)
-                    current_app.logger.info(f"Added new company to database: {company}")
-                db.session.commit()
-                
-                yield [
-                    first_date_formatted,
-                    last_date_formatted,
-                    company,
-                    total_interactions,
-                    last_interaction,
-                    data.get('ai_explanation', ''),
-                    company_contact
-                ]
-            except Exception as e:
-                current_app.logger.error(f"Error processing data for {company}: {str(e)}")
-                current_app.logger.error(f"Data causing error: {data}")  # Log the problematic data
+
+    rows = []
+    company_rows = []
+    aggregates = company_aggregates(user_email, [group.name for group in startup_companies])
+    for group in startup_companies:
+        company = group.name
+        try:
+            first_date, last_date, total_interactions = aggregates.get(company, (None, None, 0))
+            if first_date is None:
+                raise ValueError("no stored message has a valid date")
+
+            # The last email of the most recently added thread
+            last_email = group.last_email
+            if last_email:
+                last_interaction = f"{last_email.sender_email or 'Unknown'} last sent: {last_email.body[:100]}..."
+            else:
+                last_interaction = "No interaction data available"
+
+            company_contact = user_email
+
+            company_rows.append({
+                'name': company,
+                'first_interaction_date': first_date,
+                'last_interaction_date': last_date,
+                'total_interactions': total_interactions,
+                'company_contact': company_contact,
+                'last_interaction': last_interaction,
+                'ai_explanation': group.explanation or '',
+            })
+            rows.append([
+                first_date.strftime("%m-%d-%Y"),
+                last_date.strftime("%m-%d-%Y"),
+                company,
+                total_interactions,
+                last_interaction,
+                group.explanation or '',
+                company_contact
+            ])
+        except Exception as e:
+            current_app.logger.error(f"Error processing data for {company}: {str(e)}")
+
+    upsert_companies(company_rows)
+
+    # The report can be downloaded from /companies/export, so the shared file is optional
+    if not WRITE_CSV_FILE:
+        return None
 
     with open(filename, 'w', newline='', encoding='utf-8') as file:
         writer = csv.writer(file)
-        for row in generate_rows():
-            writer.writerow(row)
+        writer.writerow(['First Interaction Date', 'Last Interaction Date', 'Company', 'Interactions', 'Last Interaction', 'AI Explanation'])
+        writer.writerows(rows)
 
     current_app.logger.info(f"CSV generated: {filename}")
     return filename
 
-# Summarizes an email thread
-def summarize_thread(thread):
-    first_email = thread[0]
-    last_email = thread[-1]
-    
-    summary = f"Thread of {len(thread)} emails. "
-    summary += f"Started: '{first_email['subject']}'. "
-    if len(thread) > 1:
-        summary += f"Last: '{last_email['subject']}'. "
-    
-    content_summary = ". ".join(set(email['body'][:50] + "..." for email in thread))
-    summary += f"Content: {content_summary[:100]}..."
-    
-    return summary
+# Inserts new companies and updates existing ones in a single transaction. Dates and totals are
+# merged with the stored row: rows saved before messages were stored may cover interactions the
+# message table doesn't have, so the earliest first date, latest last date and larger total win.
+# The other fields are overwritten, and analysis_date is restamped so company listings' ETags change.
+def upsert_companies(company_rows):
+    if not company_rows:
+        return
+    now = datetime.utcnow()
+    for row in company_rows:
+        row['analysis_date'] = now
+    updated_columns = ['company_contact', 'last_interaction', 'ai_explanation', 'analysis_date']
+
+    dialect = db.engine.dialect.name
+    started = time.perf_counter()
+    try:
+        if dialect in ('sqlite', 'postgresql'):
+            # One INSERT ... ON CONFLICT DO UPDATE statement, executed for all rows at once
+            table = Company.__table__
+            statement = (sqlite_insert if dialect == 'sqlite' else postgresql_insert)(table)
+            new = statement.excluded
+            merged = {
+                'first_interaction_date': case(
+                    (new.first_interaction_date < table.c.first_interaction_date, new.first_interaction_date),
+                    else_=table.c.first_interaction_date
+                ),
+                'last_interaction_date': case(
+                    (new.last_interaction_date > table.c.last_interaction_date, new.last_interaction_date),
+                    else_=table.c.last_interaction_date
+                ),
+                'total_interactions': case(
+                    (new.total_interactions > func.coalesce(table.c.total_interactions, 0), new.total_interactions),
+                    else_=table.c.total_interactions
+                ),
+            }
+            statement = statement.on_conflict_do_update(
+                index_elements=['name'],
+                set_=dict(merged, **{column: new[column] for column in updated_columns})
+            )
+            db.session.execute(statement, company_rows)
+        else:
+            existing = {company.name: company for company in Company.query.filter(
+                Company.name.in_([row['name'] for row in company_rows])
+            )}
+            db.session.bulk_insert_mappings(Company, [row for row in company_rows if row['name'] not in existing])
+            db.session.bulk_update_mappings(Company, [
+                dict(
+                    {column: row[column] for column in updated_columns},
+                    id=existing[row['name']].id,
+                    first_interaction_date=min(row['first_interaction_date'], existing[row['name']].first_interaction_date),
+                    last_interaction_date=max(row['last_interaction_date'], existing[row['name']].last_interaction_date),
+                    total_interactions=max(row['total_interactions'], existing[row['name']].total_interactions or 0)
+                )
+                for row in company_rows if row['name'] in existing
+            ])
+        db.session.commit()
+        metrics.observe(metrics.DB_WRITE_SECONDS, time.perf_counter() - started, 'company')
+        metrics.inc(metrics.DB_WRITES, 'company', amount=len(company_rows))
+        current_app.logger.info(f"Saved {len(company_rows)} companies to the database")
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error saving companies to the database: {str(e)}")
 
 # Processes emails to identify startups
-async def process_emails(credentials, user_email, full_reanalysis=False):
-    global progress_tracker
+async def process_emails(credentials, user_email, full_reanalysis=False, progress_tracker=None):
+    progress_tracker = progress_tracker or ProgressTracker()
     progress_tracker.update(status="Starting", current_step="Initializing")
     try:
         current_app.logger.info("Starting email processing")
-        num_startups, csv_path = await analyze_emails(credentials, user_email, full_reanalysis)
+        num_startups, csv_path = await analyze_emails(credentials, user_email, full_reanalysis, progress_tracker)
+        if num_startups is None:
+            return None, None, progress_tracker.current_step, progress_tracker
         current_app.logger.info(f"Email processing complete. Found {num_startups} startups.")
         progress_tracker.update(status="Completed", num_startups=num_startups)
         return num_startups, csv_path, None, progress_tracker
+    except AnalysisCancelled:
+        current_app.logger.info("Email processing cancelled")
+        progress_tracker.update(status="Cancelled", current_step="Cancelled by user")
+        return None, None, "Cancelled", progress_tracker
     except Exception as e:
         current_app.logger.error(f"Error in email processing: {str(e)}")
         progress_tracker.update(status="Error", current_step=str(e))
@@ -0,0 +1,49 @@
+import sys
+
+# Characters of body kept per email: the classifier prompt shows 300 and the report 100
+BODY_CHARS = 300
+
+# Returns the domain part of an email address, or '' if it has none
+def domain_of(address):
+    return address.rpartition('@')[2].lower() if '@' in address else ''
+
+# One parsed email, holding only the fields later stages read. Addresses, domains and dates
+# repeat across a mailbox, so they are interned and each distinct string is stored once.
+# body is None until it has been downloaded (metadata-first mode).
+class EmailRecord:
+    __slots__ = ('id', 'date', 'subject', 'sender_email', 'recipient_email', 'sender_domain', 'recipient_domain', 'body',
+                 'has_attachment')
+
+    def __init__(self, id, date, subject, sender_email, recipient_email, body=None, has_attachment=False):
+        self.id = id
+        self.date = sys.intern(date)
+        self.subject = subject
+        self.sender_email = sys.intern(sender_email)
+        self.recipient_email = sys.intern(recipient_email)
+        self.sender_domain = sys.intern(domain_of(sender_email))
+        self.recipient_domain = sys.intern(domain_of(recipient_email))
+        self.set_body(body)
+        self.has_attachment = has_attachment
+
+    def set_body(self, body):
+        self.body = body[:BODY_CHARS] if body is not None else None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'date': self.date,
+            'subject': self.subject,
+            'sender_email': self.sender_email,
+            'recipient_email': self.recipient_email,
+            'body': self.body,
+            'has_attachment': self.has_attachment
+        }
+
+    # Builds a record from to_dict() output, or from a full email dict cached by older versions
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data['date'], data['subject'], data['sender_email'], data['recipient_email'], data.get('body'),
+                   data.get('has_attachment', False))
+
+    def __repr__(self):
+        return f'<EmailRecord {self.id} {self.sender_email} -> {self.recipient_email}>'
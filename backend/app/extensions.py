@@ -1,3 +1,12 @@
+import contextvars
+from flask import _app_ctx_stack
 from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy()
\ No newline at end of file
+# Analyses share one event loop thread (see runtime.py), so the thread can't tell their database
+# sessions apart. Each analysis task sets its own scope here; everything else is scoped per thread.
+task_scope = contextvars.ContextVar('task_scope', default=None)
+
+def session_scope():
+    return task_scope.get() or _app_ctx_stack.__ident_func__()
+
+db = SQLAlchemy(session_options={'scopefunc': session_scope})
@@ -0,0 +1,353 @@
+import asyncio
+import contextvars
+import functools
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import cachetools
+import httplib2
+import google_auth_httplib2
+from flask import current_app
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from googleapiclient.errors import HttpError
+from config import settings
+from . import metrics
+
+# Gmail rejects batch requests with more than 100 calls
+GMAIL_MAX_BATCH_SIZE = 100
+
+# Quota units charged per call (https://developers.google.com/gmail/api/reference/quota)
+QUOTA_COST = {
+    'threads.list': 10,
+    'threads.get': 10,
+    'messages.get': 5,
+}
+
+GMAIL_FETCH_MODE = getattr(settings, 'GMAIL_FETCH_MODE', 'batch')  # 'batch', 'concurrent' or 'sequential'
+GMAIL_PAGE_SIZE = min(getattr(settings, 'GMAIL_PAGE_SIZE', 100), GMAIL_MAX_BATCH_SIZE)
+GMAIL_BATCH_RETRIES = getattr(settings, 'GMAIL_BATCH_RETRIES', 2)
+GMAIL_FETCH_WORKERS = getattr(settings, 'GMAIL_FETCH_WORKERS', 8)
+GMAIL_QUOTA_UNITS_PER_SECOND = getattr(settings, 'GMAIL_QUOTA_UNITS_PER_SECOND', 250)
+GMAIL_MAX_RETRIES = getattr(settings, 'GMAIL_MAX_RETRIES', 5)
+GMAIL_METADATA_FIRST = getattr(settings, 'GMAIL_METADATA_FIRST', True)
+
+# Headers requested when threads are fetched in metadata format
+METADATA_HEADERS = ['From', 'To', 'Subject', 'Date']
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Keep-alive HTTP connections to Google per mailbox, reused by later runs for the same user.
+# A mailbox has at most one analysis at a time, and within a run only the fetch stage uses this
+# connection; stages that call Gmail while it runs bring their own from new_worker_http, so the
+# connection is never shared between threads.
+user_http_connections = cachetools.TTLCache(maxsize=100, ttl=3600)
+user_http_lock = threading.Lock()
+
+# Parsed Gmail discovery document, loaded once per process
+@functools.lru_cache(maxsize=None)
+def gmail_discovery_document():
+    return json.loads(discovery_cache.get_static_doc('gmail', 'v1'))
+
+# Builds a Gmail client from the cached discovery document on the user's pooled connection
+def gmail_service(credentials, user_email=None):
+    if user_email is None:
+        return build_from_document(gmail_discovery_document(), credentials=credentials)
+    with user_http_lock:
+        http = user_http_connections.get(user_email)
+        if http is None:
+            http = user_http_connections[user_email] = httplib2.Http()
+    return build_from_document(
+        gmail_discovery_document(), http=google_auth_httplib2.AuthorizedHttp(credentials, http=http)
+    )
+
+# Returns True if a failed Gmail call is worth retrying
+def is_retryable(error):
+    return isinstance(error, HttpError) and error.resp.status in RETRYABLE_STATUSES
+
+# Token bucket that spaces out Gmail calls to stay under the per-user quota
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, cost=1):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                await asyncio.sleep((cost - self.tokens) / self.rate)
+
+# Runs a blocking call in a worker thread, keeping the Flask app context
+async def run_blocking(fn, *args, executor=None):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(context.run, fn, *args))
+
+# Creates a separate HTTP connection for a worker, since httplib2 is not thread-safe
+def new_worker_http(service):
+    credentials = getattr(getattr(service, '_http', None), 'credentials', None)
+    if credentials is None:
+        return None
+    return google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+
+# Short method name of a Gmail request, e.g. 'threads.get' for gmail.users.threads.get
+def request_method(request):
+    return getattr(request, 'methodId', '').replace('gmail.users.', '')
+
+# Executes a Gmail request, optionally on a worker's own HTTP connection
+def execute_request(request, http=None):
+    method = request_method(request)
+    outcome = 'error'
+    try:
+        with metrics.timer(metrics.GMAIL_REQUEST_SECONDS, method):
+            response = request.execute() if http is None else request.execute(http=http)
+        outcome = 'ok'
+        return response
+    finally:
+        metrics.inc(metrics.GMAIL_REQUESTS, method, outcome)
+
+# Executes a Gmail request under the rate limiter, backing off on 429 and 5xx responses
+async def execute_with_backoff(request, limiter, cost, executor=None, http=None, retries=GMAIL_MAX_RETRIES):
+    for attempt in range(retries + 1):
+        await limiter.acquire(cost)
+        try:
+            return await run_blocking(execute_request, request, http, executor=executor)
+        except Exception as e:
+            if not is_retryable(e) or attempt == retries:
+                raise
+            delay = min(2 ** attempt, 32) + random.random()
+            current_app.logger.warning(f"Gmail returned {e.resp.status}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+# Builds a threads().get request; 'metadata' fetches only the headers the domain filter needs
+def thread_request(service, thread_id, format='full'):
+    if format == 'metadata':
+        return service.users().threads().get(userId='me', id=thread_id, format='metadata', metadataHeaders=METADATA_HEADERS)
+    return service.users().threads().get(userId='me', id=thread_id)
+
+# Builds a messages().get request for a message's full MIME tree
+def message_request(service, message_id):
+    return service.users().messages().get(userId='me', id=message_id, format='full')
+
+# Executes one request per ID in turn
+def fetch_sequential(ids, make_request, http=None):
+    items, errors = {}, {}
+    for item_id in ids:
+        try:
+            items[item_id] = execute_request(make_request(item_id), http)
+        except Exception as e:
+            errors[item_id] = e
+    return items, errors
+
+# Executes requests through the Gmail batch endpoint, up to batch_size per round trip.
+# Each item succeeds or fails on its own; rate-limited and 5xx items are retried in a later batch.
+# http, if given, is the connection the batches are sent on instead of the service's own.
+def fetch_batched(service, ids, make_request, batch_size=GMAIL_PAGE_SIZE, retries=GMAIL_BATCH_RETRIES, http=None):
+    items, errors = {}, {}
+    batch_size = min(batch_size, GMAIL_MAX_BATCH_SIZE)
+
+    method = None
+
+    def on_response(request_id, response, exception):
+        metrics.inc(metrics.GMAIL_REQUESTS, method, 'ok' if exception is None else 'error')
+        if exception is not None:
+            errors[request_id] = exception
+        else:
+            items[request_id] = response
+            errors.pop(request_id, None)
+
+    pending = list(ids)
+    for attempt in range(retries + 1):
+        for i in range(0, len(pending), batch_size):
+            chunk = pending[i:i + batch_size]
+            batch = service.new_batch_http_request(callback=on_response)
+            for item_id in chunk:
+                request = make_request(item_id)
+                method = request_method(request)
+                batch.add(request, request_id=item_id)
+            try:
+                with metrics.timer(metrics.GMAIL_REQUEST_SECONDS, 'batch'):
+                    batch.execute() if http is None else batch.execute(http=http)
+            except Exception as e:
+                current_app.logger.error(f"Gmail batch request failed: {str(e)}")
+                for item_id in chunk:
+                    errors[item_id] = e
+
+        pending = [item_id for item_id, error in errors.items() if is_retryable(error)]
+        if not pending or attempt == retries:
+            break
+        current_app.logger.warning(f"Retrying {len(pending)} items after batch errors")
+        time.sleep(2 ** attempt)
+
+    return items, errors
+
+# Fetches thread data for a page of thread IDs using the configured fetch mode
+def fetch_threads(service, thread_ids, mode=GMAIL_FETCH_MODE, format='full'):
+    make_request = functools.partial(thread_request, service, format=format)
+    if mode == 'sequential':
+        return fetch_sequential(thread_ids, make_request)
+    return fetch_batched(service, thread_ids, make_request)
+
+# Fetches full messages by ID using the configured fetch mode, optionally on a connection of
+# the caller's own
+def fetch_messages(service, message_ids, mode=GMAIL_FETCH_MODE, http=None):
+    make_request = functools.partial(message_request, service)
+    if mode == 'sequential':
+        return fetch_sequential(message_ids, make_request, http)
+    return fetch_batched(service, message_ids, make_request, http=http)
+
+# Returns the mailbox's current history ID
+def get_history_id(service):
+    return execute_request(service.users().getProfile(userId='me'))['historyId']
+
+# Returns True if Gmail rejected a start history ID because it is too old
+def is_history_expired(error):
+    return isinstance(error, HttpError) and error.resp.status == 404
+
+# Returns the IDs of threads that received messages since start_history_id, newest first,
+# along with the mailbox's latest history ID. Raises HttpError 404 if the ID has expired.
+def list_changed_thread_ids(service, start_history_id):
+    thread_ids = []
+    page_token = None
+    while True:
+        results = execute_request(service.users().history().list(
+            userId='me', startHistoryId=start_history_id, historyTypes='messageAdded', pageToken=page_token
+        ))
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                thread_ids.append(added['message']['threadId'])
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    return list(dict.fromkeys(reversed(thread_ids))), results['historyId']
+
+# Yields pages of listed threads ({'id', 'historyId', ...}) from threads().list, newest first
+async def list_thread_pages(service, limiter=None, executor=None):
+    page_token = None
+    while True:
+        request = service.users().threads().list(userId='me', maxResults=GMAIL_PAGE_SIZE, pageToken=page_token)
+        if limiter:
+            results = await execute_with_backoff(request, limiter, QUOTA_COST['threads.list'], executor)
+        else:
+            results = await run_blocking(execute_request, request)
+        threads = results.get('threads', [])
+        if not threads:
+            current_app.logger.info("No more threads to process")
+            return
+
+        current_app.logger.info(f"Fetched {len(threads)} threads")
+        yield threads
+
+        if 'nextPageToken' not in results:
+            current_app.logger.info("No more pages to fetch")
+            return
+        page_token = results['nextPageToken']
+
+# Yields a known list of thread IDs in pages
+async def split_thread_pages(thread_ids):
+    for i in range(0, len(thread_ids), GMAIL_PAGE_SIZE):
+        yield [{'id': thread_id} for thread_id in thread_ids[i:i + GMAIL_PAGE_SIZE]]
+
+# Returns {thread_id: thread_data} for the threads of a page that cached_thread can rebuild
+def lookup_cached_threads(cached_thread, page):
+    cached_threads = {}
+    for thread in page:
+        thread_data = cached_thread(thread)
+        if thread_data:
+            cached_threads[thread['id']] = thread_data
+    return cached_threads
+
+# Yields (thread_id, thread_data, error) for each thread, fetching one page at a time.
+# cached_thread(thread) may return thread data for a listed thread so it isn't fetched again.
+# It may block on a disk cache, so each page's lookups run in a worker thread.
+async def stream_thread_pages(service, mode=GMAIL_FETCH_MODE, format='full', thread_ids=None, cached_thread=None):
+    pages = list_thread_pages(service) if thread_ids is None else split_thread_pages(thread_ids)
+    async for page in pages:
+        cached_threads = {}
+        if cached_thread:
+            cached_threads = await run_blocking(lookup_cached_threads, cached_thread, page)
+        missing_ids = [thread['id'] for thread in page if thread['id'] not in cached_threads]
+        fetched_threads, fetch_errors = {}, {}
+        if missing_ids:
+            fetched_threads, fetch_errors = await run_blocking(fetch_threads, service, missing_ids, mode, format)
+        fetched_threads.update(cached_threads)
+        for thread in page:
+            yield thread['id'], fetched_threads.get(thread['id']), fetch_errors.get(thread['id'])
+
+# Yields (thread_id, thread_data, error) as a pool of workers fetches threads concurrently.
+# A producer walks threads().list pages while the workers share one token bucket sized to the
+# per-user quota, so throughput grows with the worker count until Gmail's limit is reached.
+# An error listing threads is raised to the consumer, as stream_thread_pages does, rather than
+# ending the mailbox early.
+async def stream_threads_concurrent(service, workers=GMAIL_FETCH_WORKERS, format='full', thread_ids=None, cached_thread=None):
+    limiter = TokenBucket(GMAIL_QUOTA_UNITS_PER_SECOND)
+    executor = ThreadPoolExecutor(max_workers=workers + 1, thread_name_prefix='gmail-fetch')
+    pending = asyncio.Queue(maxsize=GMAIL_PAGE_SIZE * 2)
+    results = asyncio.Queue(maxsize=GMAIL_PAGE_SIZE * 2)
+    done = object()
+
+    async def produce():
+        pages = list_thread_pages(service, limiter, executor) if thread_ids is None else split_thread_pages(thread_ids)
+        try:
+            async for page in pages:
+                cached_threads = await run_blocking(lookup_cached_threads, cached_thread, page) if cached_thread else {}
+                for thread in page:
+                    thread_data = cached_threads.get(thread['id'])
+                    if thread_data:
+                        await results.put((thread['id'], thread_data, None))
+                    else:
+                        await pending.put(thread['id'])
+        except Exception as e:
+            current_app.logger.error(f"Error listing threads: {str(e)}")
+            await results.put(e)
+            return
+        for _ in range(workers):
+            await pending.put(done)
+
+    async def fetch():
+        http = new_worker_http(service)
+        while True:
+            thread_id = await pending.get()
+            if thread_id is done:
+                break
+            request = thread_request(service, thread_id, format)
+            try:
+                thread_data = await execute_with_backoff(request, limiter, QUOTA_COST['threads.get'], executor, http)
+                await results.put((thread_id, thread_data, None))
+            except Exception as e:
+                await results.put((thread_id, None, e))
+        await results.put(done)
+
+    tasks = [asyncio.ensure_future(produce())] + [asyncio.ensure_future(fetch()) for _ in range(workers)]
+    try:
+        running = workers
+        while running:
+            item = await results.get()
+            if isinstance(item, Exception):
+                raise item
+            if item is done:
+                running -= 1
+                continue
+            yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        executor.shutdown(wait=False)
+
+# Yields (thread_id, thread_data, error) for each thread using the configured fetch mode.
+# Walks the whole mailbox unless a list of thread IDs is given.
+def stream_threads(service, mode=GMAIL_FETCH_MODE, format='full', thread_ids=None, cached_thread=None):
+    if mode == 'concurrent':
+        return stream_threads_concurrent(service, format=format, thread_ids=thread_ids, cached_thread=cached_thread)
+    return stream_thread_pages(service, mode, format, thread_ids, cached_thread)
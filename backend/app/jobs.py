@@ -0,0 +1,296 @@
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from config import settings
+from .email_analyzer import ProgressTracker, process_emails
+from .models import AnalysisJob
+from .extensions import db
+from . import metrics
+from .runtime import runtime
+
+# Analyses that can run at once in this process; further jobs wait in the queue
+ANALYSIS_WORKERS = getattr(settings, 'ANALYSIS_WORKERS', 2)
+# Minimum seconds between progress writes to the database while a job runs
+JOB_PERSIST_INTERVAL = getattr(settings, 'JOB_PERSIST_INTERVAL', 2.0)
+# Minimum seconds between progress events sent to one /progress_stream client
+PROGRESS_STREAM_INTERVAL = getattr(settings, 'PROGRESS_STREAM_INTERVAL', 1.0)
+# Seconds without a change before a keep-alive is sent
+PROGRESS_STREAM_HEARTBEAT = 15
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+# Returns True if a process with this PID is still alive
+def process_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+# Writes job fields with a short transaction of its own, independent of the analysis session
+def save_job(job_id, **fields):
+    for field in ('progress', 'metrics'):
+        if field in fields:
+            fields[field] = json.dumps(fields[field])
+    with metrics.timer(metrics.DB_WRITE_SECONDS, 'analysis_job'), db.engine.begin() as connection:
+        connection.execute(AnalysisJob.__table__.update().where(AnalysisJob.__table__.c.id == job_id).values(**fields))
+    metrics.inc(metrics.DB_WRITES, 'analysis_job')
+
+# Returns True if any server process has asked for the job to be cancelled
+def cancel_requested(job_id):
+    table = AnalysisJob.__table__
+    with db.engine.connect() as connection:
+        return bool(connection.execute(select(table.c.cancel_requested).where(table.c.id == job_id)).scalar())
+
+# Returns the mailbox's queued or running job, or None. A job left active by a process that has
+# since exited is marked as failed in the session's transaction instead.
+def active_job(user_email):
+    job = AnalysisJob.query.filter(AnalysisJob.user_email == user_email, AnalysisJob.status.in_(ACTIVE_STATUSES)).first()
+    if job is not None and not process_alive(job.worker_pid):
+        job.status = 'failed'
+        job.error = 'Interrupted by a server restart'
+        job.finished_at = datetime.utcnow()
+        db.session.flush()
+        return None
+    return job
+
+# Converts a job record into the state returned by the progress endpoints
+def job_state(job):
+    state = json.loads(job.progress) if job.progress else ProgressTracker().get_state()
+    state.update({
+        'job_id': job.id,
+        'job_status': job.status,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'metrics': json.loads(job.metrics) if job.metrics else None,
+    })
+    return state
+
+# Marks jobs left queued or running by a process that has since exited as failed
+def recover_interrupted_jobs():
+    for job in AnalysisJob.query.filter(AnalysisJob.status.in_(ACTIVE_STATUSES)):
+        if not process_alive(job.worker_pid):
+            job.status = 'failed'
+            job.error = 'Interrupted by a server restart'
+            job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+# A job queued or running in this process
+class ActiveJob:
+    def __init__(self, job_id, user_email):
+        self.job_id = job_id
+        self.user_email = user_email
+        self.status = 'queued'
+        self.persisted_at = 0
+        self.tracker = ProgressTracker(on_update=self.persist_progress)
+        self.metrics = metrics.RunMetrics()
+        self.future = None
+
+    # Saves progress at most once per JOB_PERSIST_INTERVAL so status survives restarts
+    def persist_progress(self, state):
+        now = time.monotonic()
+        if now - self.persisted_at >= JOB_PERSIST_INTERVAL:
+            self.persisted_at = now
+            save_job(self.job_id, progress=state)
+
+# Runs analyses as tasks on the shared async runtime, at most max_workers at once in this process
+# and one job per mailbox at a time across every process sharing the database
+class JobManager:
+    def __init__(self, max_workers=ANALYSIS_WORKERS):
+        self.max_workers = max_workers
+        self.slots = None
+        self.jobs = {}
+        self.lock = threading.Lock()
+        # Notified when a job finishes or is cancelled here, so watchers of saved state look again
+        self.changed = threading.Condition(self.lock)
+
+    # Queues an analysis and returns (job_id, created). If the mailbox already has a queued or
+    # running job in any process, that job's ID is returned instead of starting a duplicate run.
+    # The check and the insert share a transaction, and the unique index on a mailbox's active
+    # job turns away a second process that inserts between them.
+    def submit(self, app, credentials, user_email, full_reanalysis=False):
+        with self.lock:
+            existing = active_job(user_email)
+            if existing is not None:
+                return existing.id, False
+
+            job = ActiveJob(str(uuid.uuid4()), user_email)
+            db.session.add(AnalysisJob(
+                id=job.job_id,
+                user_email=user_email,
+                status='queued',
+                full_reanalysis=full_reanalysis,
+                progress=json.dumps(job.tracker.get_state()),
+                worker_pid=os.getpid()
+            ))
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Another process queued a job for the mailbox since the check
+                db.session.rollback()
+                existing = active_job(user_email)
+                if existing is None:
+                    raise
+                return existing.id, False
+            self.jobs[job.job_id] = job
+            job.future = runtime.submit(app, self.run(job, credentials, full_reanalysis))
+        current_app.logger.info(f"Queued analysis job {job.job_id} for {user_email}")
+        return job.job_id, True
+
+    async def run(self, job, credentials, full_reanalysis):
+        # Everything the run records is also counted in job.metrics for its final result
+        metrics.current_run.set(job.metrics)
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_workers)
+        poller = asyncio.ensure_future(self.poll_cancellation(job))
+        try:
+            await self.run_in_slot(job, credentials, full_reanalysis)
+        finally:
+            poller.cancel()
+
+    # Runs the analysis once one of this process's slots is free
+    async def run_in_slot(self, job, credentials, full_reanalysis):
+        async with self.slots:
+            try:
+                if job.tracker.cancelled.is_set() or cancel_requested(job.job_id):
+                    self.finish(job, 'cancelled')
+                    return
+                job.status = 'running'
+                save_job(job.job_id, status='running', started_at=datetime.utcnow())
+                with metrics.timer(metrics.STAGE_SECONDS, 'total'):
+                    num_startups, csv_path, error, _ = await process_emails(
+                        credentials, job.user_email, full_reanalysis, job.tracker
+                    )
+                if job.tracker.cancelled.is_set():
+                    self.finish(job, 'cancelled')
+                elif error:
+                    self.finish(job, 'failed', error=error)
+                else:
+                    self.finish(job, 'completed', num_startups=num_startups)
+            except Exception as e:
+                current_app.logger.error(f"Error in analysis job {job.job_id}: {str(e)}")
+                job.tracker.update(status="Error", current_step=str(e))
+                self.finish(job, 'failed', error=str(e))
+
+    def finish(self, job, status, **fields):
+        metrics.inc(metrics.JOBS_FINISHED, status)
+        save_job(
+            job.job_id, status=status, progress=job.tracker.get_state(), metrics=job.metrics.summary(),
+            finished_at=datetime.utcnow(), **fields
+        )
+        with self.lock:
+            self.jobs.pop(job.job_id, None)
+            self.changed.notify_all()
+        job.status = status
+        job.tracker.close()
+        current_app.logger.info(f"Analysis job {job.job_id} {status}")
+
+    # Asks a job to stop, whichever process runs it, and returns False if it isn't queued or
+    # running. The request is saved with the job, and the process running it picks it up within
+    # JOB_PERSIST_INTERVAL; a job of this process is stopped straight away.
+    def cancel(self, job_id):
+        table = AnalysisJob.__table__
+        with db.engine.begin() as connection:
+            requested = connection.execute(
+                table.update().where(table.c.id == job_id, table.c.status.in_(ACTIVE_STATUSES)).values(cancel_requested=True)
+            ).rowcount
+        metrics.inc(metrics.DB_WRITES, 'analysis_job')
+        if not requested:
+            return False
+        with self.lock:
+            job = self.jobs.get(job_id)
+            self.changed.notify_all()
+        if job is not None:
+            self.stop(job)
+        return True
+
+    # Stops a job of this process. Queued jobs never start; running jobs stop at their next checkpoint.
+    def stop(self, job):
+        job.tracker.cancel()
+        if job.status == 'queued' and job.future.cancel():
+            job.tracker.update(status="Cancelled", current_step="Cancelled by user")
+            self.finish(job, 'cancelled')
+
+    # Stops the job once a cancel request handled by any process has been saved
+    async def poll_cancellation(self, job):
+        while not job.tracker.cancelled.is_set():
+            await asyncio.sleep(JOB_PERSIST_INTERVAL)
+            if cancel_requested(job.job_id):
+                current_app.logger.info(f"Cancel requested for analysis job {job.job_id}")
+                self.stop(job)
+
+    # Returns the job's live state if it runs here, otherwise its last saved state
+    def get_state(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        record = db.session.get(AnalysisJob, job_id, populate_existing=True)
+        if record is None:
+            return None
+        state = job_state(record)
+        if job is not None:
+            state.update(job.tracker.get_state())
+        return state
+
+    # Yields the job's state whenever it changes, at most once per interval seconds, and None after
+    # PROGRESS_STREAM_HEARTBEAT seconds without a change. Ends with the job's final saved state.
+    # A job of this process is followed through its tracker, one of another process through the
+    # progress it saves.
+    def watch(self, job_id, interval=PROGRESS_STREAM_INTERVAL):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            yield from self.watch_saved(job_id)
+            return
+        version = None
+        while not job.tracker.closed:
+            new_version, state = job.tracker.wait_for_update(version, PROGRESS_STREAM_HEARTBEAT)
+            if job.tracker.closed:
+                break
+            if new_version == version:
+                yield None
+                continue
+            version = new_version
+            state.update(job_id=job_id, job_status=job.status)
+            yield state
+            # Holds back the next event for interval seconds, unless the job ends first
+            job.tracker.wait_closed(interval)
+        yield self.get_state(job_id)
+
+    # Follows a job through the progress its process saves every JOB_PERSIST_INTERVAL, yielding
+    # like watch() until the job is no longer queued or running
+    def watch_saved(self, job_id):
+        last, quiet = None, 0.0
+        while True:
+            state = self.get_state(job_id)
+            # Returns the connection between reads and makes the next read see newer saves
+            db.session.close()
+            if state is None or state['job_status'] not in ACTIVE_STATUSES:
+                yield state
+                return
+            if state != last:
+                last, quiet = state, 0.0
+                yield state
+            elif quiet >= PROGRESS_STREAM_HEARTBEAT:
+                quiet = 0.0
+                yield None
+            with self.changed:
+                self.changed.wait(JOB_PERSIST_INTERVAL)
+            quiet += JOB_PERSIST_INTERVAL
+
+    def latest_job_id(self, user_email):
+        record = AnalysisJob.query.filter_by(user_email=user_email).order_by(AnalysisJob.created_at.desc()).first()
+        return record.id if record else None
+
+job_manager = JobManager()
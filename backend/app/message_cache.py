@@ -0,0 +1,201 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import cachetools
+from config import settings
+from . import metrics
+from .email_record import EmailRecord
+
+MESSAGE_CACHE_BACKEND = getattr(settings, 'MESSAGE_CACHE_BACKEND', 'memory')  # 'memory' or 'sqlite'
+MESSAGE_CACHE_MAX_BYTES = getattr(settings, 'MESSAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+MESSAGE_CACHE_PATH = getattr(
+    settings, 'MESSAGE_CACHE_PATH', os.path.join(os.path.abspath(os.path.dirname(__file__)), 'message_cache.db')
+)
+
+# Number of writes between checks of the SQLite cache's total size
+EVICTION_CHECK_INTERVAL = 100
+
+# Both caches key entries by mailbox and Gmail ID: message and thread IDs are only unique within
+# one mailbox, and a cache is shared by every user of a process (or, for SQLite, of a file).
+
+# In-process cache of parsed emails (EmailRecords), lost on restart and private to each worker.
+# Thread lookups run in worker threads, so every access takes the lock.
+class MemoryMessageCache:
+    def __init__(self, maxsize=1000, ttl=3600):
+        self.messages = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self.threads = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_email, msg_id):
+        with self.lock:
+            email_data = self.messages.get((user_email, msg_id))
+            if email_data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.inc(metrics.CACHE_LOOKUPS, 'message', 'miss' if email_data is None else 'hit')
+        return email_data
+
+    def set(self, user_email, msg_id, email_data):
+        with self.lock:
+            self.messages[user_email, msg_id] = email_data
+
+    def get_thread(self, user_email, thread_id, history_id):
+        with self.lock:
+            cached = self.threads.get((user_email, thread_id))
+        if cached and cached[0] == history_id:
+            return cached[1]
+        return None
+
+    def set_thread(self, user_email, thread_id, history_id, message_ids):
+        with self.lock:
+            self.threads[user_email, thread_id] = (history_id, message_ids)
+
+    # Returns {msg_id: email_data} for the given messages that are cached
+    def get_many(self, user_email, msg_ids):
+        msg_ids = set(msg_ids)
+        found = {}
+        with self.lock:
+            for msg_id in msg_ids:
+                email_data = self.messages.get((user_email, msg_id))
+                if email_data is not None:
+                    found[msg_id] = email_data
+            self.hits += len(found)
+            self.misses += len(msg_ids) - len(found)
+        metrics.inc(metrics.CACHE_LOOKUPS, 'message', 'hit', amount=len(found))
+        metrics.inc(metrics.CACHE_LOOKUPS, 'message', 'miss', amount=len(msg_ids) - len(found))
+        return found
+
+    def stats(self):
+        return {'backend': 'memory', 'hits': self.hits, 'misses': self.misses, 'entries': len(self.messages)}
+
+    def clear(self):
+        with self.lock:
+            self.messages.clear()
+            self.threads.clear()
+
+# Persistent cache of parsed emails keyed by mailbox and Gmail message ID, shared by every process
+# that opens the same file. Gmail messages never change, so entries only leave through LRU
+# eviction once the stored data grows past max_bytes.
+class SQLiteMessageCache:
+    def __init__(self, path=MESSAGE_CACHE_PATH, max_bytes=MESSAGE_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # Caches written before entries were keyed by mailbox can't be told apart by user, so they are dropped
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(messages)')}
+            if columns and 'user_email' not in columns:
+                conn.execute('DROP TABLE IF EXISTS messages')
+                conn.execute('DROP TABLE IF EXISTS threads')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS messages (user_email TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL, '
+                'size INTEGER NOT NULL, accessed_at REAL NOT NULL, PRIMARY KEY (user_email, id))'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_messages_accessed_at ON messages (accessed_at)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS threads (user_email TEXT NOT NULL, id TEXT NOT NULL, '
+                'history_id TEXT NOT NULL, message_ids TEXT NOT NULL, PRIMARY KEY (user_email, id))'
+            )
+            self.local.conn = conn
+        return conn
+
+    def get(self, user_email, msg_id):
+        conn = self.connection()
+        row = conn.execute('SELECT data FROM messages WHERE user_email = ? AND id = ?', (user_email, msg_id)).fetchone()
+        metrics.inc(metrics.CACHE_LOOKUPS, 'message', 'miss' if row is None else 'hit')
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        conn.execute('UPDATE messages SET accessed_at = ? WHERE user_email = ? AND id = ?', (time.time(), user_email, msg_id))
+        return EmailRecord.from_dict(json.loads(row[0]))
+
+    def set(self, user_email, msg_id, email_data):
+        data = json.dumps(email_data.to_dict())
+        self.connection().execute(
+            'INSERT OR REPLACE INTO messages (user_email, id, data, size, accessed_at) VALUES (?, ?, ?, ?, ?)',
+            (user_email, msg_id, data, len(data), time.time())
+        )
+        with self.lock:
+            self.writes += 1
+            check_size = self.writes % EVICTION_CHECK_INTERVAL == 0
+        if check_size:
+            self.evict()
+
+    def get_thread(self, user_email, thread_id, history_id):
+        row = self.connection().execute(
+            'SELECT message_ids FROM threads WHERE user_email = ? AND id = ? AND history_id = ?', (user_email, thread_id, history_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_thread(self, user_email, thread_id, history_id, message_ids):
+        self.connection().execute(
+            'INSERT OR REPLACE INTO threads (user_email, id, history_id, message_ids) VALUES (?, ?, ?, ?)',
+            (user_email, thread_id, history_id, json.dumps(message_ids))
+        )
+
+    # Returns {msg_id: email_data} for the given messages that are cached, in one query
+    def get_many(self, user_email, msg_ids):
+        msg_ids = list(set(msg_ids))
+        if not msg_ids:
+            return {}
+        conn = self.connection()
+        placeholders = ','.join('?' * len(msg_ids))
+        rows = conn.execute(
+            f'SELECT id, data FROM messages WHERE user_email = ? AND id IN ({placeholders})', [user_email, *msg_ids]
+        ).fetchall()
+        metrics.inc(metrics.CACHE_LOOKUPS, 'message', 'hit', amount=len(rows))
+        metrics.inc(metrics.CACHE_LOOKUPS, 'message', 'miss', amount=len(msg_ids) - len(rows))
+        with self.lock:
+            self.hits += len(rows)
+            self.misses += len(msg_ids) - len(rows)
+        if rows:
+            conn.execute(
+                f'UPDATE messages SET accessed_at = ? WHERE user_email = ? AND id IN ({",".join("?" * len(rows))})',
+                [time.time(), user_email, *[msg_id for msg_id, _ in rows]]
+            )
+        return {msg_id: EmailRecord.from_dict(json.loads(data)) for msg_id, data in rows}
+
+    # Deletes the least recently used messages until the cache is back under 90% of max_bytes
+    def evict(self):
+        conn = self.connection()
+        total_size = conn.execute('SELECT COALESCE(SUM(size), 0) FROM messages').fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+        conn.execute(
+            'DELETE FROM messages WHERE rowid IN ('
+            ' SELECT rowid FROM (SELECT rowid, SUM(size) OVER (ORDER BY accessed_at DESC) AS kept FROM messages)'
+            ' WHERE kept > ?)',
+            (int(self.max_bytes * 0.9),)
+        )
+
+    def stats(self):
+        entries, size = self.connection().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM messages').fetchone()
+        return {'backend': 'sqlite', 'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
+
+    def clear(self):
+        conn = self.connection()
+        conn.execute('DELETE FROM messages')
+        conn.execute('DELETE FROM threads')
+
+# Creates the message cache selected by MESSAGE_CACHE_BACKEND
+def create_message_cache():
+    if MESSAGE_CACHE_BACKEND == 'sqlite':
+        return SQLiteMessageCache()
+    return MemoryMessageCache()
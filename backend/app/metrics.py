@@ -0,0 +1,184 @@
+import bisect
+import contextvars
+import threading
+import time
+from config import settings
+
+# Turns every counter and timer into a no-op when False
+METRICS_ENABLED = getattr(settings, 'METRICS_ENABLED', True)
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Metrics of the analysis run in progress in this context, if any. Tasks and worker threads
+# started by the run copy the context, so everything they record lands in the same RunMetrics.
+current_run = contextvars.ContextVar('current_run', default=None)
+
+def format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+# A monotonically increasing count per label combination
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.values = {}
+
+    def add(self, labels, amount):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name + format_labels(self.labelnames, labels), value
+
+# Counts of observations per bucket, plus their sum, per label combination
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}
+
+    def add(self, labels, value):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield self.name + '_bucket' + format_labels(self.labelnames, labels, [('le', bound)]), cumulative
+            yield self.name + '_sum' + format_labels(self.labelnames, labels), total
+            yield self.name + '_count' + format_labels(self.labelnames, labels), cumulative
+
+# Process-wide metrics, rendered in the Prometheus text format by /metrics
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def counter(self, name, description, labelnames=()):
+        metric = Counter(name, description, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, description, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, description, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for metric in self.metrics:
+                lines.append(f"# HELP {metric.name} {metric.description}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                lines.extend(f"{sample} {value}" for sample, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+GMAIL_REQUESTS = registry.counter('gmail_requests_total', 'Gmail API calls, counting each call in a batch', ('method', 'outcome'))
+GMAIL_REQUEST_SECONDS = registry.histogram('gmail_request_seconds', 'Gmail HTTP round trips; a batch is one round trip', ('method',))
+CACHE_LOOKUPS = registry.counter('cache_lookups_total', 'Message and classification cache lookups', ('cache', 'result'))
+BYTES_DECODED = registry.counter('email_body_bytes_decoded_total', 'Bytes of base64 email body data decoded')
+LLM_REQUESTS = registry.counter('llm_requests_total', 'Classification requests sent to OpenAI', ('outcome',))
+LLM_REQUEST_SECONDS = registry.histogram('llm_request_seconds', 'Latency of each OpenAI request attempt')
+LLM_TOKENS = registry.counter('llm_tokens_total', 'OpenAI tokens used', ('kind',))
+DB_WRITES = registry.counter('db_writes_total', 'Rows written to the database', ('table',))
+DB_WRITE_SECONDS = registry.histogram('db_write_seconds', 'Database write transactions', ('table',))
+PROMPT_TOKENS_SAVED = registry.counter(
+    'prompt_tokens_saved_total', 'Estimated prompt tokens of quoted, repeated and boilerplate text no longer sent with email bodies', ('reason',)
+)
+PRECLASSIFIER_DECISIONS = registry.counter(
+    'preclassifier_decisions_total', 'Companies screened locally before the LLM, by the rule or model that decided', ('decision', 'reason')
+)
+LLM_CALLS_SAVED = registry.counter('llm_calls_saved_total', 'OpenAI requests avoided by dropping companies locally')
+STAGE_SECONDS = registry.histogram('analysis_stage_seconds', 'Time spent in each analysis stage', ('stage',))
+JOBS_FINISHED = registry.counter('analysis_jobs_total', 'Analysis jobs finished', ('status',))
+
+# The same counters kept for one analysis run, summarized into the job's final result
+class RunMetrics:
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def add(self, metric, labels, value):
+        key = (metric.name, labels)
+        with self.lock:
+            if metric.kind == 'histogram':
+                count, total = self.values.get(key, (0, 0.0))
+                self.values[key] = (count + 1, total + value)
+            else:
+                self.values[key] = self.values.get(key, 0) + value
+
+    # Returns {metric: value} for unlabelled metrics and {metric: {label values: value}} otherwise,
+    # where histograms become {'count', 'seconds'}
+    def summary(self):
+        summary = {}
+        with self.lock:
+            items = sorted(self.values.items())
+        for (name, labels), value in items:
+            if isinstance(value, tuple):
+                value = {'count': value[0], 'seconds': round(value[1], 3)}
+            if labels:
+                summary.setdefault(name, {})['/'.join(labels)] = value
+            else:
+                summary[name] = value
+        return summary
+
+def record(metric, value, labels):
+    with registry.lock:
+        metric.add(labels, value)
+    run = current_run.get()
+    if run is not None:
+        run.add(metric, labels, value)
+
+# Adds amount to a counter; labels are given positionally, in the counter's label order
+def inc(metric, *labels, amount=1):
+    if METRICS_ENABLED:
+        record(metric, amount, labels)
+
+# Records one observation of a histogram
+def observe(metric, value, *labels):
+    if METRICS_ENABLED:
+        record(metric, value, labels)
+
+class Timer:
+    def __init__(self, metric, labels):
+        self.metric = metric
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.metric, time.perf_counter() - self.started, self.labels)
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+null_timer = NullTimer()
+
+# Context manager that observes the time spent inside it in a histogram
+def timer(metric, *labels):
+    return Timer(metric, labels) if METRICS_ENABLED else null_timer
@@ -0,0 +1,105 @@
+import base64
+import html
+import re
+from . import metrics
+
+HIDDEN_ELEMENTS = re.compile(r'<(script|style|head|title)\b.*?</\1\s*>', re.S | re.I)
+# An opening script/style/head tag whose end was cut off by a partial decode
+UNCLOSED_HIDDEN_ELEMENT = re.compile(r'<(?:script|style|head)\b.*\Z', re.S | re.I)
+COMMENTS = re.compile(r'<!--.*?(?:-->|\Z)', re.S)
+LINE_BREAKS = re.compile(r'<(?:br|/p|/div|/tr|/li|/h[1-6]|/blockquote|/table)\b[^>]*>', re.I)
+TAGS = re.compile(r'<[^>]*>')
+
+# Converts HTML to plain text with a few regex passes: drops head, script, style and comments,
+# turns block ends into line breaks, strips the remaining tags and unescapes entities.
+# A tag cut off at the end of partial input is dropped.
+def html_to_text(markup):
+    markup = COMMENTS.sub('', HIDDEN_ELEMENTS.sub('', markup))
+    markup = UNCLOSED_HIDDEN_ELEMENT.sub('', markup)
+    if markup.rfind('<') > markup.rfind('>'):
+        markup = markup[:markup.rfind('<')]
+    text = html.unescape(TAGS.sub('', LINE_BREAKS.sub('\n', markup)))
+    # Collapses runs of whitespace within lines and drops blank lines
+    return '\n'.join(filter(None, (' '.join(line.split()) for line in text.split('\n'))))
+
+# Decodes a Gmail base64url body to text. With max_chars, the data is decoded a chunk at a time,
+# doubling the decoded prefix until its (converted) text reaches max_chars or the data runs out.
+# Chunks are whole groups of 4 base64 characters, so each decodes on its own.
+def decode_body(body, max_chars=None, convert=None):
+    data = body.get('data')
+    if not data:
+        return ''
+    decoded, position = b'', 0
+    step = max_chars or len(data)
+    while True:
+        end = position + -(-step // 3) * 4
+        chunk = data[position:end]
+        position = end
+        chunk_bytes = base64.urlsafe_b64decode(chunk + '=' * (-len(chunk) % 4))
+        metrics.inc(metrics.BYTES_DECODED, amount=len(chunk_bytes))
+        decoded += chunk_bytes
+        text = decoded.decode('utf-8', errors='ignore')
+        if convert:
+            text = convert(text)
+        if position >= len(data) or len(text) >= max_chars:
+            return text[:max_chars] if max_chars else text
+        step = len(decoded)
+
+# True for parts that are files rather than message text
+def is_attachment(part):
+    if part.get('filename'):
+        return True
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-disposition':
+            return header['value'].lower().startswith('attachment')
+    return False
+
+# True if a message carries attachments. Metadata-format payloads have no parts, so there a
+# multipart/mixed type is taken as the sign of one.
+def has_attachment(payload):
+    if not payload.get('parts'):
+        return payload.get('mimeType', '').lower() == 'multipart/mixed' or is_attachment(payload)
+    stack = list(payload['parts'])
+    while stack:
+        part = stack.pop()
+        if part.get('parts'):
+            stack.extend(part['parts'])
+        elif is_attachment(part):
+            return True
+    return False
+
+# Yields the leaf parts of a MIME tree in document order, walking multiparts of any depth
+# with an explicit stack and skipping attachments
+def leaf_parts(payload):
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        children = part.get('parts')
+        if children:
+            stack.extend(reversed(children))
+        elif not is_attachment(part):
+            yield part
+
+# Returns the text of a message payload, at most max_chars of it: the text/plain parts joined
+# in order, or the text/html parts converted to text when there is no text/plain part
+def extract_text(payload, max_chars=None):
+    plain_parts, html_parts = [], []
+    for part in leaf_parts(payload):
+        mime_type = part.get('mimeType', '').lower()
+        if mime_type == 'text/plain':
+            plain_parts.append(part)
+        elif mime_type == 'text/html':
+            html_parts.append(part)
+
+    parts, convert = (plain_parts, None) if plain_parts else (html_parts, html_to_text)
+    texts, length = [], 0
+    for part in parts:
+        remaining = max_chars - length if max_chars else None
+        text = decode_body(part.get('body', {}), remaining, convert)
+        if text:
+            texts.append(text)
+            length += len(text) + 1
+        if max_chars and length >= max_chars:
+            break
+    text = '\n'.join(texts)
+    return text[:max_chars] if max_chars else text
@@ -1,4 +1,5 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text
 from .extensions import db
 from datetime import datetime
 from flask_login import UserMixin
@@ -10,6 +11,16 @@ class Company(db.Model):
     total_interactions = db.Column(db.Integer, default=0)
     company_contact = db.Column(db.String(255))
     analysis_date = db.Column(db.DateTime, default=datetime.utcnow)
+    last_interaction = db.Column(db.Text)
+    ai_explanation = db.Column(db.Text)
+
+    # Sorted listings page through these, with id breaking ties; analysis_date keys the listing ETag
+    __table_args__ = (
+        db.Index('ix_company_last_interaction_date', 'last_interaction_date', 'id'),
+        db.Index('ix_company_total_interactions', 'total_interactions', 'id'),
+        db.Index('ix_company_company_contact', 'company_contact'),
+        db.Index('ix_company_analysis_date', 'analysis_date'),
+    )
 
     def __repr__(self):
         return f'<Company {self.name}>'
@@ -17,8 +28,119 @@ class Company(db.Model):
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    last_analyzed_email_id = db.Column(db.String(255))
+    last_analyzed_email_id = db.Column(db.String(255))  # Superseded by last_history_id
+    last_history_id = db.Column(db.String(32))
     last_analysis_date = db.Column(db.DateTime)
 
     def __repr__(self):
-        return f'<User {self.email}>'
\ No newline at end of file
+        return f'<User {self.email}>'
+
+class AnalysisJob(db.Model):
+    id = db.Column(db.String(36), primary_key=True)
+    user_email = db.Column(db.String(120), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, completed, failed, cancelled
+    full_reanalysis = db.Column(db.Boolean, default=False)
+    progress = db.Column(db.Text)  # JSON ProgressTracker state
+    error = db.Column(db.Text)
+    num_startups = db.Column(db.Integer)
+    metrics = db.Column(db.Text)  # JSON summary of the run's metrics
+    worker_pid = db.Column(db.Integer)
+    cancel_requested = db.Column(db.Boolean, default=False)  # Set by whichever process handles the cancel request
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    # At most one queued or running job per mailbox, however many server processes there are
+    __table_args__ = (
+        db.Index(
+            'ux_analysis_job_active_mailbox', 'user_email', unique=True,
+            sqlite_where=text("status IN ('queued', 'running')"),
+            postgresql_where=text("status IN ('queued', 'running')")
+        ),
+    )
+
+    def __repr__(self):
+        return f'<AnalysisJob {self.id} {self.status}>'
+
+class ClassificationVerdict(db.Model):
+    # sha256 of the model, prompt version and company summary sent to OpenAI
+    fingerprint = db.Column(db.String(64), primary_key=True)
+    is_startup = db.Column(db.Boolean, nullable=False)
+    explanation = db.Column(db.Text)
+    model = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ClassificationVerdict {self.fingerprint[:12]}>'
+
+# A Gmail thread seen by an analysis of user_email's mailbox. Thread and message IDs are only
+# unique within one mailbox, so the mailbox is part of every key.
+class Thread(db.Model):
+    user_email = db.Column(db.String(120), primary_key=True)
+    id = db.Column(db.String(32), primary_key=True)
+    subject = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Thread {self.id}>'
+
+# One email of a stored thread. Messages are only ever inserted, so totals accumulate across runs.
+class Message(db.Model):
+    user_email = db.Column(db.String(120), primary_key=True)
+    id = db.Column(db.String(32), primary_key=True)
+    thread_id = db.Column(db.String(32), nullable=False)
+    date = db.Column(db.Date)
+    sender_email = db.Column(db.String(255))
+    recipient_email = db.Column(db.String(255))
+    subject = db.Column(db.Text)
+    has_attachment = db.Column(db.Boolean, default=False)
+
+    # Company aggregates read a thread's messages and dates from this index alone
+    __table_args__ = (
+        db.ForeignKeyConstraint(['user_email', 'thread_id'], ['thread.user_email', 'thread.id']),
+        db.Index('ix_message_thread', 'user_email', 'thread_id', 'date'),
+    )
+
+    def __repr__(self):
+        return f'<Message {self.id}>'
+
+# Which company each stored thread was matched to. Every matched company is mapped, whether or
+# not it was classified as a startup, so company_name is a registrable domain rather than a
+# key of Company.
+class CompanyThread(db.Model):
+    company_name = db.Column(db.String(255), primary_key=True)
+    user_email = db.Column(db.String(120), primary_key=True)
+    thread_id = db.Column(db.String(32), primary_key=True)
+
+    __table_args__ = (
+        db.ForeignKeyConstraint(['user_email', 'thread_id'], ['thread.user_email', 'thread.id']),
+        db.Index('ix_company_thread_thread', 'user_email', 'thread_id'),
+    )
+
+    def __repr__(self):
+        return f'<CompanyThread {self.company_name} {self.thread_id}>'
+
+# db.create_all() never alters existing tables, so add any columns that were
+# introduced after a table was first created
+def add_missing_columns():
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(db.engine.dialect)
+                db.session.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+    db.session.commit()
+
+# Likewise creates indexes that were added to a model after its table was created
+def add_missing_indexes():
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=db.engine)
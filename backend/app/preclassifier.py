@@ -0,0 +1,201 @@
+import functools
+import json
+import math
+import os
+import re
+import tempfile
+import zlib
+from config import settings
+from .classifier import CLASSIFIER_CHUNK_TOKENS, CLASSIFIER_MAX_COMPANIES_PER_CHUNK
+from .prompt_builder import thread_signal, SIGNAL_WORDS
+
+# Screen companies locally before the LLM and drop the ones that are clearly not startups
+PRECLASSIFIER_ENABLED = getattr(settings, 'PRECLASSIFIER_ENABLED', True)
+# Where the local model is kept between runs, next to app.db. None disables the model, leaving the rules.
+PRECLASSIFIER_MODEL_PATH = getattr(
+    settings, 'PRECLASSIFIER_MODEL_PATH', os.path.join(os.path.abspath(os.path.dirname(__file__)), 'preclassifier.json')
+)
+# Companies the model gives a lower startup probability than this are dropped
+PRECLASSIFIER_DROP_BELOW = getattr(settings, 'PRECLASSIFIER_DROP_BELOW', 0.05)
+# Verdicts the model must have learned from before its scores are trusted
+PRECLASSIFIER_MIN_EXAMPLES = getattr(settings, 'PRECLASSIFIER_MIN_EXAMPLES', 500)
+# Size of the hashed feature space
+MODEL_DIMENSIONS = 2 ** 18
+MODEL_LEARNING_RATE = 0.5
+
+# Google Calendar invitation and response subjects
+CALENDAR_SUBJECT = re.compile(
+    r'^\s*(?:(?:updated )?invitation|accepted|declined|tentatively accepted|(?:canceled|cancelled)(?: event)?|'
+    r'event (?:canceled|cancelled))\b',
+    re.I
+)
+# Local parts of addresses that send automated mail rather than people
+AUTOMATED_SENDER = re.compile(
+    r'^(?:no-?reply|do-?not-?reply|notifications?|newsletters?|news|billing|receipts?|invoices?|mailer-daemon|'
+    r'digest|marketing|updates|alerts?)(?:[+._-]|$)',
+    re.I
+)
+# Subjects of receipts, account mail and marketing from vendors
+TRANSACTIONAL_SUBJECT = re.compile(
+    r'\b(?:receipt|invoice|your order|order confirmation|payment (?:received|confirmation|failed)|subscription|'
+    r'renewal|your trial|trial (?:ends|ending|expired)|newsletter|webinar|digest|password reset|verify your|'
+    r'confirm your|welcome to)\b',
+    re.I
+)
+UNSUBSCRIBE = re.compile(r'\bunsubscribe\b', re.I)
+WORDS = re.compile(r"[a-z0-9$%]+(?:['.-][a-z0-9]+)*")
+
+# Decisions that drop a company, in the order the rules are checked
+DROP_REASONS = ('calendar_invite', 'automated_sender', 'transactional', 'bulk_mail', 'model')
+
+# Index of a feature in the hashed feature space. crc32 is used because Python's hash() of a
+# string changes with every process.
+def feature_index(feature):
+    return zlib.crc32(feature.encode('utf-8')) % MODEL_DIMENSIONS
+
+# Hashed word unigrams and bigrams of a text plus the given tags
+def hashed_features(text, tags=()):
+    words = WORDS.findall(text.lower())
+    features = [f'w:{word}' for word in words]
+    features += [f'b:{first} {second}' for first, second in zip(words, words[1:])]
+    return sorted({feature_index(feature) for feature in list(tags) + features})
+
+# Logistic regression over hashed features, trained online with SGD on the LLM's verdicts.
+# Inputs are binary and scaled to unit length, so long summaries don't dominate.
+class HashedModel:
+    def __init__(self, weights=None, bias=0.0, examples=0):
+        self.weights = weights or {}
+        self.bias = bias
+        self.examples = examples
+        self.changed = False
+
+    def probability(self, features):
+        if not features:
+            return 1 / (1 + math.exp(-self.bias))
+        scale = 1 / math.sqrt(len(features))
+        score = self.bias + scale * sum(self.weights.get(index, 0.0) for index in features)
+        return 1 / (1 + math.exp(-max(min(score, 30), -30)))
+
+    def learn(self, features, is_startup, rate=MODEL_LEARNING_RATE):
+        error = self.probability(features) - (1.0 if is_startup else 0.0)
+        if features:
+            step = rate * error / math.sqrt(len(features))
+            for index in features:
+                self.weights[index] = self.weights.get(index, 0.0) - step
+        self.bias -= rate * error
+        self.examples += 1
+        self.changed = True
+
+    def trained(self):
+        return self.examples >= PRECLASSIFIER_MIN_EXAMPLES
+
+    def to_json(self):
+        return json.dumps({
+            'dimensions': MODEL_DIMENSIONS,
+            'bias': self.bias,
+            'examples': self.examples,
+            'weights': {str(index): round(weight, 6) for index, weight in self.weights.items() if abs(weight) >= 1e-6},
+        })
+
+    # Loads a saved model, or starts an empty one if there is none or it was saved with other dimensions
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cls()
+        if data.get('dimensions') != MODEL_DIMENSIONS:
+            return cls()
+        return cls({int(index): weight for index, weight in data['weights'].items()}, data['bias'], data['examples'])
+
+# The shared model, loaded on first use, or None when PRECLASSIFIER_MODEL_PATH is None
+@functools.lru_cache(maxsize=None)
+def local_model():
+    return HashedModel.load(PRECLASSIFIER_MODEL_PATH) if PRECLASSIFIER_MODEL_PATH else None
+
+# Writes the model's changes since the last save, replacing the file atomically. Each save writes
+# a temporary file of its own, so processes saving at once never mix their files; the last one
+# to save wins, and what the others learned since they loaded the model is lost.
+def save_model(model):
+    if model is None or not model.changed:
+        return
+    data = model.to_json()
+    model.changed = False
+    directory, name = os.path.split(os.path.abspath(PRECLASSIFIER_MODEL_PATH))
+    with tempfile.NamedTemporaryFile('w', dir=directory, prefix=f'{name}.', suffix='.tmp', delete=False) as f:
+        f.write(data)
+    os.replace(f.name, PRECLASSIFIER_MODEL_PATH)
+
+# What the local screen decided about one company
+class Screening:
+    def __init__(self, reason, features, probability=None):
+        self.reason = reason
+        self.features = features
+        self.probability = probability
+
+    @property
+    def drop(self):
+        return self.reason in DROP_REASONS
+
+def is_company_sender(email, company_name):
+    return email.sender_domain == company_name or email.sender_domain.endswith('.' + company_name)
+
+# Scores a company from its candidate threads, the emails planned for its summary and the summary.
+# Companies with an attachment or a pitch or fundraising keyword are always sent on; otherwise
+# calendar-only, automated, receipt and bulk mail is dropped by rule, and the rest by the model
+# once it is trained. Only the planned emails' bodies are read, as the others may or may not have
+# been downloaded by an earlier run.
+def screen_company(company_name, threads, plan, summary, model=None):
+    emails = [email for thread in threads for email in thread]
+    company_emails = [email for email in emails if is_company_sender(email, company_name)]
+    bodies = [email.body for thread in plan for email in thread if email.body]
+    tags = [f'tag:threads={min(len(threads), 6)}']
+    tags += [f'from:{email.sender_email.partition("@")[0].lower()}' for email in company_emails]
+
+    signal = sum(thread_signal(thread) for thread in threads) + sum(bool(SIGNAL_WORDS.search(body)) for body in bodies)
+    rules = [
+        ('calendar_invite', all(len(thread) == 1 for thread in threads) and all(CALENDAR_SUBJECT.search(email.subject) for email in emails)),
+        ('automated_sender', bool(company_emails) and all(AUTOMATED_SENDER.search(email.sender_email) for email in company_emails)),
+        ('transactional', all(TRANSACTIONAL_SUBJECT.search(email.subject) for email in emails)),
+        ('bulk_mail', bool(bodies) and all(UNSUBSCRIBE.search(body) for body in bodies)),
+    ]
+    tags += [f'rule:{reason}' for reason, matched in rules if matched]
+    if signal:
+        tags.append('rule:signal')
+    features = hashed_features(summary, tags)
+
+    if not emails:
+        return Screening('uncertain', features)
+    if signal:
+        return Screening('signal', features)
+    for reason, matched in rules:
+        if matched:
+            return Screening(reason, features)
+    if model is not None and model.trained():
+        probability = model.probability(features)
+        if probability < PRECLASSIFIER_DROP_BELOW:
+            return Screening('model', features, probability)
+        return Screening('uncertain', features, probability)
+    return Screening('uncertain', features)
+
+# Counts the OpenAI requests dropped companies would have needed, packing their summaries into
+# chunks the way classify_companies does
+class CallSavings:
+    def __init__(self, max_tokens=CLASSIFIER_CHUNK_TOKENS, max_companies=CLASSIFIER_MAX_COMPANIES_PER_CHUNK):
+        self.max_tokens = max_tokens
+        self.max_companies = max_companies
+        self.full_chunks = 0
+        self.chunk_tokens = 0
+        self.chunk_companies = 0
+
+    def add(self, tokens):
+        if self.chunk_companies and (self.chunk_tokens + tokens > self.max_tokens or self.chunk_companies >= self.max_companies):
+            self.full_chunks += 1
+            self.chunk_tokens, self.chunk_companies = 0, 0
+        self.chunk_tokens += tokens
+        self.chunk_companies += 1
+
+    @property
+    def calls(self):
+        return self.full_chunks + bool(self.chunk_companies)
@@ -0,0 +1,94 @@
+import re
+from config import settings
+from .body_cleaner import dedupe_thread_bodies
+from .classifier import count_tokens, truncate_to_tokens
+from .email_record import BODY_CHARS
+from . import metrics
+
+# Tokens of email threads one company's summary may use. Busy companies fill it with more
+# threads and emails; quiet ones use less, so more of them fit in each request.
+PROMPT_COMPANY_TOKENS = getattr(settings, 'PROMPT_COMPANY_TOKENS', 600)
+# Threads kept per company as candidates for its summary: its first ones, since the company is
+# classified as soon as it has this many
+PROMPT_CANDIDATE_THREADS = getattr(settings, 'PROMPT_CANDIDATE_THREADS', 6)
+# Room an email needs for its body to be worth including
+MIN_BODY_TOKENS = 16
+# Tokens planned for every email's body, about what BODY_CHARS characters take. Downloaded or not,
+# each body is planned at this size, so the emails picked depend only on headers.
+PLANNED_BODY_TOKENS = BODY_CHARS // 4
+
+# Subject and body words that point to a pitch or a fundraise
+SIGNAL_WORDS = re.compile(
+    r'\b(?:deck|pitch\w*|rais\w*|fundrais\w*|funding|round|pre-seed|seed|series [a-d]|safe|term sheet|valuation|'
+    r'investors?|investment|traction|revenue|mrr|arr|financials|data room|cap table)\b',
+    re.I
+)
+
+# Number of signals in a thread's headers: emails with attachments and subjects mentioning a pitch
+# or fundraise. Bodies are left out, since most are only downloaded once the threads are ranked.
+def thread_signal(thread):
+    signal = 0
+    for email in thread:
+        signal += email.has_attachment
+        signal += bool(SIGNAL_WORDS.search(email.subject))
+    return signal
+
+# Threads with more signals come first, then the most recent
+def thread_rank(thread):
+    return thread_signal(thread), max(email.date for email in thread)
+
+def subject_line(email):
+    return f"Subject: {email.subject or 'No subject'}\n"
+
+# Picks the emails that go into a company's summary: threads in rank order, each given an even
+# share of what is left of the budget, with unused tokens passed on to the next thread. Emails
+# keep their order within a thread. The plan is made from headers alone, so the same threads
+# give the same summary whether their bodies come from Gmail or from the message cache, and
+# its cached verdict is found again.
+def plan_summary(threads, budget=PROMPT_COMPANY_TOKENS):
+    ranked = sorted(threads, key=thread_rank, reverse=True)
+    plan = []
+    remaining = budget
+    for i, thread in enumerate(ranked):
+        thread_budget = remaining // (len(ranked) - i)
+        used = count_tokens("Thread:\n")
+        emails = []
+        for email in thread:
+            fixed = count_tokens(subject_line(email)) + count_tokens("Body: \n\n")
+            available = thread_budget - used - fixed
+            if available < MIN_BODY_TOKENS:
+                break
+            emails.append(email)
+            used += fixed + min(PLANNED_BODY_TOKENS, available)
+        if emails:
+            plan.append(emails)
+            remaining -= used
+    return plan
+
+# Renders a planned summary of a company with the given number of emails, cutting bodies so the
+# threads stay within budget tokens
+def build_company_summary(name, plan, interactions, budget=PROMPT_COMPANY_TOKENS):
+    summary = f"Company: {name}\n"
+    summary += f"Interactions: {interactions}\n"
+    summary += "Email Threads:\n"
+    remaining = budget
+    for i, thread in enumerate(plan):
+        thread_budget = remaining // (len(plan) - i)
+        text = "Thread:\n"
+        used = count_tokens(text)
+        # Text repeated from an earlier email in the thread is sent once
+        bodies, repeated = dedupe_thread_bodies([email.body for email in thread])
+        if repeated and metrics.METRICS_ENABLED:
+            metrics.inc(metrics.PROMPT_TOKENS_SAVED, 'duplicate', amount=count_tokens(repeated))
+        for email, body in zip(thread, bodies):
+            line = subject_line(email)
+            fixed = count_tokens(line) + count_tokens("Body: \n\n")
+            available = thread_budget - used - fixed
+            if available < MIN_BODY_TOKENS:
+                break
+            body = truncate_to_tokens(body, available) if body else ''
+            text += line + (f"Body: {body}\n\n" if body else "Body: No body content\n\n")
+            used += fixed + count_tokens(body)
+        summary += text
+        remaining -= used
+    return summary
@@ -1,14 +1,18 @@
 import os
-import threading
-from flask import current_app, Blueprint, jsonify, request, url_for, session, redirect
+import io
+import csv
+import json
+from flask import current_app, Blueprint, jsonify, request, url_for, session, redirect, Response, stream_with_context
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
 from google.auth.transport import requests as google_auth_requests
 from google.oauth2 import id_token
-from .email_analyzer import process_emails
-import asyncio
-from .email_analyzer import process_emails, progress_tracker
-from .models import Company, User
+from .jobs import job_manager
+from . import metrics
+from .models import AnalysisJob, Company, User
+from .company_listing import list_companies, filter_companies, companies_etag
+from .search import (search_messages, search_available, encode_search_cursor, decode_search_cursor, SEARCH_PAGE_SIZE,
+                     SEARCH_MAX_PAGE_SIZE)
 from .extensions import db
 from sqlalchemy import text
 from flask_login import login_required, current_user, login_user, AnonymousUserMixin
@@ -115,33 +119,11 @@ def create_table():
         current_app.logger.error(f"Error creating table: {str(e)}")
         return jsonify({"error": f"Failed to create table: {str(e)}"}), 500
     
+# Older GET form of POST /start_analysis: queues a job rather than running the analysis in the
+# request, so it shares the mailbox's active job and can be followed and cancelled like any other
 @bp.route('/analyze_emails', methods=['GET'])
-async def analyze_emails():
-    if 'credentials' not in session:
-        return jsonify({"error": "Not authenticated"}), 401
-
-    credentials = Credentials(**session['credentials'])
-    user_email = session.get('user_email')
-
-    if not user_email:
-        return jsonify({"error": "User email not found"}), 400
-
-    try:
-        num_startups, csv_path, error, _ = await process_emails(credentials, user_email)
-        if error:
-            return jsonify({"error": "Email analysis failed", "details": error}), 500
-        if num_startups is None or csv_path is None:
-            return jsonify({"error": "Email analysis returned unexpected results"}), 500
-        return jsonify({
-            "num_startups": num_startups,
-            "csv_path": csv_path,
-            "message": f"Analysis complete. Found {num_startups} startup-related emails."
-        })
-    except Exception as e:
-        return jsonify({
-            "error": "Analysis failed",
-            "message": str(e)
-        }), 500
+def analyze_emails():
+    return start_analysis()
     
 def credentials_to_dict(credentials):
     return {'token': credentials.token,
@@ -157,6 +139,12 @@ def catch_all(path):
     current_app.logger.warning(f"Accessed undefined route: {path}")
     return jsonify({"error": "Route not found"}), 404
 
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not metrics.METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 @bp.route('/db_test', methods=['GET'])
 def db_test():
     try:
@@ -168,10 +156,40 @@ def db_test():
         current_app.logger.error(f"Database connection error: {str(e)}")
         return jsonify({"error": f"Database connection failed: {str(e)}"}), 500
 
+# Returns a 304 when the client's copy of a listing is current, or else None and the listing's ETag
+def listing_not_modified(endpoint):
+    etag = companies_etag(endpoint, request.args)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response, etag
+    return None, etag
+
+# Sends a page of a listing with its ETag and, unless it is the last page, the next page's
+# cursor in X-Next-Cursor and a Link header
+def listing_response(rows, next_cursor, etag=None):
+    response = jsonify(rows)
+    if etag:
+        response.set_etag(etag, weak=True)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+        next_url = url_for(request.endpoint, _external=True, **{**request.args.to_dict(), 'cursor': next_cursor})
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
+
+# Lists companies a page at a time. Optional arguments: sort (name, last_interaction_date or
+# total_interactions), order (asc or desc), limit, cursor (from X-Next-Cursor), and the
+# start_date, end_date, min_interactions, max_interactions and contact filters.
 @bp.route('/companies', methods=['GET'])
 def get_companies():
     try:
-        companies = Company.query.all()
+        not_modified, etag = listing_not_modified('companies')
+        if not_modified:
+            return not_modified
+        try:
+            companies, next_cursor = list_companies(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         company_list = [{
             'name': c.name,
             'first_interaction_date': c.first_interaction_date.strftime('%Y-%m-%d'),
@@ -180,11 +198,101 @@ def get_companies():
             'company_contact': c.company_contact
         } for c in companies]
         current_app.logger.info(f"Retrieved {len(company_list)} companies from the database")
-        return jsonify(company_list)
+        return listing_response(company_list, next_cursor, etag)
     except Exception as e:
         current_app.logger.error(f"Error in get_companies route: {str(e)}")
         return jsonify({"error": "An error occurred while retrieving companies"}), 500
 
+EXPORT_COLUMNS = ['name', 'first_interaction_date', 'last_interaction_date', 'total_interactions',
+                  'company_contact', 'analysis_date', 'last_interaction', 'ai_explanation']
+
+# Converts a Company row into a dict of export values
+def company_export_row(company):
+    return {
+        'name': company.name,
+        'first_interaction_date': company.first_interaction_date.strftime('%Y-%m-%d'),
+        'last_interaction_date': company.last_interaction_date.strftime('%Y-%m-%d'),
+        'total_interactions': company.total_interactions,
+        'company_contact': company.company_contact,
+        'analysis_date': company.analysis_date.strftime('%Y-%m-%d') if company.analysis_date else None,
+        'last_interaction': company.last_interaction,
+        'ai_explanation': company.ai_explanation
+    }
+
+# Streams the signed-in user's companies report as CSV or NDJSON straight from the database, one
+# row at a time. Takes the same filters as /companies.
+@bp.route('/companies/export', methods=['GET'])
+def export_companies():
+    user_email = session.get('user_email')
+    if 'credentials' not in session or not user_email:
+        return jsonify({"error": "Not authenticated"}), 401
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'ndjson'):
+        return jsonify({"error": "format must be csv or ndjson"}), 400
+
+    try:
+        query = filter_companies(Company.query.filter(Company.company_contact == user_email), request.args)
+    except ValueError:
+        return jsonify({"error": "Dates must be YYYY-MM-DD and min_interactions and max_interactions integers"}), 400
+    companies = query.order_by(Company.name).yield_per(500)
+
+    def generate_csv_rows():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS)
+        writer.writeheader()
+        for company in companies:
+            writer.writerow(company_export_row(company))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    def generate_ndjson_rows():
+        for company in companies:
+            yield json.dumps(company_export_row(company)) + '\n'
+
+    if export_format == 'csv':
+        rows, mimetype = generate_csv_rows(), 'text/csv'
+    else:
+        rows, mimetype = generate_ndjson_rows(), 'application/x-ndjson'
+    current_app.logger.info(f"Streaming company export as {export_format}")
+    return Response(
+        stream_with_context(rows),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=companies.{export_format}'}
+    )
+
+# Searches the subject, sender and body of the signed-in user's analyzed emails, best matches
+# first. Arguments: q (words, "a phrase", OR, NOT or prefix*), and optional company, limit and
+# cursor (from X-Next-Cursor). Each result has the company, sender, date, subject and a body
+# snippet, with matches wrapped in <mark> tags.
+@bp.route('/search', methods=['GET'])
+def search():
+    user_email = session.get('user_email')
+    if 'credentials' not in session or not user_email:
+        return jsonify({"error": "Not authenticated"}), 401
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "q is required"}), 400
+    if not search_available():
+        return jsonify({"error": "Search needs SQLite with FTS5 and SEARCH_INDEX_ENABLED"}), 501
+    try:
+        limit = int(request.args.get('limit', SEARCH_PAGE_SIZE))
+        offset = decode_search_cursor(request.args['cursor']) if request.args.get('cursor') else 0
+        if limit < 1:
+            raise ValueError("limit must be positive")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    limit = min(limit, SEARCH_MAX_PAGE_SIZE)
+    try:
+        results = search_messages(user_email, query, request.args.get('company'), limit + 1, offset)
+    except Exception as e:
+        current_app.logger.error(f"Error in search route: {str(e)}")
+        return jsonify({"error": "An error occurred while searching"}), 500
+    next_cursor = encode_search_cursor(offset + limit) if len(results) > limit else None
+    current_app.logger.info(f"Search for {query!r} returned {len(results[:limit])} results")
+    return listing_response(results[:limit], next_cursor)
+
 @bp.route('/check_auth', methods=['GET'])
 def check_auth():
     is_authenticated = 'credentials' in session
@@ -221,9 +329,8 @@ def check_auth():
         "email": email
     })
 
-# Global dictionary to store analysis tasks
-analysis_tasks = {}
-
+# Queues an analysis of the signed-in user's mailbox and returns its job ID. A mailbox has at most
+# one active job, so a repeated request returns the job that is already queued or running.
 @bp.route('/start_analysis', methods=['POST'])
 def start_analysis():
     if 'credentials' not in session:
@@ -234,70 +341,83 @@ def start_analysis():
 
     if not user_email:
         return jsonify({"error": "User email not found"}), 400
-    
-    def run_analysis_in_thread(app, credentials, user_email):
-        with app.app_context():
-            global progress_tracker
-            current_app.logger.info("Analysis thread started")
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            try:
-                num_startups, csv_path, error, _ = loop.run_until_complete(process_emails(credentials, user_email))
-                if error:
-                    progress_tracker.update(status="Error", current_step=str(error))
-                else:
-                    progress_tracker.update(status="Completed", num_startups=num_startups)
-                current_app.logger.info(f"Analysis completed. num_startups: {num_startups}, csv_path: {csv_path}, error: {error}")
-            except Exception as e:
-                current_app.logger.error(f"Error in analysis thread: {str(e)}")
-                progress_tracker.update(status="Error", current_step=str(e))
-            finally:
-                loop.close()
-            current_app.logger.info("Analysis thread finished")
 
+    full_reanalysis = bool((request.get_json(silent=True) or {}).get('full_reanalysis', False))
     app = current_app._get_current_object()
-    threading.Thread(target=run_analysis_in_thread, args=(app, credentials, user_email)).start()
-    current_app.logger.info("Analysis thread created and started")
-    
-    return jsonify({"message": "Analysis started"}), 202
-
-def run_analysis(app, credentials, user_email):
-    with app.app_context():
-        current_app.logger.info("Starting analysis...")
-        try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            current_app.logger.info("Created new event loop")
-            num_startups, csv_path, error, _ = loop.run_until_complete(process_emails(credentials, user_email))
-            current_app.logger.info(f"Analysis completed. num_startups: {num_startups}, csv_path: {csv_path}, error: {error}")
-            if error:
-                current_app.logger.error(f"Error in email analysis: {error}")
-            else:
-                current_app.logger.info(f"Analysis complete. Found {num_startups} startup-related emails.")
-        except Exception as e:
-            current_app.logger.error(f"Unexpected error in email analysis: {str(e)}")
-        finally:
-            loop.close()
-            current_app.logger.info("Event loop closed")
-
-
-@bp.route('/analysis_progress/<task_id>', methods=['GET'])
-def analysis_progress(task_id):
-    task = analysis_tasks.get(task_id)
-    if not task:
-        return jsonify({"error": "Task not found"}), 404
-    return jsonify(task)
-
+    job_id, created = job_manager.submit(app, credentials, user_email, full_reanalysis)
+    message = "Analysis started" if created else "Analysis already running"
+    return jsonify({"message": message, "job_id": job_id}), 202
+
+# Returns the job if it exists and belongs to the signed-in user
+def get_user_job(job_id):
+    job = db.session.get(AnalysisJob, job_id)
+    if job is None or job.user_email != session.get('user_email'):
+        return None
+    return job
+
+@bp.route('/analysis_progress/<job_id>', methods=['GET'])
+def analysis_progress(job_id):
+    if get_user_job(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_manager.get_state(job_id))
+
+# Progress of ?job_id=, or of the signed-in user's most recent job when no ID is given
 @bp.route('/check_progress', methods=['GET'])
 def check_progress():
-    global progress_tracker
-    current_app.logger.info(f"Check progress called. Current progress: {progress_tracker.get_state()}")
-    return jsonify(progress_tracker.get_state())
-
+    job_id = request.args.get('job_id') or job_manager.latest_job_id(session.get('user_email'))
+    if not job_id or get_user_job(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+    state = job_manager.get_state(job_id)
+    current_app.logger.debug(f"Check progress called for job {job_id}: {state['status']}")
+    return jsonify(state)
+
+# Server-sent events stream of a job's progress. The first 'progress' event carries the full state
+# and later ones only the fields that changed, sent at most once per PROGRESS_STREAM_INTERVAL.
+# A 'done' event with the final state closes the stream.
+@bp.route('/progress_stream/<job_id>', methods=['GET'])
+def progress_stream(job_id):
+    if get_user_job(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def generate_events():
+        sent = {}
+        for state in job_manager.watch(job_id):
+            if state is None:
+                yield ': keep-alive\n\n'
+                continue
+            delta = {key: value for key, value in state.items() if sent.get(key, object()) != value}
+            sent.update(delta)
+            if state['job_status'] not in ('queued', 'running'):
+                yield f'event: done\ndata: {json.dumps(state)}\n\n'
+                return
+            if delta:
+                yield f'event: progress\ndata: {json.dumps(delta)}\n\n'
+
+    return Response(
+        stream_with_context(generate_events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@bp.route('/cancel_analysis/<job_id>', methods=['POST'])
+def cancel_analysis(job_id):
+    if get_user_job(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+    if not job_manager.cancel(job_id):
+        return jsonify({"error": "Job is not running"}), 409
+    return jsonify({"message": "Cancellation requested", "job_id": job_id}), 202
+
+# Lists startups a page at a time, with the same arguments as /companies
 @bp.route('/startups', methods=['GET'])
 def get_startups():
     try:
-        startups = Company.query.all()
+        not_modified, etag = listing_not_modified('startups')
+        if not_modified:
+            return not_modified
+        try:
+            startups, next_cursor = list_companies(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         startup_list = [{
             'id': s.id,
             'name': s.name,
@@ -308,7 +428,7 @@ def get_startups():
             'analysis_date': s.analysis_date.strftime('%Y-%m-%d')  # Format changed here
         } for s in startups]
         current_app.logger.info(f"Retrieved {len(startup_list)} startups from the database")
-        return jsonify(startup_list)
+        return listing_response(startup_list, next_cursor, etag)
     except Exception as e:
         current_app.logger.error(f"Error in get_startups route: {str(e)}")
         return jsonify({"error": "An error occurred while retrieving startups"}), 500
@@ -0,0 +1,47 @@
+import asyncio
+import threading
+import uuid
+from .extensions import task_scope
+
+# One asyncio event loop per process, running on a daemon thread and started on first use.
+# Analyses run on it as tasks, so the clients they share (the OpenAI connection pool, Gmail HTTP
+# connections) stay bound to a single loop and are reused across runs instead of rebuilt each time.
+class AsyncRuntime:
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return self.loop
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name='async-runtime', daemon=True)
+            self.thread.start()
+            return self.loop
+
+    # Schedules a coroutine on the runtime inside its own app context and database session scope.
+    # Returns a concurrent.futures.Future for its result.
+    def submit(self, app, coro):
+        loop = self.start()
+        return asyncio.run_coroutine_threadsafe(run_in_app_context(app, coro), loop)
+
+    # Runs a coroutine on the runtime and blocks the calling thread until it finishes
+    def run(self, app, coro, timeout=None):
+        return self.submit(app, coro).result(timeout)
+
+    def stop(self):
+        with self.lock:
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.thread.join()
+                self.loop.close()
+                self.loop = self.thread = None
+
+async def run_in_app_context(app, coro):
+    task_scope.set(uuid.uuid4().hex)
+    with app.app_context():
+        return await coro
+
+runtime = AsyncRuntime()
@@ -0,0 +1,129 @@
+import base64
+import hashlib
+import html
+import json
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import OperationalError
+from config import settings
+from .extensions import db
+from . import metrics
+
+# Index the subject, sender and cleaned body of stored messages for /search. Needs SQLite with FTS5.
+SEARCH_INDEX_ENABLED = getattr(settings, 'SEARCH_INDEX_ENABLED', True)
+# Results per page of /search unless limit asks for fewer or more
+SEARCH_PAGE_SIZE = getattr(settings, 'SEARCH_PAGE_SIZE', 20)
+SEARCH_MAX_PAGE_SIZE = 100
+# Words around each match in a result's snippet
+SNIPPET_TOKENS = 16
+
+# Markers put around matches by SQLite, swapped for <mark> tags once the text has been escaped
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+# Porter stemming lets "raising" find "raise" and "raised"
+CREATE_SEARCH_TABLE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5("
+    "subject, sender, body, company_name UNINDEXED, user_email UNINDEXED, message_id UNINDEXED, "
+    "tokenize='porter unicode61')"
+)
+
+def search_available():
+    return SEARCH_INDEX_ENABLED and db.engine.dialect.name == 'sqlite'
+
+# Creates the search index if the database supports it
+def create_search_index():
+    if search_available():
+        db.session.execute(text(CREATE_SEARCH_TABLE))
+        db.session.commit()
+
+# Stable rowid of a message in the index, so indexing a message again replaces its entry
+def search_rowid(user_email, message_id):
+    return int(hashlib.sha1(f"{user_email}\0{message_id}".encode('utf-8')).hexdigest()[:15], 16)
+
+# Indexes (user_email, company_name, email) tuples in one statement. Emails with a body replace
+# their entry; emails whose body hasn't been downloaded are only added if they aren't indexed
+# yet, so they never blank a body indexed earlier.
+def index_messages(entries):
+    if not entries or not search_available():
+        return
+    rows = {}
+    for user_email, company_name, email in entries:
+        rowid = search_rowid(user_email, email.id)
+        rows[rowid] = {
+            'rowid': rowid,
+            'subject': email.subject,
+            'sender': email.sender_email,
+            'body': email.body or '',
+            'company_name': company_name,
+            'user_email': user_email,
+            'message_id': email.id,
+        }
+    bodiless = [rowid for rowid, row in rows.items() if not row['body']]
+    for i in range(0, len(bodiless), 500):
+        indexed = db.session.execute(
+            text("SELECT rowid FROM message_search WHERE rowid IN :rowids").bindparams(bindparam('rowids', expanding=True)),
+            {'rowids': bodiless[i:i + 500]}
+        )
+        for (rowid,) in indexed:
+            del rows[rowid]
+    if not rows:
+        return
+    db.session.execute(text(
+        "INSERT OR REPLACE INTO message_search (rowid, subject, sender, body, company_name, user_email, message_id) "
+        "VALUES (:rowid, :subject, :sender, :body, :company_name, :user_email, :message_id)"
+    ), list(rows.values()))
+    metrics.inc(metrics.DB_WRITES, 'message_search', amount=len(rows))
+
+# Escapes indexed text for HTML and turns the match markers into <mark> tags
+def highlighted(value):
+    escaped = html.escape(value or '')
+    return escaped.replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+# Quotes every word of a query so characters with a meaning in FTS5 syntax are matched literally
+def literal_query(query):
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+# Search results are ranked, so a cursor is the offset of the next page
+def encode_search_cursor(offset):
+    return base64.urlsafe_b64encode(json.dumps(['search', offset]).encode('utf-8')).decode('ascii').rstrip('=')
+
+# Returns the offset a cursor points at. Raises ValueError if it is malformed.
+def decode_search_cursor(cursor):
+    try:
+        kind, offset = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if kind != 'search' or not isinstance(offset, int) or offset < 0:
+        raise ValueError("Invalid cursor")
+    return offset
+
+# Returns up to limit matches of query in user_email's mailbox from offset on, best first, as
+# dicts with the message's company, sender, date and subject, and a snippet of its body with the
+# matches in <mark> tags.
+# query may use FTS5 syntax ("series a" for a phrase, OR, NOT, prefix*); if it doesn't parse,
+# its words are searched for literally.
+def search_messages(user_email, query, company_name=None, limit=SEARCH_PAGE_SIZE, offset=0):
+    sql = text(
+        "SELECT message_search.message_id, company_name, sender, m.date, "
+        f"highlight(message_search, 0, '{MATCH_START}', '{MATCH_END}') AS subject, "
+        f"snippet(message_search, 2, '{MATCH_START}', '{MATCH_END}', '…', {SNIPPET_TOKENS}) AS snippet, "
+        "rank "
+        "FROM message_search LEFT JOIN message m ON m.user_email = message_search.user_email AND m.id = message_search.message_id "
+        "WHERE message_search MATCH :query AND message_search.user_email = :user_email"
+        + (" AND company_name = :company_name" if company_name else "")
+        + " ORDER BY rank LIMIT :limit OFFSET :offset"
+    )
+    parameters = {'query': query, 'user_email': user_email, 'company_name': company_name, 'limit': limit, 'offset': offset}
+    try:
+        rows = db.session.execute(sql, parameters).fetchall()
+    except OperationalError:
+        db.session.rollback()
+        rows = db.session.execute(sql, dict(parameters, query=literal_query(query))).fetchall()
+    return [{
+        'message_id': row.message_id,
+        'company': row.company_name,
+        'sender': row.sender,
+        'date': str(row.date) if row.date else None,
+        'subject': highlighted(row.subject),
+        'snippet': highlighted(row.snippet),
+        'rank': row.rank,
+    } for row in rows]
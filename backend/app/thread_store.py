@@ -0,0 +1,110 @@
+from datetime import datetime
+from sqlalchemy import and_, func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from config import settings
+from .models import Thread, Message, CompanyThread
+from .search import index_messages
+from .extensions import db
+from . import metrics
+
+# Messages buffered by a run before they and their threads are written in one transaction
+THREAD_STORE_FLUSH_ROWS = getattr(settings, 'THREAD_STORE_FLUSH_ROWS', 500)
+
+# Returns an email's date as a date, or None if its Date header couldn't be parsed
+def message_date(email):
+    try:
+        return datetime.strptime(email.date, '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+# Inserts the rows whose primary key isn't stored yet and returns how many were new
+def insert_new(model, rows):
+    if not rows:
+        return 0
+    dialect = db.engine.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        # One INSERT ... ON CONFLICT DO NOTHING statement, executed for all rows at once
+        statement = (sqlite_insert if dialect == 'sqlite' else postgresql_insert)(model.__table__).on_conflict_do_nothing()
+        return db.session.execute(statement, rows).rowcount
+    inserted = 0
+    for row in rows:
+        key = tuple(row[column.name] for column in model.__table__.primary_key.columns)
+        if db.session.get(model, key) is None:
+            db.session.add(model(**row))
+            inserted += 1
+    return inserted
+
+# Saves the threads, messages and company mapping a run reads from one mailbox, and their search
+# index entries, a batch of messages at a time. Stored messages are skipped, so incremental runs
+# only add what is new. Emails whose body hasn't been downloaded are indexed by subject and
+# sender with the batch they arrive in, and their entry is replaced if the body is downloaded later.
+class ThreadStore:
+    def __init__(self, user_email, flush_rows=THREAD_STORE_FLUSH_ROWS):
+        self.user_email = user_email
+        self.flush_rows = flush_rows
+        self.threads = {}
+        self.messages = {}
+        self.mappings = set()
+        self.search_entries = {}
+        self.inserted_messages = 0
+
+    # Records a batch of a thread's emails as matched to company_name
+    def add(self, thread_id, company_name, emails):
+        if thread_id not in self.threads:
+            self.threads[thread_id] = {'user_email': self.user_email, 'id': thread_id, 'subject': emails[0].subject}
+        self.mappings.add((company_name, thread_id))
+        for email in emails:
+            self.messages[email.id] = {
+                'user_email': self.user_email,
+                'id': email.id,
+                'thread_id': thread_id,
+                'date': message_date(email),
+                'sender_email': email.sender_email,
+                'recipient_email': email.recipient_email,
+                'subject': email.subject,
+                'has_attachment': email.has_attachment,
+            }
+        self.index(company_name, emails)
+
+    # Queues search index entries for emails of company_name, e.g. once their bodies are downloaded
+    def index(self, company_name, emails):
+        for email in emails:
+            if email.body or email.id not in self.search_entries:
+                self.search_entries[email.id] = (self.user_email, company_name, email)
+        if len(self.messages) >= self.flush_rows or len(self.search_entries) >= self.flush_rows:
+            self.flush()
+
+    # Writes everything buffered
+    def flush(self):
+        if not self.threads and not self.search_entries:
+            return
+        with metrics.timer(metrics.DB_WRITE_SECONDS, 'message'):
+            inserted_threads = insert_new(Thread, list(self.threads.values()))
+            insert_new(CompanyThread, [
+                {'company_name': company_name, 'user_email': self.user_email, 'thread_id': thread_id}
+                for company_name, thread_id in self.mappings
+            ])
+            inserted_messages = insert_new(Message, list(self.messages.values()))
+            index_messages(list(self.search_entries.values()))
+            db.session.commit()
+        metrics.inc(metrics.DB_WRITES, 'thread', amount=inserted_threads)
+        metrics.inc(metrics.DB_WRITES, 'message', amount=inserted_messages)
+        self.inserted_messages += inserted_messages
+        self.threads, self.messages, self.mappings, self.search_entries = {}, {}, set(), {}
+
+# Returns {company_name: (first date, last date, messages)} over every thread of user_email's
+# mailbox stored as mapped to each company, computed by the database. A thread mapped to several
+# companies counts all of its messages for each.
+def company_aggregates(user_email, company_names):
+    aggregates = {}
+    for i in range(0, len(company_names), 500):
+        query = (
+            db.session.query(CompanyThread.company_name, func.min(Message.date), func.max(Message.date), func.count())
+            .join(Message, and_(Message.user_email == CompanyThread.user_email, Message.thread_id == CompanyThread.thread_id))
+            .filter(CompanyThread.user_email == user_email, CompanyThread.company_name.in_(company_names[i:i + 500]))
+            .group_by(CompanyThread.company_name)
+        )
+        for company_name, first_date, last_date, messages in query:
+            aggregates[company_name] = (first_date, last_date, messages)
+    return aggregates
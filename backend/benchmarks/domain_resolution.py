@@ -0,0 +1,95 @@
+"""Company key resolution for sender/recipient pairs: the old per-message path against DomainResolver.
+
+Run from the backend directory:
+
+    python -m benchmarks.domain_resolution --pairs 1000000
+"""
+import argparse
+import json
+import random
+import time
+from app.domains import DomainResolver
+
+INTERNAL = ['mucker.com', 'muckercapital.com']
+BLACKLISTED = ['gmail.com', 'yahoo.com', 'hotmail.com']
+
+# Synthetic address pairs: mostly outside companies (some on subdomains or .vc) writing to or
+# from the fund, with a share of internal and webmail traffic
+def synthetic_pairs(count, seed=0):
+    rng = random.Random(seed)
+    companies = [f"startup{i}.io" for i in range(5000)] + [f"mail.startup{i}.io" for i in range(500)] + \
+                [f"fund{i}.vc" for i in range(200)] + [f"shop{i}.co.uk" for i in range(300)]
+    outside = companies + BLACKLISTED
+    senders, recipients = [], []
+    for _ in range(count):
+        external = f"founder@{rng.choice(outside)}"
+        internal = f"partner@{rng.choice(INTERNAL)}"
+        if rng.random() < 0.1:
+            senders.append(internal)
+            recipients.append(f"analyst@{rng.choice(INTERNAL)}")
+        elif rng.random() < 0.5:
+            senders.append(external)
+            recipients.append(internal)
+        else:
+            senders.append(internal)
+            recipients.append(external)
+    return senders, recipients
+
+# The per-message path the analyzer used before DomainResolver: the domain filter and
+# extract_company_name each split both addresses and test list membership for every message
+def legacy_skipped(sender_email, recipient_email):
+    sender_domain = sender_email.split('@')[1]
+    recipient_domain = recipient_email.split('@')[1]
+    return (sender_domain in INTERNAL and recipient_domain in INTERNAL) or \
+    (sender_domain in BLACKLISTED or recipient_domain in BLACKLISTED)
+
+def legacy_company_name(sender_email, recipient_email):
+    sender_domain = sender_email.split('@')[1]
+    recipient_domain = recipient_email.split('@')[1]
+    if sender_domain.endswith('.vc') or recipient_domain.endswith('.vc'):
+        return None
+    if sender_domain in INTERNAL:
+        return recipient_domain if recipient_domain not in INTERNAL else None
+    elif recipient_domain in INTERNAL:
+        return sender_domain
+    return sender_domain if sender_domain not in BLACKLISTED else None
+
+def legacy_company_key(sender_email, recipient_email):
+    if legacy_skipped(sender_email, recipient_email):
+        return False
+    return legacy_company_name(sender_email, recipient_email)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pairs', type=int, default=1000000)
+    args = parser.parse_args()
+    senders, recipients = synthetic_pairs(args.pairs)
+
+    started = time.perf_counter()
+    legacy_keys = [legacy_company_key(sender, recipient) for sender, recipient in zip(senders, recipients)]
+    legacy_seconds = time.perf_counter() - started
+
+    # Domains are split off once when emails are parsed; that cost is included but also shown alone
+    started = time.perf_counter()
+    sender_domains = [sender.rpartition('@')[2] for sender in senders]
+    recipient_domains = [recipient.rpartition('@')[2] for recipient in recipients]
+    split_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    keys, skipped = DomainResolver(INTERNAL, BLACKLISTED).company_keys(sender_domains, recipient_domains)
+    resolver_seconds = time.perf_counter() - started + split_seconds
+
+    print(json.dumps({
+        'pairs': args.pairs,
+        'legacy': {'seconds': round(legacy_seconds, 3), 'pairs_per_second': round(args.pairs / legacy_seconds)},
+        'resolver': {
+            'seconds': round(resolver_seconds, 3),
+            'pairs_per_second': round(args.pairs / resolver_seconds),
+            'domain_split_seconds': round(split_seconds, 3)
+        },
+        'speedup': round(legacy_seconds / resolver_seconds, 2),
+        'companies': {'legacy': len({key for key in legacy_keys if key}), 'resolver': len({key for key in keys if key})},
+        'skipped': {'legacy': legacy_keys.count(False), 'resolver': sum(skipped)},
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Bytes per parsed message: the old per-message dicts against EmailRecord.
+
+Builds a synthetic mailbox of parsed messages both ways and measures the memory they hold with
+tracemalloc. Run from the backend directory:
+
+    python -m benchmarks.email_record_memory --messages 100000
+"""
+import argparse
+import gc
+import json
+import random
+import tracemalloc
+from app.email_record import EmailRecord
+
+# Synthetic headers and bodies as the parser sees them: every string is freshly decoded per
+# message, even when the same address or date appears thousands of times
+def synthetic_messages(count, seed=0):
+    rng = random.Random(seed)
+    domains = [f"startup{i}.io" for i in range(2000)] + ['gmail.com', 'mucker.com']
+    people = ['alex', 'sam', 'jordan', 'taylor', 'casey', 'morgan']
+    words = 'we are raising a seed round and would love to share our deck with the partners this week'.split()
+    text = ' '.join(rng.choice(words) for _ in range(20000))
+    for i in range(count):
+        domain = rng.choice(domains)
+        start = rng.randint(0, len(text) // 2)
+        yield {
+            'id': f"{i:016x}",
+            'date': f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            'subject': f"Intro {rng.choice(words)} {i % 500}",
+            'sender': f"{rng.choice(people).title()} <{rng.choice(people)}@{domain}>",
+            'sender_email': ''.join([rng.choice(people), '@', domain]),
+            'recipient_email': ''.join(['partner', '@', 'mucker.com']),
+            'body': text[start:start + rng.randint(500, 8000)],
+        }
+
+# The dict the analyzer used to keep per message, with the body cut to 5000 characters
+def as_dict(message):
+    return dict(message, body=message['body'][:5000])
+
+def as_record(message):
+    return EmailRecord(message['id'], message['date'], message['subject'], message['sender_email'],
+                       message['recipient_email'], message['body'])
+
+# Returns the bytes still allocated after building every message with build
+def measure(build, count):
+    gc.collect()
+    tracemalloc.start()
+    kept = [build(message) for message in synthetic_messages(count)]
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return held
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    args = parser.parse_args()
+
+    results = {}
+    for name, build in (('dict', as_dict), ('email_record', as_record)):
+        held = measure(build, args.messages)
+        results[name] = {'bytes': held, 'bytes_per_message': round(held / args.messages, 1)}
+    results['reduction'] = round(1 - results['email_record']['bytes'] / results['dict']['bytes'], 3)
+    print(json.dumps({'messages': args.messages, **results}, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""In-process stand-in for the Gmail API client, serving a SyntheticMailbox."""
+import copy
+import json
+import threading
+import time
+from googleapiclient.errors import HttpError
+
+class FakeResponse(dict):
+    def __init__(self, status):
+        super().__init__(status=str(status))
+        self.status = status
+        self.reason = 'Fake error'
+
+# A request that runs fn when executed, like googleapiclient's HttpRequest
+class FakeRequest:
+    def __init__(self, service, method, fn):
+        self.service = service
+        self.method = method
+        self.methodId = 'gmail.users.' + method
+        self.fn = fn
+
+    def execute(self, http=None, num_retries=0):
+        self.service.round_trip()
+        return self.service.call(self.method, self.fn)
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None, callback=None):
+        self.requests.append((request_id, request))
+
+    def execute(self, http=None):
+        self.service.round_trip()
+        self.service.count('batch')
+        for request_id, request in self.requests:
+            try:
+                response, exception = self.service.call(request.method, request.fn), None
+            except HttpError as e:
+                response, exception = None, e
+            self.callback(request_id, response, exception)
+
+class FakeResource:
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
+
+# Serves threads().list/get, messages().get, history().list and getProfile from a mailbox.
+# latency is slept once per HTTP round trip (a batch counts once). Call counts and response
+# bytes are recorded per method.
+class FakeGmailService:
+    def __init__(self, mailbox, latency=0.0, page_size_cap=500):
+        self.mailbox = mailbox
+        self.latency = latency
+        self.page_size_cap = page_size_cap
+        self.calls = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def count(self, method, size=0):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.bytes += size
+
+    def call(self, method, fn):
+        response = fn()
+        self.count(method, len(json.dumps(response)))
+        return response
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def users(self):
+        return FakeResource(
+            threads=lambda: FakeResource(list=self.list_threads, get=self.get_thread),
+            messages=lambda: FakeResource(get=self.get_message),
+            history=lambda: FakeResource(list=self.list_history),
+            getProfile=lambda userId: FakeRequest(self, 'getProfile', lambda: {'historyId': str(self.mailbox.history_id)}),
+        )
+
+    def list_threads(self, userId, maxResults=100, pageToken=None, **kwargs):
+        def fn():
+            start = int(pageToken or 0)
+            end = start + min(maxResults, self.page_size_cap)
+            page = self.mailbox.threads[start:end]
+            response = {'threads': [{'id': t['id'], 'historyId': t['historyId'], 'snippet': t['messages'][0]['snippet']}
+                                    for t in page]}
+            if end < len(self.mailbox.threads):
+                response['nextPageToken'] = str(end)
+            return response
+        return FakeRequest(self, 'threads.list', fn)
+
+    def get_thread(self, userId, id, format='full', metadataHeaders=None):
+        def fn():
+            thread = self.mailbox.threads_by_id.get(id)
+            if thread is None:
+                raise HttpError(FakeResponse(404), b'Not found')
+            if format != 'metadata':
+                return thread
+            return dict(thread, messages=[metadata_message(msg, metadataHeaders) for msg in thread['messages']])
+        return FakeRequest(self, 'threads.get', fn)
+
+    def get_message(self, userId, id, format='full'):
+        def fn():
+            msg = self.mailbox.messages_by_id.get(id)
+            if msg is None:
+                raise HttpError(FakeResponse(404), b'Not found')
+            return msg
+        return FakeRequest(self, 'messages.get', fn)
+
+    def list_history(self, userId, startHistoryId, historyTypes=None, pageToken=None):
+        def fn():
+            added = [{'messagesAdded': [{'message': {'id': msg['id'], 'threadId': msg['threadId']}}]}
+                     for msg in self.mailbox.messages_by_id.values() if int(msg['historyId']) > int(startHistoryId)]
+            return {'history': added, 'historyId': str(self.mailbox.history_id)}
+        return FakeRequest(self, 'history.list', fn)
+
+# Strips a message to the requested headers and no body data, as format='metadata' does
+def metadata_message(msg, headers):
+    msg = copy.deepcopy(msg)
+    wanted = {header.lower() for header in headers or []}
+    payload = msg['payload']
+    payload['headers'] = [header for header in payload['headers'] if not wanted or header['name'].lower() in wanted]
+    payload.pop('parts', None)
+    payload['body'] = {'size': 0}
+    return msg
@@ -0,0 +1,156 @@
+"""Deterministic synthetic mailboxes in the shape the Gmail API returns them."""
+import base64
+import random
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+# Body layouts seen in real mail, from a bare text/plain payload to nested multipart trees
+MIME_SHAPES = ('plain', 'alternative', 'html', 'mixed', 'nested')
+
+WORDS = ('we are raising a seed round and would love to share our deck with your partners '
+         'our revenue grew forty percent last quarter and the team is hiring engineers '
+         'thanks for the intro happy to set up a call next week to walk through the product').split()
+
+# Text of receipts, newsletters and calendar invites, with nothing that suggests a pitch
+VENDOR_WORDS = ('thanks for your payment your plan renews next month view your account settings and '
+                'manage your email preferences here is what is new this week in the product').split()
+CALENDAR_TEXT = 'Join with Google Meet: meet.google.com/abc-defg-hij\nView all guest info\nReply for yourself'
+
+FUND_DOMAIN = 'mucker.com'
+
+def encode(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+# Builds a deterministic mailbox. Options:
+#   threads            number of threads
+#   messages_per_thread  (min, max) messages in a thread
+#   body_chars         (min, max) characters of text per message body
+#   mime_shapes        {shape: weight} over MIME_SHAPES
+#   domain_mix         {'startup', 'subdomain', 'webmail', 'internal', 'vc', 'newsletter', 'vendor', 'calendar': weight}
+#                      for the outside party. Newsletters, vendor receipts and calendar invites are single
+#                      automated or invitation emails that never mention a pitch.
+#   companies          distinct outside companies to draw from
+#   quoted_replies     share of replies that quote the previous message
+class SyntheticMailbox:
+    def __init__(self, threads=500, messages_per_thread=(1, 6), body_chars=(200, 4000), mime_shapes=None,
+                 domain_mix=None, companies=200, quoted_replies=0.5, seed=0):
+        self.rng = random.Random(seed)
+        self.messages_per_thread = messages_per_thread
+        self.body_chars = body_chars
+        self.mime_shapes = mime_shapes or {'plain': 2, 'alternative': 4, 'html': 1, 'mixed': 2, 'nested': 1}
+        self.domain_mix = domain_mix or {'startup': 6, 'subdomain': 1, 'webmail': 1, 'internal': 1, 'vc': 1}
+        self.companies = companies
+        self.quoted_replies = quoted_replies
+        self.started_at = datetime(2024, 1, 1, 9, 0, tzinfo=timezone.utc)
+        self.threads = [self.build_thread(i) for i in range(threads)]
+        # Threads are listed newest first, like threads().list
+        self.threads.sort(key=lambda thread: int(thread['historyId']), reverse=True)
+        self.threads_by_id = {thread['id']: thread for thread in self.threads}
+        self.messages_by_id = {msg['id']: msg for thread in self.threads for msg in thread['messages']}
+        self.history_id = max((int(thread['historyId']) for thread in self.threads), default=1)
+
+    def pick(self, weights):
+        return self.rng.choices(list(weights), weights=list(weights.values()))[0]
+
+    def outside_address(self, kind):
+        company = self.rng.randrange(self.companies)
+        if kind == 'newsletter':
+            return f"Newsletter {company} <newsletter@news{company}.com>"
+        if kind == 'vendor':
+            return f"Vendor {company} Billing <billing@vendor{company}.com>"
+        domain = {
+            'startup': f"startup{company}.io",
+            'subdomain': f"mail.startup{company}.io",
+            'webmail': self.rng.choice(['gmail.com', 'yahoo.com', 'hotmail.com']),
+            'internal': FUND_DOMAIN,
+            'vc': f"fund{company}.vc",
+            'calendar': f"startup{company}.io",
+        }[kind]
+        return f"Founder {company} <founder{company}@{domain}>"
+
+    def text(self, chars, vocabulary=WORDS):
+        words = []
+        length = 0
+        while length < chars:
+            word = self.rng.choice(vocabulary)
+            words.append(word)
+            length += len(word) + 1
+        sentences = ' '.join(words)
+        return '\n'.join(sentences[i:i + 72] for i in range(0, len(sentences), 72))
+
+    def body_text(self, previous):
+        text = self.text(self.rng.randint(*self.body_chars))
+        if previous and self.rng.random() < self.quoted_replies:
+            quoted = '\n'.join('> ' + line for line in previous.splitlines())
+            text += f"\n\nOn Mon, Jan 1, 2024 at 9:00 AM Someone <someone@example.com> wrote:\n{quoted}"
+        return text + "\n\n--\nBest,\nFounder\nCEO | +1 555 0100"
+
+    def payload(self, shape, text, headers):
+        html = '<html><body>' + ''.join(f'<p>{line}</p>' for line in text.splitlines()) + '</body></html>'
+        plain_part = {'mimeType': 'text/plain', 'body': {'size': len(text), 'data': encode(text)}}
+        html_part = {'mimeType': 'text/html', 'body': {'size': len(html), 'data': encode(html)}}
+        alternative = {'mimeType': 'multipart/alternative', 'body': {'size': 0}, 'parts': [plain_part, html_part]}
+        attachment = {'mimeType': 'application/pdf', 'filename': 'deck.pdf',
+                      'body': {'size': 250000, 'attachmentId': 'attachment'}}
+        if shape == 'plain':
+            payload = dict(plain_part)
+        elif shape == 'html':
+            payload = dict(html_part)
+        elif shape == 'alternative':
+            payload = dict(alternative)
+        elif shape == 'mixed':
+            payload = {'mimeType': 'multipart/mixed', 'body': {'size': 0}, 'parts': [alternative, attachment]}
+        else:
+            related = {'mimeType': 'multipart/related', 'body': {'size': 0}, 'parts': [alternative]}
+            payload = {'mimeType': 'multipart/mixed', 'body': {'size': 0}, 'parts': [related, attachment]}
+        payload['headers'] = headers
+        return payload
+
+    # Subject, body and MIME shape of the single email of a newsletter, vendor or calendar thread
+    def automated_email(self, kind, index):
+        if kind == 'newsletter':
+            text = self.text(self.rng.randint(*self.body_chars), VENDOR_WORDS) + '\n\nUnsubscribe'
+            return f"Your weekly digest #{index}", text, 'html'
+        if kind == 'vendor':
+            return f"Your receipt #{index}", self.text(self.rng.randint(200, 600), VENDOR_WORDS), 'alternative'
+        return f"Invitation: Catch up #{index} @ Tue Jan 9, 2024 10am", CALENDAR_TEXT, 'alternative'
+
+    def build_thread(self, index):
+        thread_id = f"{index:016x}"
+        kind = self.pick(self.domain_mix)
+        outside = self.outside_address(kind)
+        partner = f"Partner <partner@{FUND_DOMAIN}>"
+        outside_first = self.rng.random() < 0.6
+        sent_at = self.started_at + timedelta(hours=self.rng.randrange(24 * 365))
+        messages, previous = [], None
+        automated = kind in ('newsletter', 'vendor', 'calendar')
+        length = 1 if automated else self.rng.randint(*self.messages_per_thread)
+        for position in range(length):
+            from_outside = automated or (position % 2 == 0) == outside_first
+            sender, recipient = (outside, partner) if from_outside else (partner, outside)
+            if automated:
+                subject, text, shape = self.automated_email(kind, index)
+            else:
+                subject, text, shape = ('Re: ' if position else '') + f"Intro to company {index}", self.body_text(previous), None
+            headers = [
+                {'name': 'From', 'value': sender},
+                {'name': 'To', 'value': recipient},
+                {'name': 'Subject', 'value': subject},
+                {'name': 'Date', 'value': format_datetime(sent_at)},
+                {'name': 'Message-ID', 'value': f"<{thread_id}.{position}@mail.example.com>"},
+                {'name': 'Received', 'value': 'from mail.example.com by mx.google.com with ESMTPS ' * 3},
+            ]
+            messages.append({
+                'id': f"{thread_id}{position:04x}",
+                'threadId': thread_id,
+                'historyId': str(1000 + index * 100 + position),
+                'snippet': text[:120],
+                'payload': self.payload(shape or self.pick(self.mime_shapes), text, headers),
+                'sizeEstimate': len(text) * 2,
+            })
+            previous = text
+            sent_at += timedelta(hours=self.rng.randint(1, 72))
+        return {'id': thread_id, 'historyId': messages[-1]['historyId'], 'messages': messages}
+
+    def message_count(self):
+        return len(self.messages_by_id)
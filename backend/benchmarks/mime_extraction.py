@@ -0,0 +1,142 @@
+"""Body extraction over common MIME shapes: the old top-level get_email_body against app.mime.
+
+Run from the backend directory:
+
+    python -m benchmarks.mime_extraction --messages 2000
+"""
+import argparse
+import base64
+import json
+import random
+import time
+from app.email_record import BODY_CHARS
+from app.mime import extract_text
+from benchmarks.mailbox import encode
+
+TEXT = ('Thanks for the intro. We are raising a $2M seed round and would love to share our deck. '
+        'Revenue grew 40% last quarter and we are hiring our first sales lead. ') * 3
+
+CSS = 'body{margin:0;padding:0} .header{font-family:Helvetica,Arial,sans-serif;color:#333} ' * 60
+
+def text_part(text, mime_type='text/plain'):
+    return {'mimeType': mime_type, 'headers': [], 'body': {'size': len(text), 'data': encode(text)}}
+
+def html_part(text, styled=False):
+    paragraphs = ''.join(f'<tr><td class="content"><p>{line}</p></td></tr>' for line in text.split('. '))
+    head = f'<head><title>Update</title><style>{CSS}</style></head>' if styled else ''
+    return text_part(f'<html>{head}<body><table>{paragraphs}</table></body></html>', 'text/html')
+
+def multipart(mime_type, *parts):
+    return {'mimeType': mime_type, 'headers': [], 'body': {'size': 0}, 'parts': list(parts)}
+
+def attachment(mime_type, filename):
+    return {'mimeType': mime_type, 'filename': filename, 'headers': [], 'body': {'size': 250000, 'attachmentId': 'a'}}
+
+# Payload shapes seen in real mailboxes, from plain text to signed, forwarded and HTML-only mail
+def corpus_shapes(text):
+    alternative = multipart('multipart/alternative', text_part(text), html_part(text))
+    return {
+        'plain': text_part(text),
+        'alternative': alternative,
+        'mixed_attachment': multipart('multipart/mixed', alternative, attachment('application/pdf', 'deck.pdf')),
+        'related_inline_image': multipart('multipart/mixed', multipart(
+            'multipart/related', alternative, attachment('image/png', 'logo.png')
+        ), attachment('application/pdf', 'deck.pdf')),
+        'html_only': html_part(text),
+        'html_newsletter': html_part(text, styled=True),
+        'html_only_with_attachment': multipart('multipart/mixed', html_part(text), attachment('application/pdf', 'deck.pdf')),
+        'calendar_invite': multipart('multipart/mixed', multipart(
+            'multipart/alternative', text_part(text), html_part(text), text_part('BEGIN:VCALENDAR', 'text/calendar')
+        ), attachment('application/ics', 'invite.ics')),
+        'signed': multipart('multipart/signed', alternative, attachment('application/pkcs7-signature', 'smime.p7s')),
+        'forwarded': multipart('multipart/mixed', text_part('FYI, see below.'), {
+            'mimeType': 'message/rfc822', 'filename': '', 'headers': [], 'body': {'size': 0},
+            'parts': [multipart('multipart/alternative', text_part(text), html_part(text))]
+        }),
+    }
+
+# The extraction the analyzer used before app.mime: the top-level body, top-level text/plain
+# parts and text/plain inside a top-level multipart/alternative, each decoded in full
+def legacy_body(msg, counter):
+    def decode_body(body):
+        if 'data' in body:
+            decoded = base64.urlsafe_b64decode(body['data'])
+            counter[0] += len(decoded)
+            return decoded.decode('utf-8', errors='ignore')
+        return ''
+
+    payload = msg['payload']
+    if 'body' in payload and payload['body'].get('data'):
+        return decode_body(payload['body'])
+    if 'parts' in payload:
+        text_content = ''
+        for part in payload['parts']:
+            if part['mimeType'] == 'text/plain':
+                text_content += decode_body(part['body'])
+            elif part['mimeType'] == 'multipart/alternative':
+                for subpart in part['parts']:
+                    if subpart['mimeType'] == 'text/plain':
+                        text_content += decode_body(subpart['body'])
+        if text_content:
+            return text_content
+    return msg.get('snippet', '')
+
+# Counts decoded bytes by wrapping base64.urlsafe_b64decode, which both implementations call
+def count_decoded(counter):
+    original = base64.urlsafe_b64decode
+
+    def decode(data):
+        decoded = original(data)
+        counter[0] += len(decoded)
+        return decoded
+    base64.urlsafe_b64decode = decode
+    return original
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000, help='messages per shape')
+    parser.add_argument('--body-chars', type=int, default=20000, help='approximate characters of text per message')
+    args = parser.parse_args()
+    rng = random.Random(0)
+
+    corpus = {}
+    for _ in range(args.messages):
+        text = '. '.join(rng.sample(TEXT.split('. '), 4)) + ' ' + TEXT * (args.body_chars // len(TEXT))
+        for shape, payload in corpus_shapes(text).items():
+            corpus.setdefault(shape, []).append({'snippet': 'SNIPPET', 'payload': payload})
+
+    results = {}
+    for shape, messages in corpus.items():
+        legacy_bytes = [0]
+        started = time.perf_counter()
+        legacy = [legacy_body(msg, legacy_bytes)[:BODY_CHARS] for msg in messages]
+        legacy_seconds = time.perf_counter() - started
+
+        walker_bytes = [0]
+        original = count_decoded(walker_bytes)
+        try:
+            started = time.perf_counter()
+            walked = [extract_text(msg['payload'], BODY_CHARS) or msg['snippet'] for msg in messages]
+            walker_seconds = time.perf_counter() - started
+        finally:
+            base64.urlsafe_b64decode = original
+
+        results[shape] = {
+            'legacy': {
+                'seconds': round(legacy_seconds, 4),
+                'bytes_decoded': legacy_bytes[0],
+                'snippet_fallbacks': legacy.count('SNIPPET'),
+                'raw_html': sum(body.lstrip().startswith('<') for body in legacy),
+            },
+            'walker': {
+                'seconds': round(walker_seconds, 4),
+                'bytes_decoded': walker_bytes[0],
+                'snippet_fallbacks': walked.count('SNIPPET'),
+                'raw_html': sum(body.lstrip().startswith('<') for body in walked),
+            },
+            'speedup': round(legacy_seconds / walker_seconds, 2),
+        }
+    print(json.dumps({'messages_per_shape': args.messages, 'body_chars': BODY_CHARS, 'shapes': results}, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""Offline scenario benchmarks for the analysis pipeline.
+
+Runs analyze_emails end to end against a synthetic mailbox served by a fake Gmail client, with a
+stub OpenAI client, and reports throughput, peak RSS and per-stage timings as JSON. Each scenario
+runs in its own process so peak RSS is not shared between them. Run from the backend directory:
+
+    python -m benchmarks.run_scenarios                       # every scenario
+    python -m benchmarks.run_scenarios small medium --output results.json
+    python -m benchmarks.run_scenarios --compare baseline.json
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Stage functions timed in each run. Timings of async stages are wall time spent inside them,
+# so stages that overlap in the pipeline can add up to more than the total.
+STAGES = ('extract_email_data', 'get_email_body', 'load_email_bodies', 'classify_group_batch', 'generate_csv')
+
+SCENARIOS = {
+    'small': {'mailbox': {'threads': 200}},
+    'medium': {'mailbox': {'threads': 2000}, 'gmail_latency': 0.005, 'openai_latency': 0.2},
+    'large': {'mailbox': {'threads': 10000, 'messages_per_thread': (1, 4), 'companies': 2000}, 'openai_latency': 0.2},
+    'long_bodies': {'mailbox': {'threads': 1000, 'body_chars': (5000, 30000)}},
+    'html_heavy': {'mailbox': {'threads': 1000, 'mime_shapes': {'html': 3, 'nested': 3, 'mixed': 1}}},
+    'webmail_heavy': {'mailbox': {'threads': 2000, 'domain_mix': {'startup': 1, 'webmail': 6, 'internal': 3}}},
+    'vendor_heavy': {'mailbox': {'threads': 2000, 'domain_mix': {'startup': 4, 'newsletter': 2, 'vendor': 2, 'calendar': 2}}},
+    'concurrent_fetch': {'mailbox': {'threads': 2000}, 'gmail_latency': 0.005, 'fetch_mode': 'concurrent'},
+}
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+# Replaces each stage function in module with a wrapper that adds up its calls and wall time
+def instrument(module, names):
+    timings = {name: {'calls': 0, 'seconds': 0.0} for name in names}
+
+    def wrap(name, fn):
+        timing = timings[name]
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    timing['calls'] += 1
+                    timing['seconds'] += time.perf_counter() - started
+        else:
+            @functools.wraps(fn)
+            def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    timing['calls'] += 1
+                    timing['seconds'] += time.perf_counter() - started
+        return timed
+
+    for name in names:
+        setattr(module, name, wrap(name, getattr(module, name)))
+    return timings
+
+# Runs one scenario in this process and returns its results
+def run_scenario(name, config):
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    from flask import Flask
+    from app import classifier, email_analyzer, metrics, preclassifier
+    from app.extensions import db
+    from app.gmail_client import stream_threads
+    from app.message_cache import MemoryMessageCache
+    from app.search import create_search_index
+    from benchmarks.fake_gmail import FakeGmailService
+    from benchmarks.mailbox import SyntheticMailbox
+    from benchmarks.stub_openai import StubAsyncOpenAI
+
+    started = time.perf_counter()
+    mailbox = SyntheticMailbox(**config['mailbox'])
+    build_seconds = time.perf_counter() - started
+    service = FakeGmailService(mailbox, latency=config.get('gmail_latency', 0.0))
+    stub = StubAsyncOpenAI(latency=config.get('openai_latency', 0.0))
+
+    email_analyzer.gmail_service = lambda credentials, user_email=None: service
+    classifier.client = stub
+    email_analyzer.MAX_EMAILS = mailbox.message_count()
+    email_analyzer.WRITE_CSV_FILE = False
+    email_analyzer.email_cache = MemoryMessageCache(maxsize=mailbox.message_count() + 1)
+    timings = instrument(email_analyzer, STAGES)
+    fetch_threads = functools.partial(stream_threads, mode=config.get('fetch_mode', 'batch'))
+
+    with tempfile.TemporaryDirectory() as directory:
+        preclassifier.PRECLASSIFIER_MODEL_PATH = os.path.join(directory, 'preclassifier.json')
+        app = Flask('benchmarks', root_path=directory)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(app)
+        with app.app_context():
+            db.create_all()
+            create_search_index()
+            rss_before = peak_rss_bytes()
+            tracker = email_analyzer.ProgressTracker()
+            run_metrics = metrics.RunMetrics()
+            metrics.current_run.set(run_metrics)
+            started = time.perf_counter()
+            num_startups, _ = asyncio.run(email_analyzer.analyze_emails(
+                None, 'partner@mucker.com', True, tracker, fetch_threads=fetch_threads
+            ))
+            seconds = time.perf_counter() - started
+            db.session.remove()
+
+    if num_startups is None:
+        raise RuntimeError(f"Scenario {name} failed: {tracker.current_step}")
+    messages = mailbox.message_count()
+    return {
+        'scenario': name,
+        'threads': len(mailbox.threads),
+        'messages': messages,
+        'startups': num_startups,
+        'seconds': round(seconds, 4),
+        'threads_per_second': round(len(mailbox.threads) / seconds, 1),
+        'messages_per_second': round(messages / seconds, 1),
+        'mailbox_build_seconds': round(build_seconds, 3),
+        'rss_before_run_mb': round(rss_before / 2 ** 20, 1),
+        'peak_rss_mb': round(peak_rss_bytes() / 2 ** 20, 1),
+        'stages': {stage: {'calls': t['calls'], 'seconds': round(t['seconds'], 4)} for stage, t in timings.items()},
+        'gmail_calls': service.calls,
+        'gmail_response_bytes': service.bytes,
+        'openai_calls': stub.calls,
+        'openai_prompt_chars': stub.prompt_chars,
+        'prefiltered_companies': tracker.prefiltered_companies,
+        'llm_calls_saved': tracker.llm_calls_saved,
+        'metrics': run_metrics.summary(),
+    }
+
+# Runs a scenario in a child process and returns its parsed results
+def run_isolated(name, log_level):
+    output = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.run_scenarios', '--child', name, '--log-level', log_level],
+        check=True, stdout=subprocess.PIPE, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+# Compares results with a baseline file and returns the scenarios that got slower or bigger
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as file:
+        baseline = {entry['scenario']: entry for entry in json.load(file)['scenarios']}
+    regressions = []
+    for result in results:
+        before = baseline.get(result['scenario'])
+        if before is None:
+            continue
+        for metric in ('seconds', 'peak_rss_mb'):
+            ratio = result[metric] / before[metric] if before[metric] else 1.0
+            result.setdefault('vs_baseline', {})[metric] = round(ratio, 3)
+            if ratio > 1 + threshold:
+                regressions.append(f"{result['scenario']} {metric}: {before[metric]} -> {result[metric]}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', help=f"scenarios to run (default all): {', '.join(SCENARIOS)}")
+    parser.add_argument('--output', help='write the JSON results to this file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed slowdown before --compare fails')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.disable(getattr(logging, args.log_level.upper()) - 1)
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, SCENARIOS[args.child])))
+        return
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    results = [run_isolated(name, args.log_level) for name in names]
+    regressions = compare(results, args.compare, args.threshold) if args.compare else []
+
+    report = {
+        'environment': {'python': platform.python_version(), 'platform': platform.platform()},
+        'scenarios': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
+    if regressions:
+        print('Regressions:\n  ' + '\n  '.join(regressions), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""Stand-in for AsyncOpenAI that answers classification prompts locally after a fixed delay."""
+import asyncio
+import json
+import re
+import types
+
+COMPANY_BLOCK = re.compile(r'ID: (\S+)\n(.*?)(?=\s*ID: \S+\n|\Z)', re.S)
+STARTUP_WORDS = ('raising', 'deck', 'revenue')
+
+# Mimics chat.completions.create with response_format json_object: every company block whose
+# text mentions fundraising is answered as a startup. Counts calls and prompt characters.
+class StubAsyncOpenAI:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.prompt_chars = 0
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    async def create(self, model=None, messages=(), **kwargs):
+        self.calls += 1
+        prompt = messages[-1]['content']
+        self.prompt_chars += sum(len(message['content']) for message in messages)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        companies = []
+        for company_id, text in COMPANY_BLOCK.findall(prompt):
+            is_startup = any(word in text.lower() for word in STARTUP_WORDS)
+            companies.append({
+                'id': company_id,
+                'is_startup': is_startup,
+                'reasoning': 'Mentions fundraising.' if is_startup else 'No startup signals.',
+                'stage': 'Seed, raising a round' if is_startup else ''
+            })
+        content = json.dumps({'companies': companies})
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content))],
+            usage=types.SimpleNamespace(prompt_tokens=len(prompt) // 4, completion_tokens=len(content) // 4,
+                                        total_tokens=(len(prompt) + len(content)) // 4)
+        )
@@ -0,0 +1,20 @@
+import os
+import pytest
+from flask import Flask
+
+# The classifier builds its OpenAI client on import; tests swap it for a stub
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+from app.extensions import db
+
+# A bare Flask app on a throwaway SQLite database, with its app context pushed for the test
+@pytest.fixture
+def app(tmp_path):
+    app = Flask('tests', root_path=str(tmp_path))
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + str(tmp_path / 'test.db')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
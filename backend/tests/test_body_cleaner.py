@@ -0,0 +1,41 @@
+from app import email_analyzer, metrics
+from app.body_cleaner import clean_body
+from app.classifier import count_tokens
+from app.email_analyzer import clean_email_body
+from app.email_record import BODY_CHARS
+
+QUOTE = "On Mon, Jan 1, 2024 at 9:00 AM Jane Doe <jane@startup.io> wrote:\n"
+
+# Tokens counted as saved for one reason by the call
+def saved(reason, call):
+    before = metrics.PROMPT_TOKENS_SAVED.values.get((reason,), 0)
+    call()
+    return metrics.PROMPT_TOKENS_SAVED.values.get((reason,), 0) - before
+
+# Quoted history past the first BODY_CHARS characters never reached the prompt, so cutting it saves nothing
+def test_text_beyond_the_old_body_is_not_counted():
+    text = "Happy to share our deck ahead of the meeting. " * 10 + "\n" + QUOTE + "> earlier message\n" * 20
+
+    assert saved('quoted', lambda: clean_email_body(text)) == 0
+
+# Only the part of the quote within the first BODY_CHARS characters counts
+def test_quote_is_counted_up_to_the_old_body_length():
+    text = "Sounds good, see you then.\n" + QUOTE + "> earlier message\n" * 40
+
+    assert saved('quoted', lambda: clean_email_body(text)) == count_tokens(text[text.index(QUOTE):BODY_CHARS])
+
+# A body that is only a quote is sent as it was, so nothing is saved
+def test_body_kept_as_it_was_saves_nothing():
+    text = "> earlier message\n" * 5
+
+    assert saved('quoted', lambda: clean_email_body(text)) == 0
+
+# With metrics off, a body is cleaned once and the saved tokens aren't counted
+def test_nothing_is_counted_with_metrics_off(monkeypatch):
+    calls = []
+    monkeypatch.setattr(metrics, 'METRICS_ENABLED', False)
+    monkeypatch.setattr(email_analyzer, 'clean_body', lambda text: calls.append(text) or clean_body(text))
+    text = "Sounds good, see you then.\n" + QUOTE + "> earlier message\n" * 40
+
+    assert clean_email_body(text) == "Sounds good, see you then."
+    assert len(calls) == 1
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import math
+import types
+import pytest
+from app import classifier
+from app.classifier import (classify_companies, count_tokens, CLASSIFIER_CHUNK_TOKENS, CLASSIFIER_MAX_COMPANIES_PER_CHUNK,
+                            CLASSIFIER_PARSE_ATTEMPTS)
+from benchmarks.stub_openai import StubAsyncOpenAI, COMPANY_BLOCK
+
+# Stub that records the company IDs of every request. garbled maps a company ID to how many
+# times the chunk holding it is answered with text that isn't JSON, and omitted to how many times
+# answers leave that company out.
+class RecordingStub(StubAsyncOpenAI):
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+        self.garbled = {}
+        self.omitted = {}
+
+    async def create(self, model=None, messages=(), **kwargs):
+        company_ids = [company_id for company_id, _ in COMPANY_BLOCK.findall(messages[-1]['content'])]
+        self.requests.append(company_ids)
+        response = await super().create(model, messages, **kwargs)
+        if self.garbled.get(company_ids[0]):
+            self.garbled[company_ids[0]] -= 1
+            response.choices[0].message = types.SimpleNamespace(content='Sure! Here is my analysis:')
+        elif any(self.omitted.get(company_id) for company_id in company_ids):
+            verdicts = json.loads(response.choices[0].message.content)['companies']
+            kept = [verdict for verdict in verdicts if not self.omitted.get(verdict['id'])]
+            for company_id in company_ids:
+                if self.omitted.get(company_id):
+                    self.omitted[company_id] -= 1
+            response.choices[0].message = types.SimpleNamespace(content=json.dumps({'companies': kept}))
+        return response
+
+# Swaps the classifier's OpenAI client for a recording stub
+@pytest.fixture
+def stub(monkeypatch):
+    stub = RecordingStub()
+    monkeypatch.setattr(classifier, 'client', stub)
+    return stub
+
+# Companies whose summaries mention raising are startups to the stub; every third one here
+def summaries(count, words=20):
+    return [
+        (f"company{i}.io", ' '.join(['raising' if i % 3 == 0 else 'invoice'] * words))
+        for i in range(count)
+    ]
+
+# Runs classify_companies to completion and returns its verdicts
+def classify(pairs):
+    return asyncio.run(classify_companies(pairs))
+
+# More companies than fit in one request are split into chunks of at most the per-chunk limit,
+# and each company is sent exactly once
+def test_splits_companies_over_the_per_chunk_limit(app, stub):
+    pairs = summaries(CLASSIFIER_MAX_COMPANIES_PER_CHUNK * 2 + 5)
+    verdicts = classify(pairs)
+
+    assert len(stub.requests) == math.ceil(len(pairs) / CLASSIFIER_MAX_COMPANIES_PER_CHUNK)
+    assert all(len(ids) <= CLASSIFIER_MAX_COMPANIES_PER_CHUNK for ids in stub.requests)
+    sent = [company_id for ids in stub.requests for company_id in ids]
+    assert sorted(sent) == sorted(f"c{i}" for i in range(len(pairs)))
+    assert set(verdicts) == {name for name, _ in pairs}
+
+# Summaries that together go over the token budget are split even below the company limit
+def test_splits_chunks_over_the_token_budget(app, stub):
+    tokens_per_word = count_tokens(summaries(1, 100)[0][1]) / 100
+    pairs = summaries(6, int(CLASSIFIER_CHUNK_TOKENS * 0.45 / tokens_per_word))
+    assert CLASSIFIER_CHUNK_TOKENS * 0.4 <= count_tokens(pairs[0][1]) <= CLASSIFIER_CHUNK_TOKENS / 2
+
+    verdicts = classify(pairs)
+
+    assert [len(ids) for ids in stub.requests] == [2, 2, 2]
+    assert set(verdicts) == {name for name, _ in pairs}
+
+# Verdicts from every chunk are merged under the company names, with None for non-startups
+def test_merges_verdicts_across_chunks(app, stub):
+    pairs = summaries(40)
+    verdicts = classify(pairs)
+
+    for i, (name, _) in enumerate(pairs):
+        if i % 3 == 0:
+            assert verdicts[name].startswith('Yes.')
+        else:
+            assert verdicts[name] is None
+
+# A chunk whose answer isn't JSON is sent again and its verdicts still merged
+def test_resends_a_chunk_that_fails_to_parse(app, stub):
+    stub.garbled = {'c0': 1}
+    pairs = summaries(10)
+    verdicts = classify(pairs)
+
+    assert stub.requests == [[f"c{i}" for i in range(10)]] * 2
+    assert set(verdicts) == {name for name, _ in pairs}
+    assert sum(verdict is not None for verdict in verdicts.values()) == 4
+
+# A chunk that never parses only drops its own companies
+def test_drops_only_the_chunk_that_keeps_failing(app, stub):
+    stub.garbled = {'c0': CLASSIFIER_PARSE_ATTEMPTS}
+    pairs = summaries(CLASSIFIER_MAX_COMPANIES_PER_CHUNK + 5)
+    verdicts = classify(pairs)
+
+    failed = [ids for ids in stub.requests if ids[0] == 'c0']
+    assert len(failed) == CLASSIFIER_PARSE_ATTEMPTS and len(stub.requests) == CLASSIFIER_PARSE_ATTEMPTS + 1
+    assert set(verdicts) == {name for i, (name, _) in enumerate(pairs) if f"c{i}" not in failed[0]}
+    assert len(verdicts) == 5
+
+# Companies an answer leaves out are re-sent on their own until they get a verdict
+def test_resends_companies_left_out_of_an_answer(app, stub):
+    stub.omitted = {'c3': 1, 'c7': 2}
+    pairs = summaries(10)
+    verdicts = classify(pairs)
+
+    assert stub.requests == [[f"c{i}" for i in range(10)], ['c3', 'c7'], ['c7']]
+    assert set(verdicts) == {name for name, _ in pairs}
+    assert verdicts['company3.io'].startswith('Yes.')
+
+# Companies still left out after the last attempt are dropped, keeping the rest of their chunk
+def test_drops_companies_left_out_of_every_answer(app, stub):
+    stub.omitted = {'c4': CLASSIFIER_PARSE_ATTEMPTS}
+    pairs = summaries(10)
+    verdicts = classify(pairs)
+
+    assert stub.requests == [[f"c{i}" for i in range(10)]] + [['c4']] * (CLASSIFIER_PARSE_ATTEMPTS - 1)
+    assert set(verdicts) == {name for name, _ in pairs} - {'company4.io'}
@@ -0,0 +1,30 @@
+from app.domains import DomainResolver
+
+# A configured subdomain covers that host and its subdomains, not the rest of its registrable domain
+def test_configured_subdomain_is_not_widened():
+    resolver = DomainResolver(internal_domains={'mucker.com'}, blacklisted_domains={'mail.google.com'})
+
+    keys, skipped = resolver.company_keys(
+        ['mail.google.com', 'eu.mail.google.com', 'google.com', 'cloud.google.com'], ['mucker.com'] * 4
+    )
+
+    assert skipped == [True, True, False, False]
+    assert keys == [None, None, 'google.com', 'google.com']
+
+# A configured domain still covers its subdomains, and senders are keyed by their registrable domain
+def test_configured_domain_covers_subdomains():
+    resolver = DomainResolver(internal_domains={'Mucker.com'}, blacklisted_domains={'gmail.com'})
+
+    keys, skipped = resolver.company_keys(['team.mucker.com', 'mail.acme.io', 'gmail.com'], ['mucker.com', 'team.mucker.com', 'mucker.com'])
+
+    assert skipped == [True, False, True]
+    assert keys == [None, 'acme.io', None]
+
+# An internal subdomain doesn't make the whole registrable domain internal
+def test_internal_subdomain_is_matched_as_written():
+    resolver = DomainResolver(internal_domains={'ventures.acme.com'}, blacklisted_domains=set())
+
+    keys, skipped = resolver.company_keys(['acme.com', 'ventures.acme.com'], ['ventures.acme.com', 'startup.io'])
+
+    assert skipped == [False, False]
+    assert keys == ['acme.com', 'startup.io']
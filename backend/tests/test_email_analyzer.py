@@ -0,0 +1,122 @@
+import asyncio
+import functools
+import pytest
+from app import classifier, email_analyzer, preclassifier
+from app.classifier import CLASSIFIER_CHUNK_TOKENS, CLASSIFIER_CONCURRENCY, CLASSIFIER_MAX_COMPANIES_PER_CHUNK, count_tokens
+from app.email_analyzer import CompanyGroup, PipelineStats, ProgressTracker, analyze_emails, classify_groups
+from app.email_record import EmailRecord
+from app.gmail_client import stream_threads
+from app.message_cache import SQLiteMessageCache
+from app.search import create_search_index
+from benchmarks.fake_gmail import FakeGmailService
+from benchmarks.mailbox import SyntheticMailbox
+from benchmarks.stub_openai import StubAsyncOpenAI
+
+# Stub that slows every request down and records the most that were in flight at once
+class ConcurrencyStub(StubAsyncOpenAI):
+    def __init__(self):
+        super().__init__(latency=0.02)
+        self.in_flight = 0
+        self.most_in_flight = 0
+
+    async def create(self, model=None, messages=(), **kwargs):
+        self.in_flight += 1
+        self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        try:
+            return await super().create(model, messages, **kwargs)
+        finally:
+            self.in_flight -= 1
+
+# Fake Gmail and OpenAI, a persistent message cache and a local model, all in the test's directory
+@pytest.fixture
+def mailbox(app, tmp_path, monkeypatch):
+    service = FakeGmailService(SyntheticMailbox(threads=150))
+    monkeypatch.setattr(email_analyzer, 'gmail_service', lambda credentials, user_email=None: service)
+    monkeypatch.setattr(email_analyzer, 'email_cache', SQLiteMessageCache(path=str(tmp_path / 'cache.db')))
+    monkeypatch.setattr(email_analyzer, 'WRITE_CSV_FILE', False)
+    monkeypatch.setattr(email_analyzer, 'MAX_EMAILS', 10 ** 6)
+    monkeypatch.setattr(classifier, 'client', StubAsyncOpenAI())
+    monkeypatch.setattr(preclassifier, 'PRECLASSIFIER_MODEL_PATH', str(tmp_path / 'preclassifier.json'))
+    preclassifier.local_model.cache_clear()
+    create_search_index()
+    yield service
+    preclassifier.local_model.cache_clear()
+
+# Runs a full analysis of the mailbox and returns its progress tracker
+def analyze(mode='batch'):
+    tracker = ProgressTracker()
+    fetch_threads = functools.partial(stream_threads, mode=mode)
+    asyncio.run(analyze_emails(None, 'partner@mucker.com', True, tracker, fetch_threads=fetch_threads))
+    return tracker
+
+# Summaries are planned from headers alone, so bodies cached by the first run don't change them and
+# every company of an unchanged mailbox reuses its verdict instead of going back to OpenAI
+@pytest.mark.parametrize('mode', ['batch', 'sequential'])
+def test_unchanged_mailbox_reuses_every_verdict(mailbox, mode):
+    first = analyze(mode)
+    assert first.classification_cache_misses > 0
+    calls = classifier.client.calls
+
+    second = analyze(mode)
+
+    assert second.classification_cache_misses == 0
+    assert second.classification_cache_hits == first.classification_cache_misses + first.classification_cache_hits
+    assert second.num_startups == first.num_startups
+    assert classifier.client.calls == calls
+
+# Yields companies whose summaries are large enough that every batch splits into several requests
+async def large_companies(count):
+    tokens_per_word = count_tokens('raising ' * 100) / 100
+    for i in range(count):
+        group = CompanyGroup(f'company{i}.io')
+        group.summary = 'raising ' * int(CLASSIFIER_CHUNK_TOKENS * 0.3 / tokens_per_word)
+        yield group
+
+# Batches in flight share one limit on OpenAI requests, however many chunks each is split into
+def test_batches_share_the_request_limit(app, monkeypatch):
+    stub = ConcurrencyStub()
+    monkeypatch.setattr(classifier, 'client', stub)
+    count = CLASSIFIER_MAX_COMPANIES_PER_CHUNK * CLASSIFIER_CONCURRENCY * 2
+
+    asyncio.run(classify_groups(large_companies(count), None, PipelineStats(), ProgressTracker()))
+
+    assert stub.calls > CLASSIFIER_CONCURRENCY * 2
+    assert stub.most_in_flight == CLASSIFIER_CONCURRENCY
+
+# The local model learns each verdict once, when OpenAI gives it, not again from the cache
+def test_model_learns_only_fresh_verdicts(mailbox):
+    first = analyze()
+    examples = preclassifier.local_model().examples
+    assert examples == first.classification_cache_misses
+
+    analyze()
+
+    assert preclassifier.local_model().examples == examples
+
+# A thread cached without bodies by a metadata-first run is fetched again once full messages are
+# wanted, rather than parsed from records that lack them
+def test_full_mode_fetches_threads_cached_without_bodies(mailbox, monkeypatch):
+    first = analyze()
+    monkeypatch.setattr(email_analyzer, 'GMAIL_METADATA_FIRST', False)
+    mailbox.calls.clear()
+
+    second = analyze()
+
+    assert mailbox.calls['threads.get'] > 0
+    assert second.processed_emails == first.processed_emails
+    assert second.num_startups == first.num_startups
+
+# A cached thread is only rebuilt when every one of its emails can be read from the cache, and
+# the emails read are carried in it
+def test_cached_thread_needs_every_email(mailbox):
+    cache = email_analyzer.email_cache
+    records = [EmailRecord(f'm{i}', '2024-01-01', 'Intro', 'founder@startup.io', 'partner@mucker.com') for i in range(2)]
+    for record in records:
+        cache.set('partner@mucker.com', record.id, record)
+    cache.set_thread('partner@mucker.com', 't1', '7', ['m0', 'm1'])
+
+    thread = email_analyzer.cached_thread('partner@mucker.com', {'id': 't1', 'historyId': '7'})
+    assert [msg['cached'].id for msg in thread['messages']] == ['m0', 'm1']
+
+    cache.connection().execute("DELETE FROM messages WHERE id = 'm1'")
+    assert email_analyzer.cached_thread('partner@mucker.com', {'id': 't1', 'historyId': '7'}) is None
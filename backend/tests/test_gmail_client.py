@@ -0,0 +1,78 @@
+import asyncio
+import math
+import pytest
+from app.gmail_client import stream_threads, fetch_messages, GMAIL_PAGE_SIZE
+from googleapiclient.errors import HttpError
+from benchmarks.fake_gmail import FakeGmailService, FakeRequest, FakeResponse
+from benchmarks.mailbox import SyntheticMailbox
+
+THREADS = 250
+
+@pytest.fixture(scope='module')
+def mailbox():
+    return SyntheticMailbox(threads=THREADS, body_chars=(50, 100))
+
+# Drains stream_threads into {thread_id: (thread_data, error)}
+def collect(service, **kwargs):
+    async def run():
+        return {thread_id: (thread_data, error) async for thread_id, thread_data, error in stream_threads(service, **kwargs)}
+    return asyncio.run(run())
+
+# Batch mode lists and fetches a page of threads per round trip
+def test_batch_mode_fetches_a_page_per_round_trip(app, mailbox):
+    service = FakeGmailService(mailbox)
+    threads = collect(service, mode='batch')
+
+    pages = math.ceil(THREADS / GMAIL_PAGE_SIZE)
+    assert len(threads) == THREADS
+    assert all(thread_data is not None and error is None for thread_data, error in threads.values())
+    assert service.calls == {'threads.list': pages, 'batch': pages, 'threads.get': THREADS}
+
+# Sequential mode sends one threads.get request per thread
+def test_sequential_mode_fetches_one_thread_per_request(app, mailbox):
+    service = FakeGmailService(mailbox)
+    threads = collect(service, mode='sequential')
+
+    assert len(threads) == THREADS
+    assert service.calls == {'threads.list': math.ceil(THREADS / GMAIL_PAGE_SIZE), 'threads.get': THREADS}
+
+# A thread that can't be fetched fails on its own without sinking the rest of its batch
+def test_batch_mode_reports_errors_per_thread(app, mailbox):
+    service = FakeGmailService(mailbox)
+    thread_ids = [thread['id'] for thread in mailbox.threads[:10]] + ['missing']
+    threads = collect(service, mode='batch', thread_ids=thread_ids)
+
+    assert threads['missing'][0] is None and threads['missing'][1].resp.status == 404
+    assert all(threads[thread_id][0]['id'] == thread_id for thread_id in thread_ids[:-1])
+    # One round trip: not-found errors are not retried, and known thread IDs are not listed.
+    # The fake only counts calls that returned a thread.
+    assert service.calls == {'batch': 1, 'threads.get': 10}
+
+# Metadata-first runs fetch headers only, then download the bodies they need in batches
+def test_metadata_threads_and_batched_bodies(app, mailbox):
+    service = FakeGmailService(mailbox)
+    threads = collect(service, mode='batch', format='metadata')
+    message_ids = [msg['id'] for thread_data, _ in threads.values() for msg in thread_data['messages']][:150]
+    assert all('data' not in msg['payload'].get('body', {}) for thread_data, _ in threads.values() for msg in thread_data['messages'])
+
+    messages, errors = fetch_messages(service, message_ids, mode='batch')
+
+    assert set(messages) == set(message_ids) and not errors
+    assert service.calls['messages.get'] == 150
+    assert service.calls['batch'] == math.ceil(THREADS / GMAIL_PAGE_SIZE) + math.ceil(150 / GMAIL_PAGE_SIZE)
+
+# Fake whose threads().list fails from the second page on
+class FailingListService(FakeGmailService):
+    def list_threads(self, userId, maxResults=100, pageToken=None, **kwargs):
+        if not pageToken:
+            return super().list_threads(userId, maxResults, pageToken, **kwargs)
+        def fail():
+            raise HttpError(FakeResponse(403), b'Forbidden')
+        return FakeRequest(self, 'threads.list', fail)
+
+# A failed listing fails the stream instead of ending the mailbox early with partial data
+@pytest.mark.parametrize('mode', ['batch', 'concurrent'])
+def test_listing_errors_are_raised(app, mailbox, mode):
+    service = FailingListService(mailbox, page_size_cap=10)
+    with pytest.raises(HttpError):
+        collect(service, mode=mode)
@@ -0,0 +1,106 @@
+import asyncio
+import pytest
+from app import jobs
+from app.extensions import db
+from app.jobs import JobManager
+from app.models import AnalysisJob
+
+# Stand-in for process_emails that reports progress until the job is cancelled
+async def analysis_until_cancelled(credentials, user_email, full_reanalysis, tracker):
+    tracker.update(status="Analyzing")
+    while not tracker.cancelled.is_set():
+        await asyncio.sleep(0.01)
+    return None, None, None, None
+
+# Stand-in for process_emails that finishes after a few progress updates
+async def short_analysis(credentials, user_email, full_reanalysis, tracker):
+    for step in range(3):
+        tracker.update(status="Analyzing", processed_emails=step)
+        await asyncio.sleep(0.05)
+    return 3, None, None, None
+
+@pytest.fixture(autouse=True)
+def quick_polls(monkeypatch):
+    monkeypatch.setattr(jobs, 'JOB_PERSIST_INTERVAL', 0.02)
+    monkeypatch.setattr(jobs, 'process_emails', analysis_until_cancelled)
+
+# Reads the job's saved status afresh
+def saved_status(job_id):
+    db.session.expire_all()
+    return db.session.get(AnalysisJob, job_id).status
+
+# Two managers stand for two server processes sharing the database
+def test_submit_reuses_the_active_job_of_another_process(app):
+    first, second = JobManager(), JobManager()
+    job_id, created = first.submit(app, None, 'partner@mucker.com')
+    assert created
+
+    assert second.submit(app, None, 'partner@mucker.com') == (job_id, False)
+    assert not second.jobs
+
+    first.cancel(job_id)
+
+# The unique index turns away a process whose check ran before another's insert
+def test_racing_submits_start_one_job(app, monkeypatch):
+    first, second = JobManager(), JobManager()
+    job_id, _ = first.submit(app, None, 'partner@mucker.com')
+    checks = []
+    real_active_job = jobs.active_job
+
+    # The first check misses the job, as if it ran just before the other process inserted it
+    def active_job(user_email):
+        checks.append(user_email)
+        return real_active_job(user_email) if len(checks) > 1 else None
+    monkeypatch.setattr(jobs, 'active_job', active_job)
+
+    assert second.submit(app, None, 'partner@mucker.com') == (job_id, False)
+    assert len(checks) == 2
+    assert AnalysisJob.query.filter_by(user_email='partner@mucker.com').count() == 1
+    first.cancel(job_id)
+
+# A job left active by a process that has exited doesn't block the mailbox
+def test_submit_replaces_a_job_of_an_exited_process(app, monkeypatch):
+    db.session.add(AnalysisJob(id='stale', user_email='partner@mucker.com', status='running', worker_pid=2 ** 22 + 1))
+    db.session.commit()
+    manager = JobManager()
+
+    job_id, created = manager.submit(app, None, 'partner@mucker.com')
+
+    assert created and job_id != 'stale'
+    assert saved_status('stale') == 'failed'
+    manager.cancel(job_id)
+
+# A cancel handled by another process is picked up by the process running the job
+def test_cancel_from_another_process(app):
+    owner, other = JobManager(), JobManager()
+    job_id, _ = owner.submit(app, None, 'partner@mucker.com')
+    future = owner.jobs[job_id].future
+
+    assert other.cancel(job_id)
+    future.result(5)
+
+    assert saved_status(job_id) == 'cancelled'
+    assert not other.cancel(job_id)
+
+# Another process follows the job through its saved progress until it ends
+def test_watch_a_job_of_another_process(app, monkeypatch):
+    monkeypatch.setattr(jobs, 'process_emails', short_analysis)
+    owner, other = JobManager(), JobManager()
+    job_id, _ = owner.submit(app, None, 'partner@mucker.com')
+
+    states = [state for state in other.watch(job_id) if state is not None]
+
+    assert states[-1]['job_status'] == 'completed'
+    assert states[-1]['processed_emails'] == 2
+    assert all(state['job_status'] in ('queued', 'running') for state in states[:-1])
+
+# The process running a job streams it from its tracker and ends with the saved final state
+def test_watch_a_job_of_this_process(app, monkeypatch):
+    monkeypatch.setattr(jobs, 'process_emails', short_analysis)
+    manager = JobManager()
+    job_id, _ = manager.submit(app, None, 'partner@mucker.com')
+
+    states = [state for state in manager.watch(job_id, interval=0.01) if state is not None]
+
+    assert states[-1]['job_status'] == 'completed'
+    assert any(state['status'] == 'Analyzing' for state in states[:-1])
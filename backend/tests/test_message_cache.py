@@ -0,0 +1,51 @@
+import sqlite3
+import pytest
+from app.email_record import EmailRecord
+from app.message_cache import MemoryMessageCache, SQLiteMessageCache
+
+# Each test runs against both backends
+@pytest.fixture(params=['memory', 'sqlite'])
+def cache(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryMessageCache()
+    return SQLiteMessageCache(path=str(tmp_path / 'cache.db'))
+
+# A parsed email with the given body
+def record(msg_id, body):
+    return EmailRecord(msg_id, '2024-01-01', 'Intro', 'founder@startup.io', 'partner@mucker.com', body, False)
+
+# Gmail IDs are only unique within a mailbox, so one user never gets another's cached email
+def test_messages_are_kept_per_mailbox(cache):
+    cache.set('a@mucker.com', 'm1', record('m1', 'for a'))
+
+    assert cache.get('a@mucker.com', 'm1').body == 'for a'
+    assert cache.get('b@mucker.com', 'm1') is None
+    assert set(cache.get_many('a@mucker.com', ['m1', 'm2'])) == {'m1'}
+    assert cache.get_many('b@mucker.com', ['m1']) == {}
+
+    cache.set('b@mucker.com', 'm1', record('m1', 'for b'))
+    assert cache.get('a@mucker.com', 'm1').body == 'for a'
+    assert cache.get('b@mucker.com', 'm1').body == 'for b'
+
+# Thread entries are per mailbox too, and only match the history ID they were stored with
+def test_threads_are_kept_per_mailbox(cache):
+    cache.set_thread('a@mucker.com', 't1', '7', ['m1', 'm2'])
+
+    assert cache.get_thread('a@mucker.com', 't1', '7') == ['m1', 'm2']
+    assert cache.get_thread('a@mucker.com', 't1', '8') is None
+    assert cache.get_thread('b@mucker.com', 't1', '7') is None
+
+# A cache file written before entries were keyed by mailbox is discarded rather than shared
+def test_sqlite_drops_a_cache_without_mailboxes(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE messages (id TEXT PRIMARY KEY, data TEXT NOT NULL, size INTEGER NOT NULL, accessed_at REAL NOT NULL)')
+    conn.execute("INSERT INTO messages VALUES ('m1', '{}', 2, 0)")
+    conn.execute('CREATE TABLE threads (id TEXT PRIMARY KEY, history_id TEXT NOT NULL, message_ids TEXT NOT NULL)')
+    conn.commit()
+    conn.close()
+
+    cache = SQLiteMessageCache(path=path)
+
+    assert cache.get('a@mucker.com', 'm1') is None
+    assert cache.stats()['entries'] == 0
@@ -0,0 +1,20 @@
+import json
+from app import preclassifier
+from app.preclassifier import HashedModel, save_model
+
+# Each save writes a temporary file of its own and moves it into place, leaving nothing behind
+def test_save_replaces_the_model_file(tmp_path, monkeypatch):
+    path = tmp_path / 'preclassifier.json'
+    monkeypatch.setattr(preclassifier, 'PRECLASSIFIER_MODEL_PATH', str(path))
+    first, second = HashedModel(), HashedModel()
+    first.learn([1, 2], True)
+    second.learn([3], False)
+    second.learn([4], False)
+
+    save_model(first)
+    save_model(second)
+
+    assert json.loads(path.read_text())['examples'] == 2
+    assert HashedModel.load(str(path)).examples == 2
+    assert [file.name for file in tmp_path.iterdir()] == ['preclassifier.json']
+    assert not first.changed and not second.changed
@@ -0,0 +1,23 @@
+from app.email_analyzer import CompanyGroup
+from app.email_record import EmailRecord
+from app.prompt_builder import build_company_summary, plan_summary, PROMPT_CANDIDATE_THREADS
+
+# A thread of count emails from the company
+def thread(number, count):
+    return [
+        EmailRecord(f't{number}m{i}', f'2024-01-{i + 1:02d}', f'Update {number}', 'founder@startup.io', 'partner@mucker.com',
+                    'We grew revenue again this month and would love your thoughts. ' * 5)
+        for i in range(count)
+    ]
+
+# The summary reports every email of the company's threads, not only those that fit its budget
+def test_summary_counts_every_email_read():
+    group = CompanyGroup('startup.io')
+    for number in range(PROMPT_CANDIDATE_THREADS):
+        group.add_thread(thread(number, 5))
+    plan = plan_summary(group.prompt_threads)
+    assert sum(len(emails) for emails in plan) < PROMPT_CANDIDATE_THREADS * 5
+
+    summary = build_company_summary(group.name, plan, group.interactions())
+
+    assert f"Interactions: {PROMPT_CANDIDATE_THREADS * 5}\n" in summary
@@ -0,0 +1,62 @@
+import json
+from datetime import date
+import pytest
+from app.extensions import db
+from app import routes
+from app.models import Company
+from app.routes import bp
+
+# A client of the app's routes on the test database
+@pytest.fixture
+def client(app):
+    app.secret_key = 'test'
+    app.register_blueprint(bp)
+    return app.test_client()
+
+# Signs the client in as user_email
+def sign_in(client, user_email):
+    with client.session_transaction() as session:
+        session['credentials'] = {'token': 'token'}
+        session['user_email'] = user_email
+
+# A company analyzed from contact's mailbox
+def company(name, contact):
+    return Company(name=name, first_interaction_date=date(2024, 1, 1), last_interaction_date=date(2024, 1, 2),
+                   total_interactions=2, company_contact=contact, last_interaction='Our deck', ai_explanation='Yes.')
+
+# Exports carry email excerpts, so they need a signed-in user
+def test_export_needs_sign_in(client):
+    assert client.get('/companies/export').status_code == 401
+
+# An export holds only the companies analyzed from the signed-in user's mailbox
+def test_export_is_scoped_to_the_user(client):
+    db.session.add_all([company('acme.io', 'a@mucker.com'), company('globex.io', 'b@mucker.com')])
+    db.session.commit()
+    sign_in(client, 'a@mucker.com')
+
+    response = client.get('/companies/export?format=ndjson')
+
+    assert response.status_code == 200
+    assert [json.loads(line)['name'] for line in response.data.decode().splitlines()] == ['acme.io']
+
+# Records the jobs submitted instead of running them
+class RecordingJobManager:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, app, credentials, user_email, full_reanalysis=False):
+        self.submitted.append(user_email)
+        return 'job-1', len(self.submitted) == 1
+
+# The older GET endpoint queues a job like /start_analysis instead of analyzing in the request
+def test_analyze_emails_queues_a_job(client, monkeypatch):
+    manager = RecordingJobManager()
+    monkeypatch.setattr(routes, 'job_manager', manager)
+    sign_in(client, 'a@mucker.com')
+
+    first, second = client.get('/analyze_emails'), client.get('/analyze_emails')
+
+    assert first.status_code == second.status_code == 202
+    assert first.get_json()['job_id'] == second.get_json()['job_id'] == 'job-1'
+    assert second.get_json()['message'] == "Analysis already running"
+    assert manager.submitted == ['a@mucker.com', 'a@mucker.com']
@@ -0,0 +1,49 @@
+from datetime import date
+from sqlalchemy import text
+from app.email_record import EmailRecord
+from app.extensions import db
+from app.search import create_search_index
+from app.thread_store import ThreadStore, company_aggregates
+
+# An email on the given day of January 2024
+def email(msg_id, day, body='Hello'):
+    return EmailRecord(msg_id, f'2024-01-{day:02d}', 'Intro', 'founder@startup.io', 'partner@mucker.com', body, False)
+
+# {message_id: indexed body} of the search index
+def indexed_bodies():
+    return dict(db.session.execute(text("SELECT message_id, body FROM message_search")).fetchall())
+
+# Stores the thread's emails in user_email's mailbox as mapped to Startup
+def store(user_email, thread_id, emails):
+    thread_store = ThreadStore(user_email)
+    thread_store.add(thread_id, 'Startup', emails)
+    thread_store.flush()
+
+# Gmail IDs are only unique within a mailbox, so the same thread ID in another mailbox is a
+# different thread, and another mailbox's threads don't count towards this one's interactions
+def test_aggregates_cover_only_the_analyzed_mailbox(app):
+    create_search_index()
+    store('a@mucker.com', 't1', [email('m1', 5), email('m2', 9)])
+    store('b@mucker.com', 't1', [email('m1', 2), email('m2', 20), email('m3', 21)])
+
+    assert company_aggregates('a@mucker.com', ['Startup']) == {'Startup': (date(2024, 1, 5), date(2024, 1, 9), 2)}
+    assert company_aggregates('b@mucker.com', ['Startup']) == {'Startup': (date(2024, 1, 2), date(2024, 1, 21), 3)}
+    assert company_aggregates('c@mucker.com', ['Startup']) == {}
+
+# Emails without a body are indexed with each batch rather than held until the run ends, and
+# their entry gets the body once it is downloaded
+def test_bodiless_emails_are_indexed_with_each_batch(app):
+    create_search_index()
+    thread_store = ThreadStore('a@mucker.com', flush_rows=2)
+    first, second = email('m1', 1, body=None), email('m2', 2, body=None)
+
+    thread_store.add('t1', 'Startup', [first, second])
+
+    assert not thread_store.search_entries
+    assert indexed_bodies() == {'m1': '', 'm2': ''}
+
+    first.set_body('Our deck is attached')
+    thread_store.index('Startup', [first, second])
+    thread_store.flush()
+
+    assert indexed_bodies() == {'m1': 'Our deck is attached', 'm2': ''}
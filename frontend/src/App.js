@@ -55,16 +55,18 @@ function App() {
     }
   };
 
-  const handleStartAnalysis = async () => {
+  const handleStartAnalysis = async (fullReanalysis = false) => {
     try {
       console.log("Starting analysis...");
       setAnalysisStatus("starting");
       setError(null);
-      const response = await api.post("/start_analysis");
+      const response = await api.post("/start_analysis", {
+        full_reanalysis: fullReanalysis,
+      });
       console.log("Start analysis response:", response);
       if (response.status === 202) {
         setAnalysisStatus("in_progress");
-        checkProgress();
+        watchProgress(response.data.job_id);
       } else {
         throw new Error("Unexpected response from server");
       }
@@ -75,30 +77,65 @@ function App() {
     }
   };
 
-  const checkProgress = async () => {
+  const handleFinalProgress = (state) => {
+    setProgress(state);
+    if (state.status === "Completed") {
+      setAnalysisStatus("completed");
+    } else if (state.status === "Error") {
+      setAnalysisStatus("error");
+      setError("Analysis failed: " + state.current_step);
+    } else {
+      setAnalysisStatus(null);
+    }
+  };
+
+  // Follows the job's server-sent progress events, falling back to polling
+  // if the stream can't be opened or drops
+  const watchProgress = (jobId) => {
+    if (!window.EventSource) {
+      checkProgress(jobId);
+      return;
+    }
+    const source = new EventSource(
+      `${api.defaults.baseURL}/progress_stream/${jobId}`,
+      { withCredentials: true }
+    );
+    source.addEventListener("progress", (event) => {
+      const delta = JSON.parse(event.data);
+      setProgress((previous) => ({ ...previous, ...delta }));
+    });
+    source.addEventListener("done", (event) => {
+      source.close();
+      handleFinalProgress(JSON.parse(event.data));
+    });
+    source.onerror = () => {
+      console.error("Progress stream closed, polling instead");
+      source.close();
+      checkProgress(jobId);
+    };
+  };
+
+  const checkProgress = async (jobId) => {
     try {
       console.log("Checking progress...");
-      const response = await api.get("/check_progress");
+      const response = await api.get("/check_progress", {
+        params: { job_id: jobId },
+      });
       console.log("Progress update received:", response.data);
       setProgress(response.data);
 
-      if (response.data.status === "Completed") {
-        setAnalysisStatus("completed");
-        // Stop checking progress
-        return;
-      } else if (response.data.status === "Error") {
-        setAnalysisStatus("error");
-        setError("Analysis failed: " + response.data.current_step);
+      if (["Completed", "Error", "Cancelled"].includes(response.data.status)) {
+        handleFinalProgress(response.data);
         // Stop checking progress
         return;
       }
 
       // Continue checking progress if not completed or error
-      setTimeout(checkProgress, 2000);
+      setTimeout(() => checkProgress(jobId), 2000);
     } catch (error) {
       console.error("Error checking progress:", error);
       if (error.message === "Network Error") {
-        setTimeout(checkProgress, 5000);
+        setTimeout(() => checkProgress(jobId), 5000);
       } else {
         setError("Failed to check progress: " + error.message);
         setAnalysisStatus(null);
@@ -18,10 +18,18 @@ const StartupsTable = () => {
   useEffect(() => {
     const fetchStartups = async () => {
       try {
-        const response = await axios.get("http://localhost:5001/startups", {
-          withCredentials: true,
-        });
-        const startupsWithIds = response.data.map((startup) => ({
+        // The API returns startups a page at a time; follow X-Next-Cursor until the last page
+        let allStartups = [];
+        let cursor = null;
+        do {
+          const response = await axios.get("http://localhost:5001/startups", {
+            params: { limit: 1000, ...(cursor && { cursor }) },
+            withCredentials: true,
+          });
+          allStartups = allStartups.concat(response.data);
+          cursor = response.headers["x-next-cursor"];
+        } while (cursor);
+        const startupsWithIds = allStartups.map((startup) => ({
           ...startup,
           id: startup.id || startup.name,
         }));